@@ -0,0 +1,163 @@
+from sqlite_helper_classes import *
+from partition_helper_functions import list_partitions, partition_db_name, create_partitioned_engine
+from sqlalchemy import Float, create_engine, func, select, text
+from sqlalchemy.orm import sessionmaker
+from pathlib import Path
+import csv
+import os
+import tempfile
+import time
+
+
+# rows read from the sqlite warehouse and handed to the backend's bulk ingest at a time
+INGEST_BATCH_SIZE = 100000
+
+
+class SqliteBackend:
+    '''the warehouse itself: every loader, merge and partition is written against it, so it has nothing to publish'''
+    name = "sqlite"
+    suffix = ".db"
+
+    def create_engine(self, path, read_only=False):
+        if read_only:
+            return create_engine(f"sqlite:///file:{path}?mode=ro&uri=true", echo=False)
+        return create_engine(f"sqlite:///{path}", echo=False, connect_args={"timeout": 300})
+
+
+class DuckdbBackend:
+    '''
+    columnar copy of the warehouse in one DuckDB file, built from the same sqlite_helper_classes models. Aggregate
+    scans over the fact tables run vectorized there, and the query_helper_functions queries run on it unchanged.
+    '''
+    name = "duckdb"
+    suffix = ".duckdb"
+
+    def load_driver(self):
+        try:
+            import duckdb_engine  # noqa: F401, registers the duckdb:// dialect with sqlalchemy
+        except ImportError:
+            raise Exception("the duckdb backend needs the optional duckdb packages: uv sync --extra duckdb")
+
+    def create_engine(self, path, read_only=False):
+        self.load_driver()
+        return create_engine(f"duckdb:///{path}", echo=False, connect_args={"read_only": read_only})
+
+    def column_type(self, column, dialect):
+        # sqlite stores every Float as an 8 byte REAL, duckdb's FLOAT would only keep 4 of them
+        return "DOUBLE" if isinstance(column.type, Float) else column.type.compile(dialect)
+
+    def table_ddl(self, table, dialect):
+        # no primary keys or indexes: rows arrive deduplicated from the sqlite warehouse, and ART indexes would only
+        # slow the ingest down for a copy that is scanned, not probed
+        columns = ", ".join(
+            f"{column.name} {self.column_type(column, dialect)}{'' if column.nullable else ' NOT NULL'}" for column in table.columns
+        )
+        return f"CREATE TABLE {table.name} ({columns})"
+
+    def create_tables(self, engine):
+        with engine.begin() as connection:
+            for table in Base.metadata.sorted_tables:
+                connection.execute(text(self.table_ddl(table, engine.dialect)))
+
+    def ingest(self, engine, table, columns, rows):
+        '''
+        Arrow ingest when pyarrow is installed: the batch becomes one Arrow table that DuckDB scans in place. Without
+        it the batch is staged as CSV and read by COPY, DuckDB's own bulk loader. Either is one statement per batch.
+        '''
+        column_list = ", ".join(columns)
+        raw_connection = engine.raw_connection()
+        try:
+            duckdb_connection = raw_connection.driver_connection
+            try:
+                import pyarrow
+            except ImportError:
+                pyarrow = None
+            if pyarrow is not None:
+                batch = pyarrow.Table.from_arrays([pyarrow.array(values) for values in zip(*rows)], names=list(columns))
+                duckdb_connection.register("ingest_batch", batch)
+                try:
+                    duckdb_connection.execute(f"INSERT INTO {table.name} ({column_list}) SELECT {column_list} FROM ingest_batch")
+                finally:
+                    duckdb_connection.unregister("ingest_batch")
+            else:
+                with tempfile.TemporaryDirectory() as staging_dir:
+                    staging_path = Path(staging_dir) / f"{table.name}.csv"
+                    with open(staging_path, "w", newline="") as staging:
+                        csv.writer(staging).writerows(tuple("\\N" if value is None else value for value in row) for row in rows)
+                    duckdb_connection.execute(
+                        f"COPY {table.name} ({column_list}) FROM '{staging_path}' (HEADER false, NULLSTR '\\N', QUOTE '\"')"
+                    )
+            raw_connection.commit()
+        finally:
+            raw_connection.close()
+
+    def finish(self, engine):
+        # folds the write-ahead log into the file, so the swapped in file is complete on its own
+        with engine.begin() as connection:
+            connection.execute(text("CHECKPOINT"))
+
+
+BACKENDS = {backend.name: backend for backend in (SqliteBackend(), DuckdbBackend())}
+
+
+def backend_path(db_name, backend_name):
+    return Path(f"{db_name}{BACKENDS[backend_name].suffix}")
+
+
+def warehouse_read_engine(sqlite_engine):
+    '''reads the fact tables through the partition views when the warehouse has been partitioned'''
+    db_name = partition_db_name(sqlite_engine)
+    return create_partitioned_engine(db_name) if list_partitions(db_name) else sqlite_engine
+
+
+def publish_warehouse(sqlite_engine, db_name, backend_name):
+    '''
+    copies every warehouse table into a fresh file of the backend, batch by batch through its bulk ingest, checks
+    the row counts against sqlite and then renames it over the previous copy, so readers of the old copy never see
+    a half-built one. The sqlite warehouse stays the system of record.
+    '''
+    if backend_name == "sqlite":
+        return None
+    backend = BACKENDS[backend_name]
+    live_path = backend_path(db_name, backend_name).resolve()
+    shadow = live_path.with_name(f"{live_path.stem}_shadow{backend.suffix}")
+    for path in (shadow, Path(f"{shadow}.wal")):
+        if path.exists():
+            os.remove(path)
+
+    started = time.perf_counter()
+    target_engine = backend.create_engine(shadow)
+    backend.create_tables(target_engine)
+    read_engine = warehouse_read_engine(sqlite_engine)
+    counts = {}
+    with read_engine.connect() as sqlite_connection:
+        for table in Base.metadata.sorted_tables:
+            columns = [column.name for column in table.columns]
+            result = sqlite_connection.execute(select(*table.columns))
+            rows_copied = 0
+            while rows := [tuple(row) for row in result.fetchmany(INGEST_BATCH_SIZE)]:
+                backend.ingest(target_engine, table, columns, rows)
+                rows_copied += len(rows)
+            counts[table.name] = rows_copied
+    with target_engine.connect() as target_connection:
+        for table in Base.metadata.sorted_tables:
+            target_rows = target_connection.execute(select(func.count()).select_from(table)).scalar()
+            if target_rows != counts[table.name]:
+                target_engine.dispose()
+                raise Exception(f"{table.name}: {target_rows} rows in {shadow.name}, {counts[table.name]} in sqlite")
+    backend.finish(target_engine)
+    target_engine.dispose()
+    if read_engine is not sqlite_engine:
+        read_engine.dispose()
+
+    os.replace(shadow, live_path)
+    print(f"{sum(counts.values())} rows published to {live_path.name} in {time.perf_counter() - started:.1f} s")
+    return counts
+
+
+def create_backend_session(db_name, backend_name="sqlite"):
+    '''read-only session on the warehouse or on its copy in another backend, for the query_helper_functions queries'''
+    if backend_name == "sqlite" and list_partitions(db_name):
+        return sessionmaker(bind=create_partitioned_engine(db_name))()
+    backend = BACKENDS[backend_name]
+    return sessionmaker(bind=backend.create_engine(backend_path(db_name, backend_name).resolve(), read_only=True))()
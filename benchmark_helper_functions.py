@@ -0,0 +1,223 @@
+from sakila_helper_classes import *
+from sqlite_helper_classes import *
+from sqlite_helper_functions import (
+    build_dim_date, film_dim_values, store_dim_values, customer_dim_values, actor_dim_values, category_dim_values,
+    rental_fact_values, payment_fact_values,
+)
+from scd_helper_functions import SCD_DIMENSIONS, row_hash
+from key_helper_functions import surrogate_key
+from sqlalchemy import create_engine, func, insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import sessionmaker
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from pathlib import Path
+from typing import NamedTuple
+import json
+import random
+import time
+import tracemalloc
+
+
+BENCHMARK_ROWS = 5000
+BENCHMARK_REPEATS = 7
+BENCHMARK_SEED = 42
+BASELINE_PATH = Path("benchmark_baseline.json")
+# a benchmark this much slower per row than its baseline is reported as a regression
+REGRESSION_TOLERANCE = 0.25
+
+
+class BenchmarkResult(NamedTuple):
+    name: str
+    rows: int
+    ns_per_row: float
+    # CPython keeps no running count of allocations, so this is the peak traced memory of one run spread over its rows
+    bytes_per_row: float
+
+
+def synthetic_sakila_rows(rows, seed=BENCHMARK_SEED):
+    '''
+    transient sakila objects shaped like what the extract queries return, from a fixed seed so every run transforms
+    the same rows. They are never attached to a session.
+    '''
+    generator = random.Random(seed)
+    started = datetime(2005, 5, 24, 22, 53, 30)
+    language = Language(language_id=1, name="English")
+    country = Country(country_id=1, country="Canada")
+    city = City(city_id=1, city="Lethbridge", country_id=1)
+    address = Address(address_id=1, city_id=1)
+    staff = Staff(staff_id=1, store_id=1)
+    films, actors, categories, stores, customers, rentals, payments = [], [], [], [], [], [], []
+    for row_id in range(1, rows + 1):
+        touched = started + timedelta(minutes=generator.randint(0, 500000))
+        films.append((Film(film_id=row_id, title=f"FILM {row_id}", rating=generator.choice(["G", "PG", "R"]),
+                           length=generator.randint(46, 185), release_year=2006, last_update=touched), language))
+        actors.append(Actor(actor_id=row_id, first_name="PENELOPE", last_name=f"GUINESS{row_id}", last_update=touched))
+        categories.append(Category(category_id=row_id, name=f"CATEGORY {row_id}", last_update=touched))
+        stores.append((Store(store_id=row_id, address_id=1, last_update=touched), address, city, country))
+        customers.append((Customer(customer_id=row_id, first_name="MARY", last_name=f"SMITH{row_id}", active=True,
+                                   address_id=1, last_update=touched), address, city, country))
+        returned = touched + timedelta(days=generator.randint(1, 9)) if generator.random() < 0.9 else None
+        rentals.append((Rental(rental_id=row_id, rental_date=touched, return_date=returned, inventory_id=row_id,
+                               customer_id=generator.randint(1, 599), staff_id=1),
+                        Inventory(inventory_id=row_id, film_id=generator.randint(1, 1000), store_id=generator.randint(1, 2)),
+                        films[-1][0]))
+        payments.append((Payment(payment_id=row_id, payment_date=touched, customer_id=generator.randint(1, 599), staff_id=1,
+                                 amount=Decimal(generator.choice(["0.99", "2.99", "4.99"])), rental_id=row_id), staff))
+    return {
+        "films": films, "actors": actors, "categories": categories, "stores": stores, "customers": customers,
+        "rentals": rentals, "payments": payments, "days": [date(2005, 5, 24) + timedelta(days=day) for day in range(rows)],
+    }
+
+
+def transform_benchmarks(source_rows):
+    '''name -> (transform of one row, the rows it runs over). Incremental loads call the same transforms.'''
+    film_values = [film_dim_values(film, language) for film, language in source_rows["films"]]
+    tracked_columns = SCD_DIMENSIONS["dim_film"].tracked_columns
+    return {
+        "film_dim_values": (lambda row: film_dim_values(*row), source_rows["films"]),
+        "store_dim_values": (lambda row: store_dim_values(row[0], row[2], row[3]), source_rows["stores"]),
+        "customer_dim_values": (lambda row: customer_dim_values(row[0], row[2], row[3]), source_rows["customers"]),
+        "actor_dim_values": (actor_dim_values, source_rows["actors"]),
+        "category_dim_values": (category_dim_values, source_rows["categories"]),
+        "rental_fact_values": (lambda row: rental_fact_values(*row), source_rows["rentals"]),
+        "payment_fact_values": (lambda row: payment_fact_values(*row), source_rows["payments"]),
+        "build_dim_date": (build_dim_date, source_rows["days"]),
+        "row_hash": (lambda values: row_hash(values, tracked_columns), film_values),
+        "surrogate_key": (lambda payment: surrogate_key("fact_payment", payment[0].payment_id), source_rows["payments"]),
+    }
+
+
+def fact_payment_rows(source_rows):
+    return [
+        {"fact_payment_key": surrogate_key("fact_payment", payment.payment_id), **payment_fact_values(payment, staff)}
+        for payment, staff in source_rows["payments"]
+    ]
+
+
+def write_merge(sqlite_session, rows):
+    for row in rows:
+        sqlite_session.merge(fact_payment(**row))
+    sqlite_session.commit()
+
+
+def write_add_all(sqlite_session, rows):
+    sqlite_session.add_all([fact_payment(**row) for row in rows])
+    sqlite_session.commit()
+
+
+def write_core_executemany(sqlite_session, rows):
+    sqlite_session.execute(insert(fact_payment), rows)
+    sqlite_session.commit()
+
+
+def write_insert_or_replace(sqlite_session, rows):
+    sqlite_session.execute(insert(fact_payment).prefix_with("OR REPLACE"), rows)
+    sqlite_session.commit()
+
+
+def write_on_conflict_upsert(sqlite_session, rows):
+    statement = sqlite_insert(fact_payment)
+    statement = statement.on_conflict_do_update(
+        index_elements=[fact_payment.fact_payment_key],
+        set_={column.name: statement.excluded[column.name] for column in fact_payment.__table__.columns if not column.primary_key},
+    )
+    sqlite_session.execute(statement, rows)
+    sqlite_session.commit()
+
+
+WRITE_STRATEGIES = {
+    "write_merge": write_merge,
+    "write_add_all": write_add_all,
+    "write_core_executemany": write_core_executemany,
+    "write_insert_or_replace": write_insert_or_replace,
+    "write_on_conflict_upsert": write_on_conflict_upsert,
+}
+
+
+def fresh_fact_payment_session():
+    engine = create_engine("sqlite://", echo=False)
+    fact_payment.__table__.create(engine)
+    return sessionmaker(bind=engine)()
+
+
+def measure(run, setup, rows, repeats):
+    '''best wall time of `repeats` runs, then one more run under tracemalloc for the memory figure'''
+    timings = []
+    for _ in range(repeats):
+        state = setup()
+        started = time.perf_counter_ns()
+        run(state)
+        timings.append(time.perf_counter_ns() - started)
+    state = setup()
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        run(state)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(timings) / rows, peak / rows
+
+
+def run_benchmarks(rows=BENCHMARK_ROWS, repeats=BENCHMARK_REPEATS):
+    source_rows = synthetic_sakila_rows(rows)
+    results = []
+    for name, (transform, inputs) in transform_benchmarks(source_rows).items():
+        ns_per_row, bytes_per_row = measure(lambda _: [transform(row) for row in inputs], lambda: None, len(inputs), repeats)
+        results.append(BenchmarkResult(name, len(inputs), ns_per_row, bytes_per_row))
+
+    payment_rows = fact_payment_rows(source_rows)
+    for name, strategy in WRITE_STRATEGIES.items():
+        ns_per_row, bytes_per_row = measure(lambda session: strategy(session, payment_rows), fresh_fact_payment_session,
+                                            len(payment_rows), repeats)
+        # a strategy that silently dropped rows would look fast, so each one is checked once
+        check_session = fresh_fact_payment_session()
+        strategy(check_session, payment_rows)
+        if check_session.query(func.count(fact_payment.fact_payment_key)).scalar() != len(payment_rows):
+            raise Exception(f"{name} did not write every row")
+        results.append(BenchmarkResult(name, len(payment_rows), ns_per_row, bytes_per_row))
+    return results
+
+
+def load_baseline(path=BASELINE_PATH):
+    if not Path(path).exists():
+        return {}
+    with open(path) as baseline:
+        return json.load(baseline)
+
+
+def save_baseline(results, path=BASELINE_PATH):
+    with open(path, "w") as baseline:
+        json.dump({result.name: result._asdict() for result in results}, baseline, indent=2)
+    print(f"benchmark baseline written to {path}")
+
+
+def compare_to_baseline(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    '''{name: current ns/row over baseline ns/row} for every benchmark the baseline has, and the names that regressed'''
+    ratios = {
+        result.name: result.ns_per_row / baseline[result.name]["ns_per_row"]
+        for result in results if result.name in baseline and baseline[result.name]["ns_per_row"] > 0
+    }
+    return ratios, [name for name, ratio in ratios.items() if ratio > 1 + tolerance]
+
+
+def print_benchmarks(results, ratios=None):
+    ratios = ratios or {}
+    print(f"{'benchmark':<28}{'rows':>8}{'ns/row':>12}{'bytes/row':>12}{'vs baseline':>14}")
+    for result in results:
+        ratio = f"{ratios[result.name]:.2f}x" if result.name in ratios else "-"
+        print(f"{result.name:<28}{result.rows:>8}{result.ns_per_row:>12.0f}{result.bytes_per_row:>12.0f}{ratio:>14}")
+
+
+def benchmark_hot_paths(rows=BENCHMARK_ROWS, repeats=BENCHMARK_REPEATS, baseline_path=BASELINE_PATH, save=False):
+    results = run_benchmarks(rows, repeats)
+    ratios, regressions = compare_to_baseline(results, load_baseline(baseline_path))
+    print_benchmarks(results, ratios)
+    if regressions:
+        print(f"slower than baseline by more than {REGRESSION_TOLERANCE:.0%}: {regressions}")
+    elif ratios:
+        print("no benchmark regressed against the baseline")
+    if save:
+        save_baseline(results, baseline_path)
+    return results, regressions
@@ -0,0 +1,152 @@
+from sakila_helper_classes import *
+from sqlite_helper_classes import *
+from source_helper_functions import source_key_range
+from scd_helper_functions import SCD_DIMENSIONS, expire_scd_rows
+from key_helper_functions import FACT_KEYS
+from query_helper_functions import mark_tables_written
+from partition_helper_functions import partition_db_name, partition_fact_keys, delete_partition_facts_after_commit
+from sqlalchemy import func, inspect, text
+
+
+# source table -> (source primary key, warehouse natural id column). Bridges log the film_id whose links changed.
+CHANGE_LOG_TABLES = {
+    "film": ("film_id", dim_film.film_id),
+    "actor": ("actor_id", dim_actor.actor_id),
+    "category": ("category_id", dim_category.category_id),
+    "store": ("store_id", dim_store.store_id),
+    "customer": ("customer_id", dim_customer.customer_id),
+    "rental": ("rental_id", fact_rental.rental_id),
+    "payment": ("payment_id", fact_payment.payment_id),
+    "film_actor": ("film_id", None),
+    "film_category": ("film_id", None),
+}
+
+TRIGGER_EVENTS = [("INSERT", "I", "NEW"), ("UPDATE", "U", "NEW"), ("DELETE", "D", "OLD")]
+
+# sync_state entry of the latest change time applied from a source's change log
+CHANGE_LOG_STATE = "etl_change_log"
+
+# keeps IN lists well under sqlite's bound parameter limit when the source is a local stand-in
+CHANGE_BATCH_SIZE = 5000
+
+
+def trigger_name(table_name, event):
+    return f"etl_{table_name}_{event.lower()}"
+
+
+def change_log_trigger_ddl(dialect_name, table_name, primary_key):
+    statements = []
+    for event, operation, row in TRIGGER_EVENTS:
+        insert = (f"INSERT INTO {ChangeLog.__tablename__} (table_name, row_id, operation, changed_at) "
+                  f"VALUES ('{table_name}', {row}.{primary_key}, '{operation}', CURRENT_TIMESTAMP)")
+        if dialect_name == "mysql":
+            statements.append(f"CREATE TRIGGER {trigger_name(table_name, event)} AFTER {event} ON {table_name} "
+                              f"FOR EACH ROW {insert}")
+        elif dialect_name == "sqlite":
+            statements.append(f"CREATE TRIGGER {trigger_name(table_name, event)} AFTER {event} ON {table_name} "
+                              f"FOR EACH ROW BEGIN {insert}; END")
+        else:
+            raise Exception(f"change log triggers are not supported on {dialect_name}")
+    return statements
+
+
+def install_change_log(mysql_engine):
+    '''
+    creates etl_change_log on the source and an AFTER INSERT/UPDATE/DELETE trigger per table that records the
+    primary key of every touched row and when. Reinstalling replaces the triggers, so it is safe to run more than once,
+    and adds changed_at to a change log created before it was logged.
+    '''
+    ChangeLog.__table__.create(mysql_engine, checkfirst=True)
+    with mysql_engine.begin() as connection:
+        if "changed_at" not in [column["name"] for column in inspect(connection).get_columns(ChangeLog.__tablename__)]:
+            connection.execute(text(f"ALTER TABLE {ChangeLog.__tablename__} ADD COLUMN changed_at DATETIME"))
+        for table_name, (primary_key, _) in CHANGE_LOG_TABLES.items():
+            for event, _, _ in TRIGGER_EVENTS:
+                connection.execute(text(f"DROP TRIGGER IF EXISTS {trigger_name(table_name, event)}"))
+            for statement in change_log_trigger_ddl(mysql_engine.dialect.name, table_name, primary_key):
+                connection.execute(text(statement))
+    print(f"change log triggers installed on {len(CHANGE_LOG_TABLES)} source tables")
+
+
+def uninstall_change_log(mysql_engine):
+    with mysql_engine.begin() as connection:
+        for table_name in CHANGE_LOG_TABLES:
+            for event, _, _ in TRIGGER_EVENTS:
+                connection.execute(text(f"DROP TRIGGER IF EXISTS {trigger_name(table_name, event)}"))
+    ChangeLog.__table__.drop(mysql_engine, checkfirst=True)
+    print("change log triggers removed")
+
+
+def read_change_log(mysql_session):
+    '''
+    returns the change_ids read, {table_name: {row_id: operation}} and the latest changed_at read. Only the last
+    operation per row matters, so an insert followed by a delete inside one cycle collapses to a delete.
+    '''
+    rows = mysql_session.query(
+        ChangeLog.change_id, ChangeLog.table_name, ChangeLog.row_id, ChangeLog.operation, ChangeLog.changed_at
+    ).order_by(ChangeLog.change_id).all()
+    changes = {}
+    # rows logged before changed_at was added have none
+    logged_at = max((row.changed_at for row in rows if row.changed_at is not None), default=None)
+    for _, table_name, row_id, operation, _ in rows:
+        changes.setdefault(table_name, {})[row_id] = operation
+    return [row.change_id for row in rows], changes, logged_at
+
+
+def truncate_change_log(mysql_session, change_ids):
+    '''
+    removes exactly the changes that were read. mysql hands out change_ids before the logging transaction commits,
+    so a lower id can still show up after the read and deleting a range of ids would lose it
+    '''
+    for batch in batches(change_ids):
+        mysql_session.query(ChangeLog).filter(ChangeLog.change_id.in_(batch)).delete(synchronize_session=False)
+    mysql_session.commit()
+
+
+def changed_rows_watermark(mysql_session, timestamp_column, table_changes):
+    '''
+    the latest timestamp_column (last_update, or the rental and payment dates for facts) of the rows the change log
+    upserted, looked up by primary key so no source table is scanned
+    '''
+    model = timestamp_column.class_
+    primary_key = getattr(model, CHANGE_LOG_TABLES[model.__tablename__][0])
+    latest = None
+    for batch in batches([row_id for row_id, operation in table_changes.items() if operation != "D"]):
+        value = mysql_session.query(func.max(timestamp_column)).filter(primary_key.in_(batch)).scalar()
+        if value is not None and (latest is None or value > latest):
+            latest = value
+    return latest
+
+
+def batches(values, size=CHANGE_BATCH_SIZE):
+    values = sorted(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def apply_table_changes(sqlite_session, mysql_session, table_name, incremental_function, table_changes, key_offset=0):
+    upserted_ids = [row_id for row_id, operation in table_changes.items() if operation != "D"]
+    deleted_ids = [row_id for row_id, operation in table_changes.items() if operation == "D"]
+
+    for batch in batches(upserted_ids):
+        incremental_function(sqlite_session, mysql_session, None, changed_ids=batch, key_offset=key_offset)
+
+    # natural ids repeat across sources, so deletes stay inside this source's key range
+    natural_id = CHANGE_LOG_TABLES[table_name][1]
+    warehouse_table = natural_id.class_.__tablename__
+    partitioned_keys = []
+    for batch in batches(deleted_ids):
+        if warehouse_table in SCD_DIMENSIONS:
+            expire_scd_rows(sqlite_session, warehouse_table, batch, key_offset)
+            continue
+        scope = source_key_range(natural_id.class_, key_offset)
+        if warehouse_table in FACT_KEYS:
+            partitioned_keys.extend(partition_fact_keys(partition_db_name(sqlite_session.get_bind()), natural_id, batch, scope).values())
+        sqlite_session.query(natural_id.class_).filter(natural_id.in_(batch), scope).delete(synchronize_session=False)
+    # updated rows keep their dates, so the watermark alone would not show the cached queries that they changed
+    mark_tables_written(sqlite_session, [warehouse_table])
+    sqlite_session.commit()
+    if partitioned_keys:
+        delete_partition_facts_after_commit(sqlite_session, FACT_KEYS[warehouse_table][1], partitioned_keys)
+    print(f"{table_name}: {len(upserted_ids)} rows upserted, {len(deleted_ids)} rows deleted from change log")
+    return len(upserted_ids) + len(deleted_ids)
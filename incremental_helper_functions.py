@@ -1,12 +1,27 @@
 from sakila_helper_classes import *
 from sqlite_helper_classes import *
-from sqlalchemy import func
+from sqlite_helper_functions import (
+    build_dim_date, to_date_key, rental_fact_values, payment_fact_values, rental_fact_query, payment_fact_query,
+    film_dim_values, store_dim_values, customer_dim_values, film_dim_query, store_dim_query, customer_dim_query,
+    actor_dim_values, category_dim_values,
+)
+from scd_helper_functions import merge_scd_rows, merge_changed_rows, copy_film_links, fact_key_map, film_version_keys
+from key_helper_functions import KeyAllocator, surrogate_key
+from source_helper_functions import source_key_range
+from partition_helper_functions import delete_partition_facts_after_commit
+from query_helper_functions import mark_tables_written
+from progress_helper_functions import track
+from sqlalchemy import func, update
 from datetime import datetime, timedelta
 
 
+# rental ids per IN query when open rentals are rechecked against sakila
+OPEN_RENTAL_BATCH_SIZE = 1000
+
+
 def increment_dim_date(sqlite_session, mysql_session):
     current_max =sqlite_session.query(func.max(dim_date.date_key)).scalar()
-    current_end = datetime.strptime(current_max, "%Y%m%d").date()
+    current_end = datetime.strptime(str(current_max), "%Y%m%d").date()
 
     new_dates = [
         mysql_session.query(func.max(Rental.rental_date)).scalar(),
@@ -19,157 +34,190 @@ def increment_dim_date(sqlite_session, mysql_session):
 
     current = current_end + timedelta(days=1)
     while current <= new_end:
-        sqlite_session.merge(dim_date(
-            date_key=current.strftime("%Y%m%d"),
-            date=current.strftime("%Y-%m-%d"),
-            year=str(current.year),
-            quarter=str((current.month - 1) // 3 + 1),
-            month=str(current.month),
-            day_of_month=str(current.day),
-            day_of_week=str(current.isoweekday()),
-            is_weekend=1 if current.isoweekday() >= 6 else 0
-        ))
+        sqlite_session.merge(build_dim_date(current))
         current += timedelta(days=1)
     sqlite_session.commit()
 
-def increment_dim_film(sqlite_session, mysql_session, last_sync):
-    films = mysql_session.query(Film, Language).join(
-        Language, Film.language_id == Language.language_id
-    ).filter(Film.last_update > last_sync).all()
-    for film, language in films:
-        sqlite_session.merge(dim_film(
-            film_key=film.film_id * 100 + 1,
-            film_id=film.film_id,
-            title=film.title,
-            rating=film.rating,
-            length=film.length,
-            language=language.name,
-            release_year=film.release_year,
-            last_update=film.last_update.strftime("%Y-%m-%d")
-        ))
-    sqlite_session.commit()
+def increment_dim_film(sqlite_session, mysql_session, last_sync, changed_ids=None, key_offset=0):
+    '''
+    films whose tracked attributes changed get a new version, films that were only touched are not written.
+    Returns the number of versions written.
+    '''
+    films = film_dim_query(mysql_session).filter(
+        Film.last_update > last_sync if changed_ids is None else Film.film_id.in_(changed_ids)).all()
+    written, new_versions = merge_scd_rows(
+        sqlite_session, "dim_film", [film_dim_values(film, language) for film, language in films], key_offset
+    )
+    copy_film_links(sqlite_session, new_versions)
+    return written
 
-def increment_dim_actor(sqlite_session, mysql_session, last_sync):
-    actors = mysql_session.query(Actor).filter(Actor.last_update > last_sync).all()
-    for actor in actors:
-        sqlite_session.merge(dim_actor(
-            actor_key=50000 + actor.actor_id,
-            actor_id=actor.actor_id,
-            first_name=actor.first_name,
-            last_name=actor.last_name,
-            last_update=actor.last_update.strftime("%Y-%m-%d")
-        ))
-    sqlite_session.commit()
+def increment_dim_actor(sqlite_session, mysql_session, last_sync, changed_ids=None, key_offset=0):
+    '''only actors whose content changed are written, a bumped last_update on its own is skipped'''
+    actors = mysql_session.query(Actor).filter(
+        Actor.last_update > last_sync if changed_ids is None else Actor.actor_id.in_(changed_ids)
+    ).all()
+    return merge_changed_rows(sqlite_session, "dim_actor", [actor_dim_values(actor, key_offset) for actor in actors], key_offset)
 
-def increment_dim_category(sqlite_session, mysql_session, last_sync):
-    categories = mysql_session.query(Category).filter(Category.last_update > last_sync).all()
-    for category in categories:
-        sqlite_session.merge(dim_category(
-            category_key = 30000 + category.category_id * 10 + 1,
-            category_id = category.category_id,
-            name = category.name,
-            last_update = category.last_update.strftime("%Y-%m-%d")
-        ))
-    sqlite_session.commit()
+def increment_dim_category(sqlite_session, mysql_session, last_sync, changed_ids=None, key_offset=0):
+    categories = mysql_session.query(Category).filter(
+        Category.last_update > last_sync if changed_ids is None else Category.category_id.in_(changed_ids)
+    ).all()
+    return merge_changed_rows(
+        sqlite_session, "dim_category", [category_dim_values(category, key_offset) for category in categories], key_offset
+    )
 
-def increment_dim_store(sqlite_session, mysql_session, last_sync):
-    stores = mysql_session.query(Store, Address, City, Country).join(
-        Address, Store.address_id == Address.address_id).join(
-        City, Address.city_id == City.city_id).join(
-        Country, City.country_id == Country.country_id
-    ).filter(Store.last_update > last_sync).all()
-    for store, address, city, country in stores:
-        sqlite_session.merge(dim_store(
-            store_key = 1000 + store.store_id,
-            store_id = store.store_id,
-            city = city.city,
-            country = country.country,
-            last_update = store.last_update.strftime("%Y-%m-%d")
-        ))
-    sqlite_session.commit()
+def increment_dim_store(sqlite_session, mysql_session, last_sync, changed_ids=None, key_offset=0):
+    stores = store_dim_query(mysql_session).filter(
+        Store.last_update > last_sync if changed_ids is None else Store.store_id.in_(changed_ids)).all()
+    written, _ = merge_scd_rows(
+        sqlite_session, "dim_store", [store_dim_values(store, city, country) for store, _, city, country in stores], key_offset
+    )
+    return written
 
-def increment_dim_customer(sqlite_session, mysql_session, last_sync):
-    customers = mysql_session.query(Customer, Address, City, Country).join(
-        Address, Customer.address_id == Address.address_id).join(
-        City, Address.city_id == City.city_id).join(
-        Country, City.country_id == Country.country_id
-    ).filter(Customer.last_update > last_sync).all()
-    for customer, address, city, country in customers:
-        sqlite_session.merge(dim_customer(
-            customer_key = customer.customer_id * 100 + 1,
-            customer_id = customer.customer_id,
-            first_name = customer.first_name,
-            last_name = customer.last_name,
-            active = customer.active,
-            city = city.city,
-            country = country.country,
-            last_update = customer.last_update.strftime("%Y-%m-%d")
-        ))
-    sqlite_session.commit()
+def increment_dim_customer(sqlite_session, mysql_session, last_sync, changed_ids=None, key_offset=0):
+    customers = customer_dim_query(mysql_session).filter(
+        Customer.last_update > last_sync if changed_ids is None else Customer.customer_id.in_(changed_ids)).all()
+    written, _ = merge_scd_rows(sqlite_session, "dim_customer", [
+        customer_dim_values(customer, city, country) for customer, _, city, country in customers
+    ], key_offset)
+    return written
 
-def increment_bridge_film_actor(sqlite_session, mysql_session):
+def increment_bridge_film_actor(sqlite_session, mysql_session, changed_film_ids=None, key_offset=0):
     '''
     we could find all records in MySQL that are not in SQLite, and update the table that way,
     which would not catch deleted rows.
     We could load both tables, and find all records that exist in only one table, and true up accordingly,
     but I think this would be quite slow. This just drops and rebuilds the table, which is simpler
-    and similar performance-wise.
+    and similar performance-wise. The rebuilt links are compared with the stored ones first, and an
+    unchanged table is not rewritten.
+    With the change log enabled only the links of the films that changed are dropped and rebuilt.
+    Links are written for every version of a film, so facts pointing at an older version still find them.
     '''
-    sqlite_session.query(bridge_film_actor).delete()
-    film_actors = mysql_session.query(FilmActor).all()
-    for film_actor in film_actors:
+    film_keys = film_version_keys(sqlite_session, key_offset, changed_film_ids)
+    if changed_film_ids is None:
+        scope = source_key_range(bridge_film_actor, key_offset)
+        film_actors = mysql_session.query(FilmActor).all()
+    else:
+        scope = bridge_film_actor.film_key.in_([key for keys in film_keys.values() for key in keys] +
+                                               [surrogate_key("dim_film", film_id, key_offset) for film_id in changed_film_ids])
+        film_actors = mysql_session.query(FilmActor).filter(FilmActor.film_id.in_(changed_film_ids)).all()
+    links = {
+        (film_key, surrogate_key("dim_actor", film_actor.actor_id, key_offset))
+        for film_actor in track(film_actors, "bridge_film_actor")
+        for film_key in film_keys.get(film_actor.film_id) or [surrogate_key("dim_film", film_actor.film_id, key_offset)]
+    }
+    # an unchanged bridge is left alone, so cached queries over it stay valid
+    if {tuple(link) for link in sqlite_session.query(bridge_film_actor.film_key, bridge_film_actor.actor_key).filter(scope)} == links:
+        return
+    sqlite_session.query(bridge_film_actor).filter(scope).delete(synchronize_session=False)
+    for film_key, actor_key in sorted(links):
         sqlite_session.merge(bridge_film_actor(
-            film_key = film_actor.film_id * 100 + 1,
-            actor_key=50000 + film_actor.actor_id
+            film_key = film_key,
+            actor_key=actor_key
         ))
+    # bridges have no watermark, so cached queries over them only see the rebuild through this
+    mark_tables_written(sqlite_session, ["bridge_film_actor"])
     sqlite_session.commit()
 
 
-def increment_bridge_film_category(sqlite_session, mysql_session):
+def increment_bridge_film_category(sqlite_session, mysql_session, changed_film_ids=None, key_offset=0):
     '''
     everything said about the increment_bridge_film_actor table is also true here
     '''
-    sqlite_session.query(bridge_film_category).delete()
-    film_categories = mysql_session.query(FilmCategory).all()
-    for film_category in film_categories:
+    film_keys = film_version_keys(sqlite_session, key_offset, changed_film_ids)
+    if changed_film_ids is None:
+        scope = source_key_range(bridge_film_category, key_offset)
+        film_categories = mysql_session.query(FilmCategory).all()
+    else:
+        scope = bridge_film_category.film_key.in_([key for keys in film_keys.values() for key in keys] +
+                                                  [surrogate_key("dim_film", film_id, key_offset) for film_id in changed_film_ids])
+        film_categories = mysql_session.query(FilmCategory).filter(FilmCategory.film_id.in_(changed_film_ids)).all()
+    links = {
+        (film_key, surrogate_key("dim_category", film_category.category_id, key_offset))
+        for film_category in track(film_categories, "bridge_film_category")
+        for film_key in film_keys.get(film_category.film_id) or [surrogate_key("dim_film", film_category.film_id, key_offset)]
+    }
+    if {tuple(link) for link in sqlite_session.query(bridge_film_category.film_key, bridge_film_category.category_key).filter(scope)} == links:
+        return
+    sqlite_session.query(bridge_film_category).filter(scope).delete(synchronize_session=False)
+    for film_key, category_key in sorted(links):
         sqlite_session.merge(bridge_film_category(
-            film_key=film_category.film_id * 100 + 1,
-            category_key=30000 + film_category.category_id * 10 + 1
+            film_key=film_key,
+            category_key=category_key
         ))
+    mark_tables_written(sqlite_session, ["bridge_film_category"])
     sqlite_session.commit()
 
-def increment_fact_rental(sqlite_session, mysql_session, last_sync):
-    rentals = mysql_session.query(Rental, Inventory, Film).join(
-        Inventory, Rental.inventory_id == Inventory.inventory_id).join(
-        Film, Film.film_id == Inventory.film_id).filter(Rental.rental_date > last_sync).all()
-    max_key = sqlite_session.query(func.max(fact_rental.fact_rental_key)).scalar() or 50000
-    for i, (rental, inventory, film) in enumerate(rentals, start=1):
+def increment_fact_rental(sqlite_session, mysql_session, last_sync, changed_ids=None, key_offset=0):
+    rentals = rental_fact_query(mysql_session).filter(
+        Rental.rental_date > last_sync if changed_ids is None else Rental.rental_id.in_(changed_ids)).all()
+    # rentals that are already loaded (updates from the change log, or a watermark that was moved back)
+    # keep the surrogate key they have, new ones get the key of their rental_id
+    allocator = KeyAllocator(sqlite_session, "fact_rental", key_offset)
+    allocator.preload([rental.rental_id for rental, _, _ in rentals])
+    key_map = fact_key_map(sqlite_session, key_offset)
+    for rental, inventory, film in track(rentals, "fact_rental"):
         sqlite_session.merge(fact_rental(
-            fact_rental_key = max_key + i,
-            rental_id = rental.rental_id,
-            date_key_rented = rental.rental_date.strftime("%Y%m%d"),
-            date_key_returned = rental.return_date.strftime("%Y%m%d") if rental.return_date is not None else None,
-            film_key = film.film_id*100 + 1,
-            store_key = 1000 + inventory.store_id,
-            customer_key = rental.customer_id * 100 + 1,
-            staff_id = rental.staff_id,
-            rental_duration_days = (rental.return_date - rental.rental_date).days if rental.return_date is not None else None
+            fact_rental_key = allocator.key(rental.rental_id),
+            **rental_fact_values(rental, inventory, film, key_offset, key_map)
         ))
     sqlite_session.commit()
+    # rows read back from a partition now live in main again
+    delete_partition_facts_after_commit(sqlite_session, fact_rental.fact_rental_key, allocator.partitioned.values())
+    return len(rentals)
 
-def increment_fact_payment(sqlite_session, mysql_session, last_sync):
-    payments = mysql_session.query(Payment, Staff).join(
-        Staff, Payment.staff_id == Staff.staff_id
-    ).filter(Payment.payment_date > last_sync).all()
-    max_key = sqlite_session.query(func.max(fact_payment.fact_payment_key)).scalar() or 80000
-    for i, (payment, staff) in enumerate(payments, start=1):
+def increment_fact_payment(sqlite_session, mysql_session, last_sync, changed_ids=None, key_offset=0):
+    payments = payment_fact_query(mysql_session).filter(
+        Payment.payment_date > last_sync if changed_ids is None else Payment.payment_id.in_(changed_ids)).all()
+    allocator = KeyAllocator(sqlite_session, "fact_payment", key_offset)
+    allocator.preload([payment.payment_id for payment, _ in payments])
+    key_map = fact_key_map(sqlite_session, key_offset)
+    for payment, staff in track(payments, "fact_payment"):
         sqlite_session.merge(fact_payment(
-            fact_payment_key = max_key + i,
-            payment_id = payment.payment_id,
-            date_key_paid = payment.payment_date.strftime("%Y%m%d"),
-            customer_key = payment.customer_id * 100 + 1,
-            store_key = 1000 + staff.store_id,
-            staff_id = payment.staff_id,
-            amount = payment.amount
+            fact_payment_key = allocator.key(payment.payment_id),
+            **payment_fact_values(payment, staff, key_offset, key_map)
         ))
-    sqlite_session.commit()
\ No newline at end of file
+    sqlite_session.commit()
+    # rows read back from a partition now live in main again
+    delete_partition_facts_after_commit(sqlite_session, fact_payment.fact_payment_key, allocator.partitioned.values())
+    return len(payments)
+
+def open_rentals(sqlite_session, key_offset=0):
+    '''{rental_id: fact_rental_key} of one source's rentals that have no return date yet, read from index_fact_rental_open'''
+    rows = sqlite_session.query(fact_rental.rental_id, fact_rental.fact_rental_key).filter(
+        fact_rental.date_key_returned.is_(None), source_key_range(fact_rental, key_offset)
+    )
+    return dict(rows.all())
+
+
+def refresh_open_rentals(sqlite_session, mysql_session, batch_size=OPEN_RENTAL_BATCH_SIZE, key_offset=0):
+    '''
+    the watermark only picks up new rentals, so a rental returned later would keep a null date_key_returned forever.
+    Each cycle rechecks just the rentals that are still open, in sorted batches of IN queries against sakila, and
+    writes the returned ones back in one bulk update per batch. The cost follows the open rentals, not the history.
+    Partitioning leaves open rentals in the main file, so every one of them is rechecked.
+    '''
+    rentals = open_rentals(sqlite_session, key_offset)
+    rental_ids = sorted(rentals)
+    returned = 0
+    for start in range(0, len(rental_ids), batch_size):
+        batch = rental_ids[start:start + batch_size]
+        rows = mysql_session.query(Rental.rental_id, Rental.rental_date, Rental.return_date).filter(
+            Rental.rental_id.in_(batch), Rental.return_date.is_not(None)
+        ).all()
+        if not rows:
+            continue
+        sqlite_session.execute(update(fact_rental), [
+            {
+                "fact_rental_key": rentals[rental_id],
+                "date_key_returned": to_date_key(return_date),
+                "rental_duration_days": (return_date - rental_date).days,
+            }
+            for rental_id, rental_date, return_date in rows
+        ])
+        returned += len(rows)
+    if returned:
+        mark_tables_written(sqlite_session, ["fact_rental"])
+    sqlite_session.commit()
+    print(f"fact_rental: {returned} of {len(rental_ids)} open rentals returned")
+    return returned
@@ -0,0 +1,124 @@
+from sqlite_helper_classes import *
+from sqlalchemy import text
+from sqlalchemy.schema import CreateIndex, DropIndex
+
+
+# representative star joins, written without table aliases so EXPLAIN QUERY PLAN reports the real table names
+STAR_QUERIES = {
+    "payments_by_date_range": '''
+        SELECT dim_date.year, dim_date.month, SUM(fact_payment.amount)
+        FROM dim_date JOIN fact_payment ON fact_payment.date_key_paid = dim_date.date_key
+        WHERE dim_date.date BETWEEN '2005-06-01' AND '2005-06-30'
+        GROUP BY dim_date.year, dim_date.month
+    ''',
+    "rentals_for_customer": '''
+        SELECT fact_rental.rental_id, fact_rental.date_key_rented
+        FROM dim_customer JOIN fact_rental ON fact_rental.customer_key = dim_customer.customer_key
+        WHERE dim_customer.customer_id = 1
+    ''',
+    "payments_for_customer": '''
+        SELECT SUM(fact_payment.amount)
+        FROM dim_customer JOIN fact_payment ON fact_payment.customer_key = dim_customer.customer_key
+        WHERE dim_customer.customer_id = 1
+    ''',
+    "rentals_for_film": '''
+        SELECT COUNT(*)
+        FROM dim_film JOIN fact_rental ON fact_rental.film_key = dim_film.film_key
+        WHERE dim_film.film_id = 1
+    ''',
+    "rentals_for_category": '''
+        SELECT COUNT(*)
+        FROM dim_category
+        JOIN bridge_film_category ON bridge_film_category.category_key = dim_category.category_key
+        JOIN fact_rental ON fact_rental.film_key = bridge_film_category.film_key
+        WHERE dim_category.category_id = 1
+    ''',
+}
+
+FACT_TABLES = ("fact_rental", "fact_payment")
+# natural ids are only unique per source since multi-source loads, so these single column unique indexes were replaced
+# by (natural id, store_key) ones, and those by (natural id, key block) ones once store_key became versioned
+RETIRED_INDEXES = ("index_fact_rental_rental_id", "index_fact_payment_payment_id",
+                   "index_fact_rental_rental_id_store_key", "index_fact_payment_payment_id_store_key")
+
+
+def warehouse_indexes():
+    return [index for table in Base.metadata.sorted_tables for index in sorted(table.indexes, key=lambda ix: ix.name)]
+
+
+def create_index(connection, index):
+    '''IF NOT EXISTS rather than checkfirst, which reflects the table and never sees an expression index'''
+    connection.execute(CreateIndex(index, if_not_exists=True))
+
+
+def drop_index(connection, index):
+    connection.execute(DropIndex(index, if_exists=True))
+
+
+def drop_retired_indexes(engine):
+    with engine.begin() as connection:
+        for index_name in RETIRED_INDEXES:
+            connection.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+
+
+def drop_warehouse_indexes(engine):
+    '''
+    secondary indexes are dropped before a bulk load so every inserted row only touches the table B-tree,
+    and rebuilt once afterwards by create_warehouse_indexes
+    '''
+    drop_retired_indexes(engine)
+    with engine.begin() as connection:
+        for index in warehouse_indexes():
+            drop_index(connection, index)
+    print("warehouse indexes dropped for bulk load")
+
+
+def create_warehouse_indexes(engine):
+    drop_retired_indexes(engine)
+    with engine.begin() as connection:
+        for index in warehouse_indexes():
+            create_index(connection, index)
+    print("warehouse indexes created")
+
+
+def analyze_warehouse(engine):
+    with engine.begin() as connection:
+        connection.execute(text("ANALYZE"))
+        connection.execute(text("PRAGMA optimize"))
+    print("warehouse statistics refreshed")
+
+
+def explain_star_queries(engine):
+    plans = {}
+    with engine.connect() as connection:
+        for name, query in STAR_QUERIES.items():
+            rows = connection.execute(text(f"EXPLAIN QUERY PLAN {query}")).all()
+            plans[name] = [row[-1] for row in rows]
+    return plans
+
+
+def is_full_fact_scan(detail):
+    # "SCAN fact_rental" is a full table scan, "SCAN fact_rental USING INDEX ..." is still an index walk
+    words = detail.split()
+    return len(words) >= 2 and words[0] == "SCAN" and words[1] in FACT_TABLES and "USING" not in words
+
+
+def verify_star_query_plans(engine):
+    failed_queries = []
+    for name, details in explain_star_queries(engine).items():
+        if any(is_full_fact_scan(detail) for detail in details):
+            failed_queries.append(name)
+    if failed_queries:
+        return False, failed_queries
+    return True, None
+
+
+def rebuild_warehouse_indexes(engine):
+    create_warehouse_indexes(engine)
+    analyze_warehouse(engine)
+    plans_ok, failed_queries = verify_star_query_plans(engine)
+    if plans_ok:
+        print("all star queries use indexes")
+    else:
+        print(f"star queries still scanning a fact table: {failed_queries}")
+    return plans_ok, failed_queries
@@ -0,0 +1,150 @@
+from sqlite_helper_classes import *
+from sqlite_helper_functions import build_dim_date, to_date_key
+from scd_helper_functions import SCD_DIMENSIONS, OPEN_EXPIRY_DATE, PLACEHOLDER_ROW_HASH
+from key_helper_functions import natural_id_from_key
+from source_helper_functions import source_key_range
+from changelog_helper_functions import batches
+from query_helper_functions import mark_tables_written
+from sqlalchemy import exists, func, insert, select
+from typing import NamedTuple
+from datetime import date, datetime
+
+
+# inserting placeholder members for orphan keys instead of only reporting them, set from --integrity-placeholders
+INTEGRITY_PLACEHOLDERS = False
+PLACEHOLDER_LABEL = "UNKNOWN"
+
+
+class FactReference(NamedTuple):
+    fact_column: object
+    dimension_key: object
+
+    @property
+    def name(self):
+        return f"{self.fact_column.table.name}.{self.fact_column.name}"
+
+
+# every dimension key a fact row carries. No foreign keys are declared in the warehouse, so these are only checked here
+FACT_REFERENCES = [
+    FactReference(fact_rental.film_key, dim_film.film_key),
+    FactReference(fact_rental.customer_key, dim_customer.customer_key),
+    FactReference(fact_rental.store_key, dim_store.store_key),
+    FactReference(fact_rental.date_key_rented, dim_date.date_key),
+    FactReference(fact_rental.date_key_returned, dim_date.date_key),
+    FactReference(fact_payment.customer_key, dim_customer.customer_key),
+    FactReference(fact_payment.store_key, dim_store.store_key),
+    FactReference(fact_payment.date_key_paid, dim_date.date_key),
+]
+
+
+def configure_integrity(placeholders=None):
+    global INTEGRITY_PLACEHOLDERS
+    if placeholders is not None:
+        INTEGRITY_PLACEHOLDERS = placeholders
+
+
+def orphan_keys(sqlite_session, reference, scope=None):
+    '''
+    {orphan key: fact rows} for one reference, from a single NOT EXISTS anti-join. Each fact row costs one probe of
+    the dimension's primary key; scope narrows the fact rows to the ones a cycle wrote.
+    '''
+    fact_column, dimension_key = reference
+    query = select(fact_column, func.count()).where(
+        fact_column.is_not(None), ~exists().where(dimension_key == fact_column)
+    )
+    if scope is not None:
+        query = query.where(scope)
+    return dict(sqlite_session.execute(query.group_by(fact_column)).all())
+
+
+def cycle_scopes(table_name, last_sync=None, changed_ids=None, key_offset=0):
+    '''
+    filters for the fact rows one load wrote. A watermark load wrote rows dated on or after the watermark's day, read
+    through the date key indexes; a change log load wrote the ids it was given; anything else checks the source's
+    whole key range. Returns a list, since long id lists are checked in batches.
+    '''
+    model = fact_rental if table_name == "fact_rental" else fact_payment
+    if changed_ids is not None:
+        natural_id = fact_rental.rental_id if model is fact_rental else fact_payment.payment_id
+        return [natural_id.in_(batch) & source_key_range(model, key_offset) for batch in batches(changed_ids)]
+    if last_sync is not None:
+        date_column = fact_rental.date_key_rented if model is fact_rental else fact_payment.date_key_paid
+        return [(date_column >= to_date_key(last_sync)) & source_key_range(model, key_offset)]
+    return [source_key_range(model, key_offset)]
+
+
+def placeholder_member(table_name, key):
+    '''
+    a stand-in dimension row for an orphan key. dim_date rows are generated, so a valid date key gets its real row.
+    Versioned dimensions get the natural id the key was derived from, and the real row takes the key over when it
+    is loaded. Returns None for keys no row can be made for.
+    '''
+    if table_name == "dim_date":
+        try:
+            return build_dim_date(datetime.strptime(str(key), "%Y%m%d").date())
+        except ValueError:
+            return None
+    dimension = SCD_DIMENSIONS[table_name]
+    today = date.today().strftime("%Y-%m-%d")
+    values = {
+        column.name: PLACEHOLDER_LABEL if column.type.python_type is str else 0
+        for column in dimension.model.__table__.columns
+    }
+    values.update({
+        dimension.surrogate_key: key,
+        dimension.natural_id: natural_id_from_key(table_name, key),
+        "last_update": today,
+        "effective_date": today,
+        "expiry_date": OPEN_EXPIRY_DATE,
+        "is_current": 1,
+        "row_hash": PLACEHOLDER_ROW_HASH,
+    })
+    return dimension.model(**values)
+
+
+def insert_placeholders(sqlite_session, orphans_by_dimension):
+    '''one bulk insert per dimension of the placeholder members for every orphan key'''
+    inserted = 0
+    for table_name, keys in orphans_by_dimension.items():
+        members = [member for member in (placeholder_member(table_name, key) for key in sorted(keys)) if member is not None]
+        if not members:
+            continue
+        columns = [column.name for column in members[0].__table__.columns]
+        sqlite_session.execute(insert(members[0].__table__),
+                               [{column: getattr(member, column) for column in columns} for member in members])
+        inserted += len(members)
+        print(f"integrity: {len(members)} placeholder rows inserted into {table_name}")
+    if inserted:
+        mark_tables_written(sqlite_session, orphans_by_dimension)
+    sqlite_session.commit()
+    return inserted
+
+
+def check_fact_integrity(sqlite_session, scopes=None, placeholders=None):
+    '''
+    anti-joins every fact reference against its dimension and prints the orphan rows and keys per reference.
+    scopes maps a fact table to the filters of the rows to check (see cycle_scopes); a fact table missing from
+    scopes is skipped, and scopes=None checks every row. Returns {reference name: {orphan key: fact rows}}.
+    '''
+    placeholders = INTEGRITY_PLACEHOLDERS if placeholders is None else placeholders
+    report = {}
+    for reference in FACT_REFERENCES:
+        table_name = reference.fact_column.table.name
+        if scopes is not None and table_name not in scopes:
+            continue
+        orphans = {}
+        for scope in (scopes[table_name] if scopes is not None else [None]):
+            for key, rows in orphan_keys(sqlite_session, reference, scope).items():
+                orphans[key] = orphans.get(key, 0) + rows
+        report[reference.name] = orphans
+        if orphans:
+            print(f"integrity: {reference.name} has {sum(orphans.values())} orphan rows over {len(orphans)} keys "
+                  f"missing from {reference.dimension_key.table.name}")
+    if not any(report.values()):
+        print(f"integrity: no orphan keys in {len(report)} fact references")
+    elif placeholders:
+        orphans_by_dimension = {}
+        for reference in FACT_REFERENCES:
+            orphans_by_dimension.setdefault(reference.dimension_key.table.name, set()).update(report.get(reference.name, {}))
+        insert_placeholders(sqlite_session, {table_name: keys for table_name, keys in orphans_by_dimension.items() if keys})
+    return report
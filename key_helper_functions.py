@@ -0,0 +1,124 @@
+from sqlite_helper_classes import *
+from source_helper_functions import SOURCE_KEY_STRIDE, source_key_range
+from partition_helper_functions import first_taken_fact_key, partition_db_name, partition_fact_keys
+from typing import NamedTuple
+
+
+class KeyScheme(NamedTuple):
+    base: int
+    id_step: int
+    # distance between two versions of one row, only the type 2 dimensions have more than one
+    version_step: int = 0
+
+
+# surrogate key = key_offset + base + natural id * id_step (+ (version - 1) * version_step). Every key is a pure
+# function of the natural id, so it does not depend on load order, shards can assign their own keys and a reload
+# reproduces the same keys. These are the formulas the warehouse has always used for its dimensions.
+KEY_SCHEMES = {
+    "dim_film": KeyScheme(1, 100, 1),
+    "dim_actor": KeyScheme(50000, 1),
+    "dim_category": KeyScheme(30001, 10),
+    "dim_store": KeyScheme(1000, 1, 1000),
+    "dim_customer": KeyScheme(1, 100, 1),
+    "fact_rental": KeyScheme(50000, 1),
+    "fact_payment": KeyScheme(80000, 1),
+}
+
+# natural id column and surrogate key column of each fact table
+FACT_KEYS = {
+    "fact_rental": (fact_rental.rental_id, fact_rental.fact_rental_key),
+    "fact_payment": (fact_payment.payment_id, fact_payment.fact_payment_key),
+}
+
+KEY_LOOKUP_BATCH_SIZE = 5000
+
+
+def surrogate_key(table_name, natural_id, key_offset=0, version=1):
+    scheme = KEY_SCHEMES[table_name]
+    return key_offset + scheme.base + natural_id * scheme.id_step + (version - 1) * scheme.version_step
+
+
+def natural_id_from_key(table_name, key):
+    '''inverse of surrogate_key for the natural id: drops the source block, the base and the version'''
+    scheme = KEY_SCHEMES[table_name]
+    position = key % SOURCE_KEY_STRIDE - scheme.base
+    if scheme.version_step > scheme.id_step:
+        position %= scheme.version_step
+    return position // scheme.id_step
+
+
+class KeyAllocator:
+    '''
+    hands out fact surrogate keys for one source. Rows the warehouse already holds keep their key, found through
+    the (natural id, store_key) index in batches, in the main file first and then in the partitions; every other row
+    gets the key derived from its natural id. No MAX() is read, so loaders running at the same time never have to
+    agree on the next free key. The rows found in a partition are kept in `partitioned`, the load writes them to main.
+    '''
+    def __init__(self, sqlite_session, table_name, key_offset=0, batch_size=KEY_LOOKUP_BATCH_SIZE):
+        self.sqlite_session = sqlite_session
+        self.table_name = table_name
+        self.key_offset = key_offset
+        self.batch_size = batch_size
+        self.natural_id, self.key_column = FACT_KEYS[table_name]
+        self.keys = {}
+        self.partitioned = {}
+
+    def preload(self, natural_ids):
+        '''reverse lookup from natural id to the key already stored, for every id about to be loaded'''
+        natural_ids = sorted(set(natural_ids) - set(self.keys))
+        scope = source_key_range(self.key_column.class_, self.key_offset)
+        for start in range(0, len(natural_ids), self.batch_size):
+            self.keys.update(self.sqlite_session.query(self.natural_id, self.key_column).filter(
+                self.natural_id.in_(natural_ids[start:start + self.batch_size]), scope,
+            ).all())
+        missing = [natural_id for natural_id in natural_ids if natural_id not in self.keys]
+        if missing:
+            self.partitioned.update(partition_fact_keys(
+                partition_db_name(self.sqlite_session.get_bind()), self.natural_id, missing, scope
+            ))
+            self.keys.update(self.partitioned)
+        self.check_new_keys(natural_ids)
+
+    def check_new_keys(self, natural_ids):
+        '''
+        a warehouse loaded before keys were derived from natural ids numbered facts by load position, and such a key
+        can equal the derived key of a row that is new. Migrate renumbers those, until then the load stops here
+        instead of overwriting another fact.
+        '''
+        new_keys = [surrogate_key(self.table_name, natural_id, self.key_offset) for natural_id in natural_ids if natural_id not in self.keys]
+        for start in range(0, len(new_keys), self.batch_size):
+            taken = first_taken_fact_key(self.sqlite_session, self.key_column, new_keys[start:start + self.batch_size])
+            if taken is not None:
+                raise Exception(f"{self.table_name} key {taken} is held by another row, run --mode Migrate to renumber "
+                                f"fact keys loaded before they were derived from natural ids")
+
+    def key(self, natural_id):
+        key = self.keys.get(natural_id)
+        if key is None:
+            key = self.keys[natural_id] = surrogate_key(self.table_name, natural_id, self.key_offset)
+        return key
+
+
+def positional_fact_keys(connection, table_name):
+    '''number of rows of a fact table whose key is not the one derived from their natural id'''
+    natural_id, key_column = FACT_KEYS[table_name]
+    scheme = KEY_SCHEMES[table_name]
+    return connection.exec_driver_sql(
+        f"SELECT COUNT(*) FROM {table_name} WHERE {key_column.name} != "
+        f"({key_column.name} / {SOURCE_KEY_STRIDE}) * {SOURCE_KEY_STRIDE} + {scheme.base} + {natural_id.name} * {scheme.id_step}"
+    ).scalar()
+
+
+def renumber_fact_keys(connection, table_name):
+    '''
+    rewrites every key of a fact table to the one derived from its natural id, keeping each row's source block.
+    Keys are negated first, so no row can collide with a key another row has not given up yet.
+    '''
+    natural_id, key_column = FACT_KEYS[table_name]
+    scheme = KEY_SCHEMES[table_name]
+    key = key_column.name
+    connection.exec_driver_sql(f"UPDATE {table_name} SET {key} = -{key}")
+    return connection.exec_driver_sql(
+        f"UPDATE {table_name} SET {key} = "
+        f"(-{key} / {SOURCE_KEY_STRIDE}) * {SOURCE_KEY_STRIDE} + {scheme.base} + {natural_id.name} * {scheme.id_step}"
+    ).rowcount
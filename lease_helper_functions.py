@@ -0,0 +1,219 @@
+from sqlite_helper_classes import *
+from source_helper_functions import sync_state_name
+from shadow_helper_functions import reopen_after_swap
+from sqlalchemy import create_engine, delete, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import OperationalError
+from datetime import datetime, timedelta, timezone
+import os
+import socket
+import threading
+import uuid
+
+
+# a lease not renewed for this long belongs to a crashed worker and can be taken over
+LEASE_SECONDS = 60
+# renewals per lease period, so a worker survives a couple of missed heartbeats
+HEARTBEATS_PER_LEASE = 3
+# steps of a cycle that get a lease besides its tables. dim_date is shared by every source, the rest are per source
+LEASED_STEPS = ["bridge_film_actor", "bridge_film_category", "reconcile_deletes"]
+SHARED_LEASES = ["dim_date"]
+
+
+def lease_timestamp(moment):
+    # fixed width UTC text, so expiry comparisons in SQL are plain string comparisons
+    return moment.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def sync_lease_name(name, source=None):
+    return name if name in SHARED_LEASES else sync_state_name(name, source)
+
+
+def worker_owner():
+    '''host, process and a random suffix, so two workers never share an owner even after a pid is reused'''
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class NoLeases:
+    '''the default: the worker assumes it is the only one syncing and holds every table'''
+    owner = None
+
+    def holds(self, lease_name):
+        return True
+
+    def join(self, session):
+        pass
+
+    def renew(self):
+        pass
+
+    def check(self, lease_name):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class LeaseHolder(NoLeases):
+    '''
+    leases in sync_lease with an owner, a heartbeat and an expiry. A lease is taken with one upsert that only
+    overwrites a row when it has expired or is already ours, so two workers can never both get one, and a crashed
+    worker's leases are reclaimed by the next worker once they expire. A background thread renews held leases every
+    lease_seconds / HEARTBEATS_PER_LEASE. Leases go through their own engine, whose busy timeout is one heartbeat
+    interval: a heartbeat that cannot get the write lock in time gives up and tries again on the next beat. A group
+    commit cycle holds the write lock for as long as it runs, so it joins its session: the heartbeat then leaves the
+    leases alone and the cycle renews them inside its own transaction after every step. No other worker can take
+    them over meanwhile, since that takes the write lock too.
+    '''
+    def __init__(self, sqlite_engine, lease_seconds=LEASE_SECONDS, owner=None):
+        self.lease_seconds = lease_seconds
+        self.owner = owner or worker_owner()
+        self.interval = lease_seconds / HEARTBEATS_PER_LEASE
+        self.engine = reopen_after_swap(create_engine(sqlite_engine.engine.url, echo=False, connect_args={"timeout": self.interval}))
+        sync_lease.__table__.create(self.engine, checkfirst=True)
+        self.held = set()
+        self.lost = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat_thread = None
+        self.session = None
+
+    def acquire(self, lease_names, all_or_nothing=False):
+        '''
+        takes every free or expired lease of lease_names, or none of them when all_or_nothing and one is taken. The
+        expired ones are deleted first, which also takes the write lock, so the owners reported as reclaimed are
+        exactly the ones this worker replaced.
+        '''
+        now = datetime.now(timezone.utc)
+        expires = lease_timestamp(now + timedelta(seconds=self.lease_seconds))
+        now = lease_timestamp(now)
+        acquired = []
+        try:
+            with self.engine.connect() as connection:
+                reclaimed = dict(connection.execute(delete(sync_lease).where(
+                    sync_lease.lease_name.in_(lease_names), sync_lease.expires_at < now
+                ).returning(sync_lease.lease_name, sync_lease.owner)).all())
+                for lease_name in lease_names:
+                    statement = sqlite_insert(sync_lease).values(
+                        lease_name=lease_name, owner=self.owner, acquired_at=now, heartbeat_at=now, expires_at=expires
+                    )
+                    statement = statement.on_conflict_do_update(
+                        index_elements=[sync_lease.lease_name],
+                        set_={"heartbeat_at": now, "expires_at": expires},
+                        where=sync_lease.owner == self.owner,
+                    )
+                    if connection.execute(statement).rowcount == 1:
+                        acquired.append(lease_name)
+                    elif all_or_nothing:
+                        acquired = []
+                        break
+                if acquired:
+                    connection.commit()
+        except OperationalError as e:
+            print(f"leases not acquired, the warehouse stayed locked: {e}")
+            return []
+        for lease_name in acquired:
+            if lease_name in reclaimed and reclaimed[lease_name] != self.owner:
+                print(f"lease {lease_name} reclaimed from {reclaimed[lease_name]}, its heartbeat expired")
+        with self.lock:
+            self.held.update(acquired)
+        return acquired
+
+    def join(self, session):
+        '''renews and checks the leases through session from now on, or through the lease engine again for None'''
+        self.session = session
+
+    def renew(self):
+        '''moves the expiry of every held lease forward, and marks the ones another worker has taken over as lost'''
+        with self.lock:
+            held = sorted(self.held)
+        if not held:
+            return
+        now = datetime.now(timezone.utc)
+        statements = [
+            update(sync_lease).where(sync_lease.lease_name.in_(held), sync_lease.owner == self.owner).values(
+                heartbeat_at=lease_timestamp(now), expires_at=lease_timestamp(now + timedelta(seconds=self.lease_seconds))
+            ),
+            select(sync_lease.lease_name).where(sync_lease.lease_name.in_(held), sync_lease.owner == self.owner),
+        ]
+        if self.session is not None:
+            self.session.execute(statements[0])
+            still_held = set(self.session.execute(statements[1]).scalars())
+        else:
+            with self.engine.begin() as connection:
+                connection.execute(statements[0])
+                still_held = set(connection.execute(statements[1]).scalars())
+        with self.lock:
+            self.lost.update(set(held) - still_held)
+            self.held &= still_held
+
+    def heartbeat(self):
+        while not self.stopped.wait(self.interval):
+            # a joined cycle renews in its own transaction, and this connection would only wait for its lock
+            if self.session is not None:
+                continue
+            try:
+                self.renew()
+            except OperationalError as e:
+                print(f"lease heartbeat skipped: {e}")
+
+    def holds(self, lease_name):
+        with self.lock:
+            return lease_name in self.held
+
+    def check(self, lease_name):
+        '''
+        raises when a held lease was taken over or its stored expiry has passed, so a stalled worker never advances
+        a watermark it may no longer own
+        '''
+        with self.lock:
+            if lease_name in self.lost:
+                raise Exception(f"lease {lease_name} expired and was taken over by another worker")
+        statement = select(sync_lease.expires_at).where(sync_lease.lease_name == lease_name, sync_lease.owner == self.owner)
+        if self.session is not None:
+            expires_at = self.session.execute(statement).scalar()
+        else:
+            with self.engine.connect() as connection:
+                expires_at = connection.execute(statement).scalar()
+        if expires_at is None or expires_at < lease_timestamp(datetime.now(timezone.utc)):
+            raise Exception(f"lease {lease_name} expired at {expires_at} before this worker renewed it")
+
+    def release(self):
+        with self.lock:
+            held = sorted(self.held)
+            self.held.clear()
+        if held:
+            with self.engine.begin() as connection:
+                connection.execute(delete(sync_lease).where(sync_lease.lease_name.in_(held), sync_lease.owner == self.owner))
+
+    def __enter__(self):
+        self.heartbeat_thread = threading.Thread(target=self.heartbeat, daemon=True)
+        self.heartbeat_thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.heartbeat_thread.join()
+        try:
+            self.release()
+        finally:
+            self.engine.dispose()
+
+
+def hold_sync_leases(sqlite_session, lease_names, lease_seconds=None, all_or_nothing=False):
+    '''
+    NoLeases when lease_seconds is None, otherwise a LeaseHolder that has already tried to take lease_names.
+    Use it as a context manager: the heartbeat runs inside it and the leases are released when it exits.
+    '''
+    if lease_seconds is None:
+        return NoLeases()
+    if lease_seconds <= 0:
+        raise ValueError(f"lease seconds must be positive: {lease_seconds}")
+    leases = LeaseHolder(sqlite_session.get_bind(), lease_seconds)
+    acquired = leases.acquire(lease_names, all_or_nothing)
+    skipped = [lease_name for lease_name in lease_names if lease_name not in acquired]
+    print(f"{leases.owner} leased {len(acquired)} of {len(lease_names)} tables" + (f", held elsewhere: {skipped}" if skipped else ""))
+    return leases
@@ -0,0 +1,176 @@
+from sqlite_helper_classes import *
+from index_helper_functions import create_index, drop_index
+from scd_helper_functions import SCD_DIMENSIONS, HASHED_DIMENSIONS, OPEN_EXPIRY_DATE, row_hash
+from key_helper_functions import FACT_KEYS, positional_fact_keys, renumber_fact_keys
+from partition_helper_functions import list_partitions, partition_db_name, is_frozen, freeze_partition
+from sqlalchemy import create_engine, text
+from sqlalchemy.schema import CreateTable
+from pathlib import Path
+import os
+import stat
+
+
+# columns that moved from String to Integer, per table
+INTEGER_DATE_COLUMNS = {
+    dim_date: ["date_key", "year", "quarter", "month", "day_of_month", "day_of_week"],
+    fact_rental: ["date_key_rented", "date_key_returned"],
+    fact_payment: ["date_key_paid"],
+}
+
+
+def declared_column_types(connection, table_name):
+    rows = connection.execute(text(f"PRAGMA table_info({table_name})")).all()
+    return {row[1]: row[2].upper() for row in rows}
+
+
+def table_exists(connection, table_name):
+    return connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": table_name}
+    ).first() is not None
+
+
+def needs_integer_migration(connection, model, columns):
+    if table_exists(connection, f"{model.__tablename__}_old"):
+        return True
+    column_types = declared_column_types(connection, model.__tablename__)
+    return any(column_types.get(column) != "INTEGER" for column in columns)
+
+
+def migrate_table_to_integer_keys(engine, model, columns, batch_size=5000):
+    '''
+    SQLite cannot change a column type in place, so the table is renamed to <table>_old, recreated from the model
+    and copied across in rowid batches, each in its own transaction. INSERT OR IGNORE makes an interrupted
+    migration safe to rerun: rows that were already copied collide on the primary key and are skipped.
+    '''
+    table_name = model.__tablename__
+    old_table_name = f"{table_name}_old"
+
+    with engine.begin() as connection:
+        if not table_exists(connection, old_table_name):
+            for index in model.__table__.indexes:
+                drop_index(connection, index)
+            connection.execute(text(f"ALTER TABLE {table_name} RENAME TO {old_table_name}"))
+            connection.execute(CreateTable(model.__table__))
+
+    select_columns = ", ".join(
+        f"CAST({column.name} AS INTEGER)" if column.name in columns else column.name
+        for column in model.__table__.columns
+    )
+    insert_columns = ", ".join(column.name for column in model.__table__.columns)
+
+    last_rowid = 0
+    copied = 0
+    while True:
+        with engine.begin() as connection:
+            batch_end = connection.execute(text(
+                f"SELECT MAX(rowid) FROM (SELECT rowid FROM {old_table_name} WHERE rowid > :last_rowid "
+                f"ORDER BY rowid LIMIT :batch_size)"
+            ), {"last_rowid": last_rowid, "batch_size": batch_size}).scalar()
+            if batch_end is None:
+                break
+            result = connection.execute(text(
+                f"INSERT OR IGNORE INTO {table_name} ({insert_columns}) SELECT {select_columns} "
+                f"FROM {old_table_name} WHERE rowid > :last_rowid AND rowid <= :batch_end ORDER BY rowid"
+            ), {"last_rowid": last_rowid, "batch_end": batch_end})
+            copied += result.rowcount
+            last_rowid = batch_end
+
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP TABLE {old_table_name}"))
+        for index in model.__table__.indexes:
+            create_index(connection, index)
+    print(f"{table_name} migrated to integer date keys: {copied} rows copied")
+    return copied
+
+
+def migrate_integer_date_keys(engine, batch_size=5000):
+    migrated_tables = []
+    for model, columns in INTEGER_DATE_COLUMNS.items():
+        with engine.connect() as connection:
+            if not needs_integer_migration(connection, model, columns):
+                print(f"{model.__tablename__} already uses integer date keys")
+                continue
+        migrate_table_to_integer_keys(engine, model, columns, batch_size)
+        migrated_tables.append(model.__tablename__)
+
+    if migrated_tables:
+        # VACUUM cannot run inside a transaction, and it is what actually returns the freed pages to the filesystem
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            connection.execute(text("ANALYZE"))
+            connection.execute(text("VACUUM"))
+    return migrated_tables
+
+
+# history columns added to the versioned dimensions, with the defaults existing rows start from
+SCD_COLUMNS = {
+    "effective_date": "VARCHAR(10) NOT NULL DEFAULT ''",
+    "expiry_date": f"VARCHAR(10) NOT NULL DEFAULT '{OPEN_EXPIRY_DATE}'",
+    "is_current": "INTEGER NOT NULL DEFAULT 1",
+    "row_hash": "VARCHAR(16) NOT NULL DEFAULT ''",
+}
+
+
+def migrate_scd_columns(engine):
+    '''
+    adds the row_hash column to every dimension loaded from sakila, and the type 2 columns to the film, store and
+    customer dimensions, of a warehouse created before they existed. Every existing row becomes the current
+    version 1, effective from its last_update, with its hash computed from what is stored. ADD COLUMN only touches
+    the schema, so no table has to be copied.
+    '''
+    migrated_tables = []
+    for table_name, dimension in HASHED_DIMENSIONS.items():
+        columns = SCD_COLUMNS if table_name in SCD_DIMENSIONS else {"row_hash": SCD_COLUMNS["row_hash"]}
+        with engine.begin() as connection:
+            if not table_exists(connection, table_name):
+                continue
+            column_types = declared_column_types(connection, table_name)
+            missing_columns = [column for column in columns if column not in column_types]
+            if not missing_columns:
+                print(f"{table_name} already has its row hash")
+                continue
+            for column in missing_columns:
+                connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column} {columns[column]}"))
+            if "effective_date" in columns:
+                connection.execute(text(f"UPDATE {table_name} SET effective_date = last_update WHERE effective_date = ''"))
+            rows = connection.execute(text(f"SELECT * FROM {table_name} WHERE row_hash = ''")).mappings().all()
+            if rows:
+                connection.execute(text(f"UPDATE {table_name} SET row_hash = :row_hash WHERE {dimension.surrogate_key} = :key"), [
+                    {"row_hash": row_hash(row, dimension.tracked_columns), "key": row[dimension.surrogate_key]} for row in rows
+                ])
+        print(f"{table_name} migrated: {', '.join(missing_columns)} added, {len(rows)} rows hashed")
+        migrated_tables.append(table_name)
+    return migrated_tables
+
+
+def renumber_file_fact_keys(engine, file_name):
+    renumbered = 0
+    with engine.begin() as connection:
+        for table_name in FACT_KEYS:
+            if table_exists(connection, table_name) and positional_fact_keys(connection, table_name):
+                rows = renumber_fact_keys(connection, table_name)
+                print(f"{file_name} {table_name}: {rows} keys renumbered")
+                renumbered += rows
+    return renumbered
+
+
+def migrate_fact_keys(engine):
+    '''
+    fact keys used to be numbered by load position. They are now derived from the natural id, so every fact row of
+    the main file and of each partition gets the key its rental_id/payment_id maps to. Frozen partitions are made
+    writable for the rewrite and frozen again afterwards. Files whose keys already match are left untouched.
+    '''
+    renumbered = renumber_file_fact_keys(engine, Path(engine.url.database).name)
+    for partition, path in list_partitions(partition_db_name(engine)):
+        frozen = is_frozen(path)
+        if frozen:
+            os.chmod(path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+        partition_engine = create_engine(f"sqlite:///{path}", echo=False)
+        try:
+            renumbered += renumber_file_fact_keys(partition_engine, path.name)
+        finally:
+            partition_engine.dispose()
+            if frozen:
+                freeze_partition(path)
+    if not renumbered:
+        print("fact keys already derived from natural ids")
+    return renumbered
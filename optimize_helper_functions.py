@@ -0,0 +1,107 @@
+from sqlite_helper_classes import *
+from index_helper_functions import create_index, drop_index
+from migration_helper_functions import table_exists
+from shadow_helper_functions import replace_warehouse_file
+from sqlalchemy import text
+from sqlalchemy.schema import CreateTable
+from pathlib import Path
+import os
+
+
+PAGE_SIZES = [1024, 2048, 4096, 8192, 16384, 32768, 65536]
+# larger pages mean fewer, fuller B-tree pages for long scans, but every table and index needs at least one, so
+# which size packs tightest depends on the data. Without an explicit size each candidate is tried and measured.
+CANDIDATE_PAGE_SIZES = [4096, 8192, 16384]
+
+
+def storage_stats(engine):
+    with engine.connect() as connection:
+        stats = {
+            "page_size": connection.execute(text("PRAGMA page_size")).scalar(),
+            "page_count": connection.execute(text("PRAGMA page_count")).scalar(),
+            "freelist_count": connection.execute(text("PRAGMA freelist_count")).scalar(),
+        }
+    stats["file_bytes"] = Path(engine.url.database).stat().st_size
+    return stats
+
+
+def print_storage_report(before, after):
+    print(f"{'':<16}{'before':>14}{'after':>14}")
+    for name in ("file_bytes", "page_size", "page_count", "freelist_count"):
+        print(f"{name:<16}{before[name]:>14}{after[name]:>14}")
+    change = after["file_bytes"] / before["file_bytes"] - 1
+    print(f"file size {before['file_bytes']} -> {after['file_bytes']} bytes ({change:+.1%})")
+
+
+def without_rowid_tables():
+    return [table for table in Base.metadata.sorted_tables if table.dialect_options["sqlite"]["with_rowid"] is False]
+
+
+def has_rowid(connection, table_name):
+    sql = connection.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": table_name}
+    ).scalar()
+    return "WITHOUT ROWID" not in sql.upper()
+
+
+def rebuild_without_rowid(engine, table):
+    '''
+    copies a table declared WITHOUT ROWID out of its old rowid layout, the same rename and copy the integer key
+    migration uses. A copy interrupted after the rename resumes from <table>_old on the next run.
+    '''
+    old_table_name = f"{table.name}_old"
+    columns = ", ".join(column.name for column in table.columns)
+    with engine.begin() as connection:
+        if not table_exists(connection, old_table_name):
+            for index in table.indexes:
+                drop_index(connection, index)
+            connection.execute(text(f"ALTER TABLE {table.name} RENAME TO {old_table_name}"))
+            connection.execute(CreateTable(table))
+        copied = connection.execute(text(
+            f"INSERT OR IGNORE INTO {table.name} ({columns}) SELECT {columns} FROM {old_table_name}"
+        )).rowcount
+        connection.execute(text(f"DROP TABLE {old_table_name}"))
+        for index in table.indexes:
+            create_index(connection, index)
+    print(f"{table.name} rebuilt WITHOUT ROWID: {copied} rows copied")
+    return copied
+
+
+def vacuum_into(engine, page_size):
+    '''writes a defragmented copy of the warehouse with the given page size next to it and returns its path'''
+    db_path = Path(engine.url.database).resolve()
+    compact_path = db_path.with_name(f"{db_path.stem}_optimized_{page_size}.db")
+    if compact_path.exists():
+        os.remove(compact_path)
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text(f"PRAGMA page_size = {int(page_size)}"))
+        connection.execute(text("VACUUM INTO :path"), {"path": str(compact_path)})
+    return compact_path
+
+
+def vacuum_into_swap(engine, page_sizes):
+    '''
+    VACUUM INTO one copy per page size, keep the smallest and move it over the warehouse the same way a Full-load
+    swaps its shadow in. No other process should have the warehouse open while this runs.
+    '''
+    copies = [vacuum_into(engine, page_size) for page_size in page_sizes]
+    smallest = min(copies, key=lambda path: path.stat().st_size)
+    replace_warehouse_file(engine, smallest, Path(engine.url.database).resolve())
+    for path in copies:
+        if path != smallest:
+            os.remove(path)
+
+
+def optimize_warehouse(engine, page_size=None):
+    if page_size is not None and page_size not in PAGE_SIZES:
+        raise ValueError(f"page size must be one of {PAGE_SIZES}")
+    before = storage_stats(engine)
+    for table in without_rowid_tables():
+        with engine.connect() as connection:
+            needs_rebuild = table_exists(connection, f"{table.name}_old") or has_rowid(connection, table.name)
+        if needs_rebuild:
+            rebuild_without_rowid(engine, table)
+    vacuum_into_swap(engine, [page_size] if page_size else CANDIDATE_PAGE_SIZES)
+    after = storage_stats(engine)
+    print_storage_report(before, after)
+    return before, after
@@ -0,0 +1,402 @@
+from sqlite_helper_classes import *
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.orm import Session, sessionmaker
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from pathlib import Path
+import sqlite3
+import stat
+import os
+
+
+# the date key each fact table is partitioned on
+PARTITION_COLUMNS = {
+    "fact_rental": "date_key_rented",
+    "fact_payment": "date_key_paid",
+}
+PARTITIONED_TABLES = [fact_rental.__table__, fact_payment.__table__]
+# fact rows that may move to a partition. Open rentals stay in main whatever their date, so the rental refresh can
+# still write their return date
+MOVABLE_ROWS = {
+    "fact_rental": "date_key_returned IS NOT NULL",
+    "fact_payment": "1",
+}
+# SQLITE_MAX_ATTACHED in the default sqlite build, the oldest partitions past it are merged into the archive
+MAX_ATTACHED_PARTITIONS = 10
+# partition number of the archive file holding every merged partition
+ARCHIVE_PARTITION = 0
+# fact keys per IN query when rows are looked up or deleted in partition files
+PARTITION_KEY_BATCH_SIZE = 500
+
+
+def partition_path(db_name, partition):
+    return Path(f"{db_name}_part_{partition}.db")
+
+
+def partition_for_date_key(date_key, granularity="year"):
+    if granularity == "year":
+        return date_key // 10000
+    elif granularity == "month":
+        return date_key // 100
+    raise ValueError(f"unsupported partition granularity: {granularity}")
+
+
+def partition_bounds(partition):
+    # 2005 covers 20050101-20051231, 200505 covers 20050501-20050531, the archive spans every period merged into it
+    if partition == ARCHIVE_PARTITION:
+        return 0, 99991231
+    if partition >= 100000:
+        return partition * 100 + 1, partition * 100 + 31
+    return partition * 10000 + 101, partition * 10000 + 1231
+
+
+def partition_files(db_name):
+    partitions = []
+    if db_name is None:
+        return partitions
+    for path in Path(f"{db_name}.db").resolve().parent.glob(f"{Path(db_name).name}_part_*.db"):
+        suffix = path.stem.rsplit("_", 1)[-1]
+        if suffix.isdigit():
+            partitions.append((int(suffix), path))
+    return sorted(partitions)
+
+
+def archived_partitions(db_name):
+    '''partitions already merged into the archive. Their own files are only left behind by a merge that stopped early'''
+    path = partition_path(db_name, ARCHIVE_PARTITION)
+    if not path.exists():
+        return set()
+    with closing(sqlite3.connect(f"file:{path}?mode=ro", uri=True)) as connection:
+        return {partition for partition, in connection.execute("SELECT partition FROM archived_partition")}
+
+
+def list_partitions(db_name):
+    partitions = partition_files(db_name)
+    archived = archived_partitions(db_name) if partitions and partitions[0][0] == ARCHIVE_PARTITION else set()
+    return [(partition, path) for partition, path in partitions if partition not in archived]
+
+
+def is_frozen(path):
+    # the mode bits rather than os.access, which is always true for root
+    return not os.stat(path).st_mode & stat.S_IWUSR
+
+
+def partition_db_name(engine):
+    # a session joined to a group commit is bound to a Connection, which reaches its url through .engine.
+    # In-memory databases have no file name and so no partitions
+    database = engine.engine.url.database
+    return str(Path(database).with_suffix("")) if database else None
+
+
+def attach_partitions(dbapi_connection, db_name, date_key_from=None, date_key_to=None):
+    '''
+    attaches every partition overlapping [date_key_from, date_key_to] and shadows the fact tables with TEMP union views.
+    Temp objects resolve before main, so unqualified fact_rental/fact_payment see main (the hot rows still being
+    written) plus the attached partitions. Partitions outside the range are never opened. Partitioning keeps no more
+    files than SQLite can attach by merging the oldest into the archive, which is attached whatever the range.
+    '''
+    partitions = []
+    for partition, path in list_partitions(db_name):
+        lower, upper = partition_bounds(partition)
+        if (date_key_from is not None and upper < date_key_from) or (date_key_to is not None and lower > date_key_to):
+            continue
+        partitions.append((partition, path))
+    if len(partitions) > MAX_ATTACHED_PARTITIONS:
+        raise Exception(f"{len(partitions)} partitions overlap the date range, more than sqlite can attach "
+                        f"({MAX_ATTACHED_PARTITIONS}): run Partition to merge the oldest into the archive")
+
+    cursor = dbapi_connection.cursor()
+    schemas = []
+    for partition, path in partitions:
+        mode = "ro" if is_frozen(path) else "rw"
+        schema = f"part_{partition}"
+        cursor.execute(f"ATTACH DATABASE 'file:{path}?mode={mode}' AS {schema}")
+        schemas.append(schema)
+
+    for table in PARTITIONED_TABLES:
+        selects = [f"SELECT * FROM main.{table.name}"] + [f"SELECT * FROM {schema}.{table.name}" for schema in schemas]
+        cursor.execute(f"CREATE TEMP VIEW {table.name} AS {' UNION ALL '.join(selects)}")
+    cursor.close()
+
+
+def attach_partitions_on_connect(engine, db_name, date_key_from=None, date_key_to=None):
+    '''
+    attaches the partitions to every connection engine opens, as they are when it connects. A pooled connection that
+    attached an older set (opened before a Partition run or an archive merge) is reopened on its next checkout.
+    '''
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        connection_record.info["partitions"] = list_partitions(db_name)
+        if connection_record.info["partitions"]:
+            attach_partitions(dbapi_connection, db_name, date_key_from, date_key_to)
+
+    @event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info.get("partitions") != list_partitions(db_name):
+            raise DisconnectionError("the warehouse partitions changed since this connection attached them")
+
+    return engine
+
+
+def create_partitioned_engine(db_name, date_key_from=None, date_key_to=None):
+    '''read engine over the main file plus its partitions. Writes must go through the plain engine.'''
+    engine = create_engine(f"sqlite:///{db_name}.db", echo=False)
+    return attach_partitions_on_connect(engine, db_name, date_key_from, date_key_to)
+
+
+def create_partitioned_session(db_name, date_key_from=None, date_key_to=None):
+    Session = sessionmaker(bind=create_partitioned_engine(db_name, date_key_from, date_key_to))
+    return Session()
+
+
+def first_taken_fact_key(sqlite_session, key_column, keys):
+    '''one of `keys` that is already used in the main file or any partition, or None when they are all free'''
+    taken = sqlite_session.query(key_column).filter(key_column.in_(keys)).first()
+    if taken is not None:
+        return taken[0]
+    table_name = key_column.table.name
+    placeholders = ", ".join("?" * len(keys))
+    for partition, path in list_partitions(partition_db_name(sqlite_session.get_bind())):
+        with closing(sqlite3.connect(f"file:{path}?mode=ro", uri=True)) as connection:
+            taken = connection.execute(
+                f"SELECT {key_column.name} FROM {table_name} WHERE {key_column.name} IN ({placeholders}) LIMIT 1", keys
+            ).fetchone()
+        if taken is not None:
+            return taken[0]
+    return None
+
+
+def partition_sessions(db_name):
+    '''(partition, read-only session) for every partition file, opened one at a time and closed after use'''
+    for partition, path in list_partitions(db_name):
+        engine = create_engine(f"sqlite:///file:{path}?mode=ro&uri=true", echo=False)
+        session = Session(bind=engine)
+        try:
+            yield partition, session
+        finally:
+            session.close()
+            engine.dispose()
+
+
+def partition_fact_keys(db_name, natural_id, natural_ids, scope=None, batch_size=PARTITION_KEY_BATCH_SIZE):
+    '''{natural id: surrogate key} of the fact rows with these natural ids that live in a partition'''
+    key_column = getattr(natural_id.class_, list(natural_id.table.primary_key.columns)[0].name)
+    natural_ids = sorted(natural_ids)
+    keys = {}
+    for partition, session in partition_sessions(db_name):
+        for start in range(0, len(natural_ids), batch_size):
+            query = session.query(natural_id, key_column).filter(natural_id.in_(natural_ids[start:start + batch_size]))
+            if scope is not None:
+                query = query.filter(scope)
+            keys.update(query.all())
+    return keys
+
+
+def delete_partition_facts(db_name, key_column, keys, batch_size=PARTITION_KEY_BATCH_SIZE):
+    '''
+    deletes fact rows by key from every partition holding them. A frozen partition is made writable for the delete
+    and frozen again, partitions without any of the keys are only read.
+    '''
+    keys = sorted(keys)
+    table_name = key_column.table.name
+    deleted = 0
+    for partition, path in list_partitions(db_name):
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            placeholders = ", ".join("?" * len(batch))
+            with closing(sqlite3.connect(f"file:{path}?mode=ro", uri=True)) as connection:
+                if connection.execute(f"SELECT 1 FROM {table_name} WHERE {key_column.name} IN ({placeholders}) LIMIT 1", batch).fetchone() is None:
+                    continue
+            frozen = is_frozen(path)
+            if frozen:
+                os.chmod(path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+            try:
+                with closing(sqlite3.connect(path)) as connection:
+                    with connection:
+                        deleted += connection.execute(f"DELETE FROM {table_name} WHERE {key_column.name} IN ({placeholders})", batch).rowcount
+            finally:
+                if frozen:
+                    freeze_partition(path)
+    if deleted:
+        print(f"{table_name}: {deleted} rows removed from partitions")
+    return deleted
+
+
+def delete_partition_facts_after_commit(sqlite_session, key_column, keys):
+    '''
+    a fact row lives in exactly one file, so once a commit has written a partitioned row back to main, or deleted it,
+    its partition copy goes too. Call it after the commit. A group commit session only queues the keys in its info,
+    the cycle deletes them once its own transaction has committed, so a rolled back cycle keeps the partition rows.
+    '''
+    keys = list(keys)
+    if not keys:
+        return
+    pending = sqlite_session.info.get("pending_partition_deletes")
+    if pending is not None:
+        pending.append((key_column, keys))
+        return
+    delete_partition_facts(partition_db_name(sqlite_session.get_bind()), key_column, keys)
+
+
+def flush_partition_deletes(sqlite_session):
+    '''runs the partition deletes a group commit session queued, once its transaction has committed'''
+    pending = sqlite_session.info.get("pending_partition_deletes")
+    while pending:
+        key_column, keys = pending.pop(0)
+        delete_partition_facts(partition_db_name(sqlite_session.get_bind()), key_column, keys)
+
+
+def copy_partition(db_name, partition):
+    path = partition_path(db_name, partition)
+    engine = create_engine(f"sqlite:///{path}", echo=False)
+    Base.metadata.create_all(engine, tables=PARTITIONED_TABLES)
+    lower, upper = partition_bounds(partition)
+
+    copied = 0
+    with engine.begin() as connection:
+        connection.execute(text(f"ATTACH DATABASE 'file:{Path(db_name + '.db').resolve()}?mode=ro' AS source"))
+        for table_name, column in PARTITION_COLUMNS.items():
+            result = connection.execute(text(
+                f"INSERT OR REPLACE INTO main.{table_name} SELECT * FROM source.{table_name} "
+                f"WHERE {column} BETWEEN :lower AND :upper AND {MOVABLE_ROWS[table_name]}"
+            ), {"lower": lower, "upper": upper})
+            copied += result.rowcount
+        connection.execute(text("ANALYZE main"))
+    engine.dispose()
+    return partition, copied
+
+
+def freeze_partition(path):
+    '''cold partitions are made read-only on disk and attached with mode=ro, so nothing can write to them again'''
+    with closing(sqlite3.connect(path)) as connection:
+        connection.execute("PRAGMA journal_mode=DELETE")
+        connection.execute("PRAGMA optimize")
+    os.chmod(path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+
+
+def partition_fact_tables(sqlite_engine, db_name, granularity="year", workers=4):
+    '''
+    moves fact rows out of the main file into one file per year or month. Rows from the newest period stay in main
+    because incremental loads are still appending to it, and so do open rentals. Partitions are written in parallel,
+    one thread per file, and rows are only deleted from main once every partition has committed. Every partition
+    except the newest is frozen afterwards; rows that arrive late for a frozen period stay in main.
+    '''
+    partitions = set()
+    with sqlite_engine.connect() as connection:
+        for table_name, column in PARTITION_COLUMNS.items():
+            date_keys = connection.execute(text(
+                f"SELECT DISTINCT {column} FROM {table_name} WHERE {column} IS NOT NULL"
+            )).scalars()
+            partitions.update(partition_for_date_key(date_key, granularity) for date_key in date_keys)
+    if not partitions:
+        print("no fact rows to partition")
+        return []
+
+    hot_partition = max(partitions)
+    frozen = {partition for partition, path in list_partitions(db_name) if is_frozen(path)} | archived_partitions(db_name)
+    cold_partitions = sorted(partition for partition in partitions if partition != hot_partition and partition not in frozen)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda partition: copy_partition(db_name, partition), cold_partitions))
+    for partition, copied in results:
+        print(f"partition {partition}: {copied} fact rows written to {partition_path(db_name, partition)}")
+
+    with sqlite_engine.begin() as connection:
+        for partition in cold_partitions:
+            lower, upper = partition_bounds(partition)
+            for table_name, column in PARTITION_COLUMNS.items():
+                connection.execute(text(f"DELETE FROM {table_name} WHERE {column} BETWEEN :lower AND :upper "
+                                        f"AND {MOVABLE_ROWS[table_name]}"),
+                                   {"lower": lower, "upper": upper})
+    with sqlite_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("VACUUM"))
+
+    newest_partition = max(partition for partition, path in list_partitions(db_name))
+    for partition, path in list_partitions(db_name):
+        if partition != newest_partition and not is_frozen(path):
+            freeze_partition(path)
+            print(f"partition {partition} frozen read-only")
+    archive_cold_partitions(db_name)
+    return cold_partitions
+
+
+def archive_cold_partitions(db_name, max_partitions=MAX_ATTACHED_PARTITIONS):
+    '''
+    merges the oldest frozen partitions into the archive until no more than max_partitions files are left, so a
+    connection can always attach all of them. Each round records the partitions it merged in the archive in the
+    same transaction as their rows, so readers skip their files from that commit on, and the files go afterwards.
+    Rows for an archived period that turn up later stay in main.
+    '''
+    archive = partition_path(db_name, ARCHIVE_PARTITION)
+    for partition in archived_partitions(db_name):
+        if partition_path(db_name, partition).exists():
+            os.remove(partition_path(db_name, partition))
+    partitions = list_partitions(db_name)
+    if len(partitions) <= max_partitions:
+        return []
+    excess = len(partitions) - max_partitions + (0 if archive.exists() else 1)
+    merged = [(partition, path) for partition, path in partitions if partition != ARCHIVE_PARTITION and is_frozen(path)]
+    merged = merged[:max(excess, 0)]
+    if not merged:
+        return []
+
+    if archive.exists():
+        os.chmod(archive, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+    else:
+        engine = create_engine(f"sqlite:///{archive}", echo=False)
+        Base.metadata.create_all(engine, tables=PARTITIONED_TABLES)
+        engine.dispose()
+    try:
+        with closing(sqlite3.connect(archive, isolation_level=None)) as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS archived_partition (partition INTEGER PRIMARY KEY)")
+            # sqlite attaches outside a transaction and only so many files at once
+            for start in range(0, len(merged), MAX_ATTACHED_PARTITIONS):
+                batch = merged[start:start + MAX_ATTACHED_PARTITIONS]
+                for partition, path in batch:
+                    connection.execute(f"ATTACH DATABASE 'file:{path}?mode=ro' AS part_{partition}")
+                connection.execute("BEGIN IMMEDIATE")
+                for partition, path in batch:
+                    for table in PARTITIONED_TABLES:
+                        connection.execute(f"INSERT OR REPLACE INTO main.{table.name} SELECT * FROM part_{partition}.{table.name}")
+                    connection.execute("INSERT OR REPLACE INTO archived_partition VALUES (?)", (partition,))
+                connection.execute("COMMIT")
+                for partition, path in batch:
+                    connection.execute(f"DETACH DATABASE part_{partition}")
+            connection.execute("ANALYZE")
+    finally:
+        freeze_partition(archive)
+    for partition, path in merged:
+        os.remove(path)
+        print(f"partition {partition} merged into {archive}")
+    return [partition for partition, path in merged]
+
+
+def drop_partitions(db_name):
+    for partition, path in partition_files(db_name):
+        os.remove(path)
+        print(f"partition {partition} removed")
+
+
+def retire_partitions(db_name):
+    '''
+    renames the partitions out of the names connections attach, before a swap puts a file holding every fact row in
+    place of main. Returns (path, retired path) pairs for restore_partitions or remove_retired_partitions.
+    '''
+    retired = []
+    for partition, path in partition_files(db_name):
+        retired_path = path.with_name(f"{Path(db_name).name}_retired_part_{partition}.db")
+        os.replace(path, retired_path)
+        retired.append((path, retired_path))
+    return retired
+
+
+def restore_partitions(retired):
+    for path, retired_path in retired:
+        os.replace(retired_path, path)
+
+
+def remove_retired_partitions(retired):
+    for path, retired_path in retired:
+        os.remove(retired_path)
+        print(f"partition {path.name} removed")
@@ -0,0 +1,103 @@
+from sakila_helper_classes import *
+from sqlite_helper_classes import *
+from sqlite_helper_functions import (
+    create_dim_film, create_dim_actor, create_dim_category, create_dim_store, create_dim_customer,
+    create_fact_rental, create_fact_payment,
+)
+from partition_helper_functions import list_partitions, partition_db_name
+from index_helper_functions import create_index, drop_index
+from source_helper_functions import sync_state_name, source_key_range
+from scd_helper_functions import HASHED_DIMENSIONS
+from typing import NamedTuple
+from sqlalchemy import func
+
+
+SKIP = "skip"
+INCREMENTAL = "incremental"
+RELOAD = "reload"
+
+# an incremental merge costs a lookup plus a write per row, a reload is one bulk pass with the indexes dropped,
+# so once roughly a fifth of the table has moved the reload wins
+RELOAD_THRESHOLD = 0.2
+
+RELOAD_FUNCTIONS = {
+    "dim_film": create_dim_film,
+    "dim_actor": create_dim_actor,
+    "dim_category": create_dim_category,
+    "dim_store": create_dim_store,
+    "dim_customer": create_dim_customer,
+    "fact_rental": create_fact_rental,
+    "fact_payment": create_fact_payment,
+}
+
+
+class TablePlan(NamedTuple):
+    table_name: str
+    strategy: str
+    delta_rows: int
+    source_rows: int
+    last_sync: datetime
+
+
+def read_last_sync(sqlite_session, table_name):
+    state = sqlite_session.query(sync_state).filter_by(table_name=table_name).first()
+    return datetime.strptime(state.last_update, "%Y-%m-%d %H:%M:%S") if state else datetime.min
+
+
+def plan_table(sqlite_session, mysql_session, table_name, model, timestamp_column,
+               reload_threshold=RELOAD_THRESHOLD, allow_reload=True, source=None):
+    last_sync = read_last_sync(sqlite_session, sync_state_name(table_name, source))
+    delta_rows = mysql_session.query(func.count()).select_from(model).filter(timestamp_column > last_sync).scalar()
+    if delta_rows == 0:
+        return TablePlan(table_name, SKIP, 0, None, last_sync)
+
+    source_rows = mysql_session.query(func.count()).select_from(model).scalar()
+    if allow_reload and delta_rows >= reload_threshold * source_rows:
+        return TablePlan(table_name, RELOAD, delta_rows, source_rows, last_sync)
+    return TablePlan(table_name, INCREMENTAL, delta_rows, source_rows, last_sync)
+
+
+def plan_incremental_sync(sqlite_session, mysql_session, sync_config, reload_threshold=RELOAD_THRESHOLD, source=None):
+    '''
+    estimates how many rows moved past each watermark with count queries and picks skip, incremental or reload
+    per table. Fact tables are never reloaded once partitions exist, since the reload only rewrites the main file.
+    '''
+    partitioned = bool(list_partitions(partition_db_name(sqlite_session.get_bind())))
+    plans = {}
+    for table_name, model, timestamp_column, _ in sync_config:
+        allow_reload = not (partitioned and table_name.startswith("fact_"))
+        plans[table_name] = plan_table(
+            sqlite_session, mysql_session, table_name, model, timestamp_column, reload_threshold, allow_reload, source
+        )
+    return plans
+
+
+def print_plan(plans):
+    print(f"{'table':<15}{'strategy':<14}{'delta rows':>12}{'source rows':>13}  last sync")
+    for plan in plans.values():
+        source_rows = "-" if plan.source_rows is None else plan.source_rows
+        print(f"{plan.table_name:<15}{plan.strategy:<14}{plan.delta_rows:>12}{source_rows:>13}  {plan.last_sync}")
+
+
+def reload_table(sqlite_session, mysql_session, table_name, key_offset=0):
+    '''
+    truncates one source's rows of the warehouse table and reloads them from scratch, with the secondary indexes
+    dropped for the load and rebuilt once at the end. Dimensions are not truncated: facts point at older versions
+    of the versioned ones, and a reload triggered by a bulk touch of last_update should not rewrite rows that did
+    not change, so all of their rows are compared by hash and only the changed ones written.
+    '''
+    table = Base.metadata.tables[table_name]
+    model = next(mapper.class_ for mapper in Base.registry.mappers if mapper.local_table is table)
+    connection = sqlite_session.connection()
+    for index in table.indexes:
+        drop_index(connection, index)
+    if table_name not in HASHED_DIMENSIONS:
+        sqlite_session.query(model).filter(source_key_range(model, key_offset)).delete(synchronize_session=False)
+    RELOAD_FUNCTIONS[table_name](sqlite_session, mysql_session, key_offset)
+    connection = sqlite_session.connection()
+    for index in table.indexes:
+        create_index(connection, index)
+    sqlite_session.commit()
+    reloaded_rows = sqlite_session.query(func.count()).select_from(model).filter(source_key_range(model, key_offset)).scalar()
+    print(f"{table_name} reloaded: {reloaded_rows} rows")
+    return reloaded_rows
@@ -0,0 +1,93 @@
+import json
+import threading
+import time
+
+
+# seconds between two progress lines of one table, and "human" or "json" (one object per line for log shippers)
+PROGRESS_INTERVAL = 5.0
+PROGRESS_FORMAT = "human"
+PROGRESS_FORMATS = ("human", "json")
+
+# name of the source the current thread is loading, so concurrent sources can be told apart in the output
+progress_context = threading.local()
+
+
+def configure_progress(interval=None, log_format=None):
+    global PROGRESS_INTERVAL, PROGRESS_FORMAT
+    if interval is not None:
+        PROGRESS_INTERVAL = interval
+    if log_format is not None:
+        if log_format not in PROGRESS_FORMATS:
+            raise ValueError(f"unsupported progress format: {log_format}")
+        PROGRESS_FORMAT = log_format
+
+
+def set_progress_source(source_name):
+    progress_context.source = source_name
+
+
+class ProgressReporter:
+    '''
+    counts the rows of one table as they are written and prints rows done, rows/sec and an ETA every
+    PROGRESS_INTERVAL seconds, then one line when the table is finished. A table that keeps printing lines with the
+    same row count is stalled, one whose rate is just low is slow.
+    '''
+    def __init__(self, table_name, expected_rows=None):
+        self.table_name = table_name
+        self.expected_rows = expected_rows
+        self.source = getattr(progress_context, "source", None)
+        self.rows_done = 0
+        self.started = self.last_report = time.perf_counter()
+
+    def advance(self, rows=1):
+        self.rows_done += rows
+        now = time.perf_counter()
+        if now - self.last_report >= PROGRESS_INTERVAL:
+            self.last_report = now
+            self.report("progress", now)
+
+    def finish(self):
+        if self.rows_done:
+            self.report("finished", time.perf_counter())
+
+    def snapshot(self, now):
+        elapsed = now - self.started
+        rate = self.rows_done / elapsed if elapsed > 0 else 0.0
+        remaining = None
+        if self.expected_rows is not None and rate > 0:
+            remaining = max(self.expected_rows - self.rows_done, 0) / rate
+        return {
+            "table": self.table_name,
+            "source": self.source,
+            "rows_done": self.rows_done,
+            "rows_expected": self.expected_rows,
+            "rows_per_second": round(rate, 1),
+            "elapsed_seconds": round(elapsed, 1),
+            "eta_seconds": None if remaining is None else round(remaining, 1),
+        }
+
+    def report(self, event, now):
+        snapshot = self.snapshot(now)
+        if PROGRESS_FORMAT == "json":
+            print(json.dumps({"event": event, **snapshot}), flush=True)
+            return
+        label = f"{self.source} {self.table_name}" if self.source else self.table_name
+        if event == "finished":
+            print(f"{label}: {self.rows_done} rows in {snapshot['elapsed_seconds']:.1f} s "
+                  f"({snapshot['rows_per_second']:.0f} rows/s)", flush=True)
+            return
+        done = f"{self.rows_done}/{self.expected_rows} rows ({self.rows_done / self.expected_rows:.0%})" if self.expected_rows else f"{self.rows_done} rows"
+        eta = f", eta {snapshot['eta_seconds']:.0f} s" if snapshot["eta_seconds"] is not None else ""
+        print(f"{label}: {done}, {snapshot['rows_per_second']:.0f} rows/s{eta}", flush=True)
+
+
+def track(rows, table_name, expected_rows=None):
+    '''
+    iterates rows while reporting on them. Extracts are already materialized with .all(), so their length is the
+    expected count unless the caller knows it from a count query.
+    '''
+    reporter = ProgressReporter(table_name, len(rows) if expected_rows is None and hasattr(rows, "__len__") else expected_rows)
+    for row in rows:
+        yield row
+        reporter.advance()
+    reporter.finish()
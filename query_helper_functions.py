@@ -0,0 +1,172 @@
+from sqlite_helper_classes import *
+from collections import OrderedDict
+from typing import NamedTuple
+import threading
+from source_helper_functions import SOURCE_KEY_STRIDE
+from sqlalchemy import func, or_
+from sqlalchemy.orm import aliased
+from datetime import datetime, timedelta
+
+
+class RevenueRow(NamedTuple):
+    period: str
+    revenue: float
+
+
+class FilmRentalsRow(NamedTuple):
+    film_id: int
+    title: str
+    rentals: int
+
+
+class CategoryRentalsRow(NamedTuple):
+    category: str
+    rentals: int
+
+
+class QueryCache:
+    '''
+    LRU cache for warehouse query results. Every entry remembers the sync_state watermarks of the
+    tables it was computed from, and is thrown away the first time one of those watermarks moves (or the
+    entry mark_tables_written moves).
+    A hit between syncs costs a single primary key lookup on sync_state. Safe to share between threads; two threads
+    missing on the same key at once both run the query and the later result wins.
+    '''
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_run(self, sqlite_session, key, tables, run):
+        watermarks = current_watermarks(sqlite_session, tables)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == watermarks:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        result = tuple(run())
+        with self._lock:
+            self._entries[key] = (watermarks, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return result
+
+    def invalidate(self, tables=None):
+        with self._lock:
+            if tables is None:
+                self._entries.clear()
+                return
+            tables = set(tables)
+            for key in [key for key, (watermarks, _) in self._entries.items() if tables & set(dict(watermarks))]:
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+query_cache = QueryCache()
+
+# sync_state entry of the writes that leave a table's watermarks where they are, e.g. "fact_rental@#writes". Source
+# names are letters, digits and underscores, so it can never be a source's watermark
+WRITES_STATE_SUFFIX = "@#writes"
+
+
+def mark_tables_written(sqlite_session, tables):
+    '''
+    returned rentals, reconciled deletes, change log updates, bridge rebuilds and placeholder rows change tables
+    without moving their watermarks. Their writers call this before they commit, so results cached over those tables
+    are recomputed in every process reading the warehouse, not only this one. The entry keeps the watermarks' format
+    and moves a second past its last value when it was already written this second, so it always changes.
+    '''
+    now = datetime.now().replace(microsecond=0)
+    for table_name in sorted(set(tables)):
+        state_name = f"{table_name}{WRITES_STATE_SUFFIX}"
+        written_at = now
+        stored = sqlite_session.get(sync_state, state_name)
+        if stored is not None and stored.last_update[:19] >= now.strftime("%Y-%m-%d %H:%M:%S"):
+            written_at = datetime.strptime(stored.last_update[:19], "%Y-%m-%d %H:%M:%S") + timedelta(seconds=1)
+        sqlite_session.merge(sync_state(table_name=state_name, last_update=written_at.strftime("%Y-%m-%d %H:%M:%S")))
+    query_cache.invalidate(tables)
+
+
+def current_watermarks(sqlite_session, tables):
+    # every source keeps its own <table>@<source> watermark, and any one of them moving invalidates the table
+    states = sqlite_session.query(sync_state.table_name, sync_state.last_update).filter(or_(
+        sync_state.table_name.in_(tables), *[sync_state.table_name.like(f"{table_name}@%") for table_name in tables]
+    )).all()
+    found = {}
+    for state_name, last_update in sorted(states):
+        found.setdefault(state_name.split("@")[0], []).append((state_name, last_update))
+    return tuple((table_name, tuple(found.get(table_name, ()))) for table_name in sorted(tables))
+
+
+def revenue_by_period(sqlite_session, period="month", cache=query_cache) -> list[RevenueRow]:
+    if period not in ("year", "quarter", "month", "day"):
+        raise ValueError(f"unsupported period: {period}")
+
+    def run():
+        if period == "year":
+            columns = [dim_date.year]
+        elif period == "quarter":
+            columns = [dim_date.year, dim_date.quarter]
+        elif period == "month":
+            columns = [dim_date.year, dim_date.month]
+        else:
+            columns = [dim_date.date]
+        rows = sqlite_session.query(*columns, func.sum(fact_payment.amount)).join(
+            dim_date, fact_payment.date_key_paid == dim_date.date_key
+        ).group_by(*columns).all()
+
+        results = []
+        for *parts, revenue in rows:
+            if period == "quarter":
+                label = f"{parts[0]}-Q{parts[1]}"
+            elif period == "month":
+                label = f"{parts[0]}-{int(parts[1]):02d}"
+            else:
+                label = str(parts[0])
+            results.append(RevenueRow(label, round(revenue, 2)))
+        return sorted(results)
+
+    return list(cache.get_or_run(sqlite_session, ("revenue_by_period", period), ["fact_payment", "dim_date"], run))
+
+
+def top_films(sqlite_session, limit=10, cache=query_cache) -> list[FilmRentalsRow]:
+    '''rentals of every version of a film count towards it, listed under its current title'''
+    def run():
+        rentals = func.count(fact_rental.fact_rental_key)
+        rented = aliased(dim_film)
+        same_source = rented.film_key // SOURCE_KEY_STRIDE == dim_film.film_key // SOURCE_KEY_STRIDE
+        rows = sqlite_session.query(dim_film.film_id, dim_film.title, rentals).join(
+            rented, (rented.film_id == dim_film.film_id) & same_source
+        ).join(
+            fact_rental, fact_rental.film_key == rented.film_key
+        ).filter(dim_film.is_current == 1).group_by(
+            dim_film.film_id, dim_film.title
+        ).order_by(rentals.desc(), dim_film.film_id).limit(limit).all()
+        return [FilmRentalsRow(*row) for row in rows]
+
+    return list(cache.get_or_run(sqlite_session, ("top_films", limit), ["fact_rental", "dim_film"], run))
+
+
+def rentals_by_category(sqlite_session, cache=query_cache) -> list[CategoryRentalsRow]:
+    '''
+    bridge_film_category has no watermark of its own, its rebuilds move its mark_tables_written entry instead
+    '''
+    def run():
+        rentals = func.count(fact_rental.fact_rental_key)
+        rows = sqlite_session.query(dim_category.name, rentals).join(
+            bridge_film_category, bridge_film_category.category_key == dim_category.category_key).join(
+            fact_rental, fact_rental.film_key == bridge_film_category.film_key
+        ).group_by(dim_category.name).order_by(rentals.desc(), dim_category.name).all()
+        return [CategoryRentalsRow(*row) for row in rows]
+
+    return list(cache.get_or_run(
+        sqlite_session, ("rentals_by_category",), ["fact_rental", "dim_film", "dim_category", "bridge_film_category"], run
+    ))
@@ -0,0 +1,138 @@
+from sakila_helper_classes import *
+from sqlite_helper_classes import *
+from source_helper_functions import source_key_range
+from scd_helper_functions import SCD_DIMENSIONS, current_version_filter, expire_scd_rows
+from key_helper_functions import FACT_KEYS
+from query_helper_functions import mark_tables_written
+from partition_helper_functions import partition_db_name, partition_sessions, partition_fact_keys, delete_partition_facts_after_commit
+from sqlalchemy import and_, func
+
+
+# warehouse table, source primary key, warehouse natural id
+RECONCILED_TABLES = [
+    ("dim_film", Film.film_id, dim_film.film_id),
+    ("dim_actor", Actor.actor_id, dim_actor.actor_id),
+    ("dim_category", Category.category_id, dim_category.category_id),
+    ("dim_store", Store.store_id, dim_store.store_id),
+    ("dim_customer", Customer.customer_id, dim_customer.customer_id),
+    ("fact_rental", Rental.rental_id, fact_rental.rental_id),
+    ("fact_payment", Payment.payment_id, fact_payment.payment_id),
+]
+
+CHUNK_SIZE = 1000
+DELETE_BATCH_SIZE = 500
+# the per-key hash: two rounds of an affine step and a squaring modulo a prime below 2**31, so every intermediate
+# product stays inside a signed 64 bit integer and mysql and sqlite compute exactly the same values
+HASH_MODULUS = 2147483647
+HASH_ROUNDS = [(48271, 11), (69621, 7)]
+
+
+def key_hash(offset):
+    '''hash of a key offset, for a column expression or a plain int alike'''
+    value = offset
+    for multiplier, increment in HASH_ROUNDS:
+        value = (value * multiplier + increment) % HASH_MODULUS
+        value = value * value % HASH_MODULUS
+    return value
+
+
+def chunk_digests(session, key_column, chunk_size=CHUNK_SIZE, scope=None):
+    '''
+    {chunk: (count, sum of key hashes)} of the keys inside each chunk, computed by the database so only one small row
+    per chunk crosses the wire. The hash is not linear in the key, so unlike sums of keys or of their powers, two
+    different key sets of one chunk practically never share a digest. Hashing offsets inside the chunk keeps the
+    products small. scope optionally restricts the rows, e.g. to one source's key range in the warehouse.
+    '''
+    chunk = key_column // chunk_size
+    query = session.query(chunk, func.count(key_column), func.sum(key_hash(key_column % chunk_size)))
+    if scope is not None:
+        query = query.filter(scope)
+    rows = query.group_by(chunk).all()
+    return {int(chunk_id): (int(count), int(hashes)) for chunk_id, count, hashes in rows}
+
+
+def chunk_keys(session, key_column, chunk_id, chunk_size=CHUNK_SIZE, scope=None):
+    lower = chunk_id * chunk_size
+    rows = session.query(key_column).filter(key_column >= lower, key_column < lower + chunk_size)
+    if scope is not None:
+        rows = rows.filter(scope)
+    rows = rows.order_by(key_column)
+    return {row[0] for row in rows}
+
+
+def warehouse_sessions(sqlite_session, warehouse_key):
+    '''the warehouse session, then a read-only session per partition for the fact tables, whose rows can live in either'''
+    yield sqlite_session
+    if warehouse_key.class_.__tablename__ in FACT_KEYS:
+        for partition, session in partition_sessions(partition_db_name(sqlite_session.get_bind())):
+            yield session
+
+
+def warehouse_chunk_digests(sqlite_session, warehouse_key, chunk_size, scope):
+    digests = {}
+    for session in warehouse_sessions(sqlite_session, warehouse_key):
+        for chunk_id, digest in chunk_digests(session, warehouse_key, chunk_size, scope).items():
+            # a fact row lives in one file only, so the digests of the files add up to the digest of the table
+            digests[chunk_id] = tuple(map(sum, zip(digests[chunk_id], digest))) if chunk_id in digests else digest
+    return digests
+
+
+def find_deleted_keys(sqlite_session, mysql_session, source_key, warehouse_key, chunk_size=CHUNK_SIZE, key_offset=0):
+    '''
+    the loads have already written every new source row, so a table holding as many rows as its source has no
+    deletes left to find, and the chunk digests are only computed on either side when the counts differ. A delete
+    hidden by an insert the loads have not picked up yet shows up once they have.
+    '''
+    # versioned dimensions hold each natural id once per version, only the current versions are compared
+    scope = and_(source_key_range(warehouse_key.class_, key_offset), current_version_filter(warehouse_key.class_))
+    warehouse_count = sum(session.query(func.count(warehouse_key)).filter(scope).scalar()
+                          for session in warehouse_sessions(sqlite_session, warehouse_key))
+    if mysql_session.query(func.count(source_key)).scalar() == warehouse_count:
+        return []
+    source_digests = chunk_digests(mysql_session, source_key, chunk_size)
+    warehouse_digests = warehouse_chunk_digests(sqlite_session, warehouse_key, chunk_size, scope)
+
+    deleted_keys = []
+    for chunk_id, digest in sorted(warehouse_digests.items()):
+        if source_digests.get(chunk_id) == digest:
+            continue
+        # only chunks whose digests disagree pay for fetching exact key lists from both sides
+        source_keys = chunk_keys(mysql_session, source_key, chunk_id, chunk_size) if chunk_id in source_digests else set()
+        warehouse_keys = set()
+        for session in warehouse_sessions(sqlite_session, warehouse_key):
+            warehouse_keys |= chunk_keys(session, warehouse_key, chunk_id, chunk_size, scope)
+        deleted_keys.extend(sorted(warehouse_keys - source_keys))
+    return deleted_keys
+
+
+def delete_warehouse_keys(sqlite_session, warehouse_key, deleted_keys, batch_size=DELETE_BATCH_SIZE, key_offset=0):
+    table_name = warehouse_key.class_.__tablename__
+    partitioned_keys = []
+    for start in range(0, len(deleted_keys), batch_size):
+        batch = deleted_keys[start:start + batch_size]
+        if table_name in SCD_DIMENSIONS:
+            expire_scd_rows(sqlite_session, table_name, batch, key_offset)
+            continue
+        scope = source_key_range(warehouse_key.class_, key_offset)
+        if table_name in FACT_KEYS:
+            partitioned_keys.extend(partition_fact_keys(partition_db_name(sqlite_session.get_bind()), warehouse_key, batch, scope).values())
+        sqlite_session.query(warehouse_key.class_).filter(warehouse_key.in_(batch), scope).delete(synchronize_session=False)
+    mark_tables_written(sqlite_session, [table_name])
+    sqlite_session.commit()
+    if partitioned_keys:
+        delete_partition_facts_after_commit(sqlite_session, FACT_KEYS[table_name][1], partitioned_keys)
+
+
+def reconcile_deletes(sqlite_session, mysql_session, chunk_size=CHUNK_SIZE, key_offset=0):
+    '''
+    removes warehouse rows of one source whose natural key no longer exists in that sakila database. Versioned
+    dimensions keep their history and only have the current version expired.
+    '''
+    deleted_counts = {}
+    for table_name, source_key, warehouse_key in RECONCILED_TABLES:
+        deleted_keys = find_deleted_keys(sqlite_session, mysql_session, source_key, warehouse_key, chunk_size, key_offset)
+        if deleted_keys:
+            delete_warehouse_keys(sqlite_session, warehouse_key, deleted_keys, key_offset=key_offset)
+            print(f"{table_name}: {len(deleted_keys)} rows deleted in sakila removed from the warehouse")
+        deleted_counts[table_name] = len(deleted_keys)
+    return deleted_counts
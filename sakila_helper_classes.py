@@ -1,4 +1,5 @@
 from datetime import datetime
+from typing import Optional
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 from sqlalchemy import String, Integer, Float, DateTime, Boolean
 
@@ -57,7 +58,7 @@ class Rental(SakilaBase):
     __tablename__ = "rental"
     rental_id: Mapped[int] = mapped_column(Integer, primary_key=True)
     rental_date: Mapped[datetime] = mapped_column(DateTime)
-    return_date: Mapped[datetime] = mapped_column(DateTime)
+    return_date: Mapped[Optional[datetime]] = mapped_column(DateTime)
     staff_id: Mapped[int] = mapped_column(Integer)
     inventory_id: Mapped[int] = mapped_column(Integer)
     customer_id: Mapped[int] = mapped_column(Integer)
@@ -114,3 +115,11 @@ class Country(SakilaBase):
     country_id: Mapped[int] = mapped_column(Integer, primary_key=True)
     country: Mapped[str] = mapped_column(String(50))
 
+
+class ChangeLog(SakilaBase):
+    __tablename__ = "etl_change_log"
+    change_id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    table_name: Mapped[str] = mapped_column(String(30))
+    row_id: Mapped[int] = mapped_column(Integer)
+    operation: Mapped[str] = mapped_column(String(1))
+    changed_at: Mapped[Optional[datetime]] = mapped_column(DateTime)
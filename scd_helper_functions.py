@@ -0,0 +1,245 @@
+from sqlite_helper_classes import *
+from source_helper_functions import source_key_range
+from key_helper_functions import KEY_SCHEMES, surrogate_key
+from progress_helper_functions import ProgressReporter, track
+from query_helper_functions import mark_tables_written
+from sqlalchemy import func, insert, select, text, true
+from typing import NamedTuple
+from datetime import date
+from bisect import bisect_right
+import hashlib
+
+
+# expiry date of the version that is still current
+OPEN_EXPIRY_DATE = "9999-12-31"
+# row_hash of a placeholder member the integrity check inserted for a key facts pointed at before its row arrived
+PLACEHOLDER_ROW_HASH = "placeholder"
+
+
+class ScdDimension(NamedTuple):
+    model: type
+    natural_id: str
+    surrogate_key: str
+    # attributes whose change creates a new version; last_update alone never does
+    tracked_columns: list
+    max_versions: int
+
+
+# versions take the keys after version 1 in KEY_SCHEMES: film 7 is 701, 702, ... and store 2 is 1002, 2002, ...
+# (sakila store ids are tinyints, below 1000), which bounds how many versions fit before the next id's keys
+SCD_DIMENSIONS = {
+    "dim_film": ScdDimension(dim_film, "film_id", "film_key",
+                             ["title", "rating", "length", "language", "release_year"], 99),
+    "dim_store": ScdDimension(dim_store, "store_id", "store_key", ["city", "country"], 999),
+    "dim_customer": ScdDimension(dim_customer, "customer_id", "customer_key",
+                                 ["first_name", "last_name", "active", "city", "country"], 99),
+}
+
+SCD_MODELS = {dimension.model: dimension for dimension in SCD_DIMENSIONS.values()}
+
+
+class Type1Dimension(NamedTuple):
+    model: type
+    surrogate_key: str
+    tracked_columns: list
+
+
+# dimensions that are overwritten in place, but still only when their content actually changed
+TYPE1_DIMENSIONS = {
+    "dim_actor": Type1Dimension(dim_actor, "actor_key", ["first_name", "last_name"]),
+    "dim_category": Type1Dimension(dim_category, "category_key", ["name"]),
+}
+
+# every dimension loaded from sakila rows carries a row_hash; dim_date is generated, not loaded
+HASHED_DIMENSIONS = {**SCD_DIMENSIONS, **TYPE1_DIMENSIONS}
+
+FILM_BRIDGES = [bridge_film_actor, bridge_film_category]
+
+
+def row_hash(values, columns):
+    '''8 byte blake2b of the tracked attributes, enough to tell the versions of one row apart'''
+    payload = "\x1f".join(
+        "" if values[column] is None else str(int(values[column]) if isinstance(values[column], bool) else values[column])
+        for column in columns
+    )
+    return hashlib.blake2b(payload.encode(), digest_size=8).hexdigest()
+
+
+def version_key(dimension, natural_id, version, key_offset=0):
+    if version > dimension.max_versions:
+        raise Exception(f"{dimension.model.__tablename__} {natural_id} has more than {dimension.max_versions} versions")
+    return surrogate_key(dimension.model.__tablename__, natural_id, key_offset, version)
+
+
+def key_version(dimension, natural_id, key, key_offset=0):
+    table_name = dimension.model.__tablename__
+    return (key - surrogate_key(table_name, natural_id, key_offset)) // KEY_SCHEMES[table_name].version_step + 1
+
+
+def latest_versions(sqlite_session, dimension, key_offset=0):
+    '''
+    {natural id: (surrogate key, row hash, is_current)} of the newest version of every row of one source, read in
+    one pass. Versions only ever get higher keys, so the newest is the highest key of its natural id.
+    '''
+    model = dimension.model
+    natural_id = getattr(model, dimension.natural_id)
+    key_column = getattr(model, dimension.surrogate_key)
+    newest = sqlite_session.query(func.max(key_column)).filter(
+        source_key_range(model, key_offset)
+    ).group_by(natural_id).scalar_subquery()
+    rows = sqlite_session.query(natural_id, key_column, model.row_hash, model.is_current).filter(
+        key_column.in_(newest)
+    )
+    return {row[0]: (row[1], row[2], row[3]) for row in rows}
+
+
+def merge_scd_rows(sqlite_session, table_name, rows, key_offset=0):
+    '''
+    rows are the natural id, tracked attributes and last_update of sakila rows. A natural id seen for the first time
+    becomes version 1. A row whose tracked attributes hash differently from its newest version, or whose newest
+    version was expired by a delete, expires that version and gets the next key. Unchanged rows are not written.
+    Returns the number of versions written and [(previous key, new key)] for the rows that got a new version.
+    '''
+    dimension = SCD_DIMENSIONS[table_name]
+    model = dimension.model
+    key_column = getattr(model, dimension.surrogate_key)
+    latest = latest_versions(sqlite_session, dimension, key_offset)
+
+    written = 0
+    new_versions = []
+    for values in track(rows, table_name):
+        natural_id = values[dimension.natural_id]
+        digest = row_hash(values, dimension.tracked_columns)
+        previous = latest.get(natural_id)
+        if previous is None:
+            key = version_key(dimension, natural_id, 1, key_offset)
+        elif previous[1] == PLACEHOLDER_ROW_HASH:
+            # facts already point at the placeholder's key, so the real row takes it over instead of versioning it
+            key = previous[0]
+        elif previous[1] == digest and previous[2] == 1:
+            continue
+        else:
+            previous_key = previous[0]
+            key = version_key(dimension, natural_id, key_version(dimension, natural_id, previous_key, key_offset) + 1, key_offset)
+            sqlite_session.query(model).filter(key_column == previous_key, model.is_current == 1).update(
+                {"is_current": 0, "expiry_date": values["last_update"]}, synchronize_session=False
+            )
+            new_versions.append((previous_key, key))
+        sqlite_session.merge(model(**{dimension.surrogate_key: key}, **values, effective_date=values["last_update"],
+                                   expiry_date=OPEN_EXPIRY_DATE, is_current=1, row_hash=digest))
+        latest[natural_id] = (key, digest, 1)
+        written += 1
+    sqlite_session.commit()
+    return written, new_versions
+
+
+def merge_changed_rows(sqlite_session, table_name, rows, key_offset=0):
+    '''
+    type 1 refresh: rows already carry their surrogate key. The stored hashes of one source are read in a single
+    pass and only rows that are new or hash differently are written, in one bulk statement, so a bulk touch of
+    last_update in sakila costs no writes. Returns the number of rows written.
+    '''
+    dimension = TYPE1_DIMENSIONS[table_name]
+    model = dimension.model
+    key_column = getattr(model, dimension.surrogate_key)
+    stored_hashes = dict(sqlite_session.query(key_column, model.row_hash).filter(source_key_range(model, key_offset)).all())
+
+    progress = ProgressReporter(table_name, len(rows))
+    changed_rows = []
+    for values in rows:
+        digest = row_hash(values, dimension.tracked_columns)
+        if stored_hashes.get(values[dimension.surrogate_key]) != digest:
+            changed_rows.append({**values, "row_hash": digest})
+    if changed_rows:
+        sqlite_session.execute(insert(model).prefix_with("OR REPLACE"), changed_rows)
+    sqlite_session.commit()
+    progress.advance(len(rows))
+    progress.finish()
+    return len(changed_rows)
+
+
+def expire_scd_rows(sqlite_session, table_name, natural_ids, key_offset=0, expiry_date=None):
+    '''a row deleted in sakila keeps its history for the facts that point at it, its current version is just closed'''
+    dimension = SCD_DIMENSIONS[table_name]
+    model = dimension.model
+    expired = sqlite_session.query(model).filter(
+        getattr(model, dimension.natural_id).in_(natural_ids), model.is_current == 1, source_key_range(model, key_offset)
+    ).update({"is_current": 0, "expiry_date": expiry_date or date.today().strftime("%Y-%m-%d")}, synchronize_session=False)
+    sqlite_session.commit()
+    return expired
+
+
+def fact_key_map(sqlite_session, key_offset=0):
+    '''
+    {fact column: {natural id: ([effective dates], [surrogate keys])}} of every version of every row of one source,
+    oldest first, loaded once per fact load so every fact row finds the version valid on its date in memory
+    '''
+    key_map = {}
+    for dimension in SCD_DIMENSIONS.values():
+        model = dimension.model
+        key_column = getattr(model, dimension.surrogate_key)
+        versions = {}
+        rows = sqlite_session.query(getattr(model, dimension.natural_id), model.effective_date, key_column).filter(
+            source_key_range(model, key_offset)
+        ).order_by(key_column)
+        for natural_id, effective_date, key in rows:
+            effective_dates, keys = versions.setdefault(natural_id, ([], []))
+            # rows migrated without a history start before every fact
+            effective_dates.append(effective_date or "")
+            keys.append(key)
+        key_map[dimension.surrogate_key] = versions
+    return key_map
+
+
+def version_key_on(key_map, key_name, natural_id, as_of=None, key_offset=0):
+    '''
+    the key of the version valid on as_of (effective_date <= as_of < expiry_date). A version's expiry date is the
+    next one's effective date, so that is the last version that took effect by then. Facts older than the first
+    version get the first one and as_of=None gets the newest. Rows the warehouse has not seen yet fall back to the
+    version 1 key.
+    '''
+    versions = key_map.get(key_name, {}).get(natural_id) if key_map else None
+    if versions is None:
+        dimension = next(dimension for dimension in SCD_DIMENSIONS.values() if dimension.surrogate_key == key_name)
+        return version_key(dimension, natural_id, 1, key_offset)
+    effective_dates, keys = versions
+    if as_of is None:
+        return keys[-1]
+    return keys[max(bisect_right(effective_dates, as_of.strftime("%Y-%m-%d")) - 1, 0)]
+
+
+def film_version_keys(sqlite_session, key_offset=0, film_ids=None):
+    '''{film_id: [film_key of every version]}, bridges link the actors and categories to all versions of a film'''
+    query = sqlite_session.query(dim_film.film_id, dim_film.film_key).filter(source_key_range(dim_film, key_offset))
+    if film_ids is not None:
+        query = query.filter(dim_film.film_id.in_(film_ids))
+    keys = {}
+    for film_id, film_key in query.order_by(dim_film.film_key):
+        keys.setdefault(film_id, []).append(film_key)
+    return keys
+
+
+def copy_film_links(sqlite_session, new_versions):
+    '''gives every new film version the actor and category links of the version it replaces'''
+    for bridge in FILM_BRIDGES:
+        other_key = next(column.name for column in bridge.__table__.columns if column.name != "film_key")
+        for previous_key, key in new_versions:
+            sqlite_session.execute(text(
+                f"INSERT OR IGNORE INTO {bridge.__tablename__} (film_key, {other_key}) "
+                f"SELECT :key, {other_key} FROM {bridge.__tablename__} WHERE film_key = :previous_key"
+            ), {"key": key, "previous_key": previous_key})
+    if new_versions:
+        mark_tables_written(sqlite_session, [bridge.__tablename__ for bridge in FILM_BRIDGES])
+    sqlite_session.commit()
+
+
+def current_version_filter(model):
+    '''
+    restricts versioned dimensions, and the bridge rows of their versions, to the current version so counts line up
+    with sakila. Every other table is left as is.
+    '''
+    if model in SCD_MODELS:
+        return model.is_current == 1
+    if model in FILM_BRIDGES:
+        return model.film_key.in_(select(dim_film.film_key).where(dim_film.is_current == 1))
+    return true()
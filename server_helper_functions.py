@@ -0,0 +1,149 @@
+from sqlite_helper_classes import *
+from query_helper_functions import revenue_by_period, top_films, rentals_by_category, query_cache, QueryCache
+from partition_helper_functions import attach_partitions_on_connect
+from shadow_helper_functions import reopen_after_swap
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import sessionmaker
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from pathlib import Path
+import json
+import time
+
+
+READ_POOL_SIZE = 8
+# compiled sqlite statements kept per connection, on top of sqlalchemy's own compiled query cache
+CACHED_STATEMENTS = 256
+# changing temp_store drops every TEMP object, so these run before the partition views are created
+READ_PRAGMAS = [
+    "PRAGMA cache_size = -32768",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+]
+
+
+def enable_wal(sqlite_engine):
+    '''
+    WAL lets the pooled readers keep reading their snapshot while an incremental load commits, instead of waiting
+    for the writer's exclusive lock. The mode is stored in the file, so the writer picks it up as well.
+    '''
+    with sqlite_engine.connect() as connection:
+        mode = connection.execute(text("PRAGMA journal_mode = WAL")).scalar()
+    print(f"warehouse journal mode: {mode}")
+    return mode
+
+
+def create_read_engine(db_name, pool_size=READ_POOL_SIZE):
+    '''
+    pool of query-only connections. Each remembers the inode of the file it opened, and a connection whose file was
+    replaced by a Full-load swap is thrown away on checkout, so the pool moves on to the new warehouse.
+    '''
+    db_path = Path(f"{db_name}.db").resolve()
+    engine = create_engine(
+        f"sqlite:///{db_path}", echo=False, pool_size=pool_size, max_overflow=0, pool_timeout=30,
+        connect_args={"timeout": 30, "cached_statements": CACHED_STATEMENTS, "check_same_thread": False},
+    )
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in READ_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    # the partition union views are TEMP objects, so they are created before the connection turns query-only
+    attach_partitions_on_connect(engine, str(db_path.with_suffix("")))
+
+    @event.listens_for(engine, "connect")
+    def on_connect_query_only(dbapi_connection, connection_record):
+        dbapi_connection.execute("PRAGMA query_only = ON")
+
+    return reopen_after_swap(engine)
+
+
+ROUTES = {
+    "/revenue": lambda session, params, cache=query_cache: revenue_by_period(session, params.get("period", "month"), cache),
+    "/top-films": lambda session, params, cache=query_cache: top_films(session, int(params.get("limit", 10)), cache),
+    "/rentals-by-category": lambda session, params, cache=query_cache: rentals_by_category(session, cache),
+}
+
+
+def warm_read_pool(engine, pool_size=READ_POOL_SIZE):
+    '''
+    checks out every pooled connection at once and runs each route through it, so the page cache, the statement
+    caches and the query result cache are hot before the first real request arrives. Only the first connection
+    fills the shared result cache, the others get one of their own so their queries really run
+    '''
+    Session = sessionmaker(bind=engine)
+    sessions = [Session() for _ in range(pool_size)]
+    started = time.perf_counter()
+    for i, session in enumerate(sessions):
+        cache = QueryCache() if i else query_cache
+        for route in ROUTES.values():
+            route(session, {}, cache)
+    for session in sessions:
+        session.close()
+    print(f"{pool_size} read connections warmed in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+
+class WarehouseRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        if url.path == "/health":
+            return self.send_json(200, {
+                "pool": self.server.read_engine.pool.status(),
+                "cache_hits": query_cache.hits,
+                "cache_misses": query_cache.misses,
+            })
+        route = ROUTES.get(url.path)
+        if route is None:
+            return self.send_json(404, {"error": f"unknown endpoint {url.path}", "endpoints": sorted(ROUTES)})
+
+        started = time.perf_counter()
+        session = self.server.Session()
+        try:
+            rows = route(session, params)
+        except ValueError as e:
+            return self.send_json(400, {"error": str(e)})
+        finally:
+            session.close()
+        self.send_json(200, [row._asdict() for row in rows], {"X-Query-Time-Ms": f"{(time.perf_counter() - started) * 1000:.2f}"})
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        # one line per request would drown everything else on the console under dashboard load
+        pass
+
+
+def create_query_server(db_name, host="127.0.0.1", port=8765, pool_size=READ_POOL_SIZE):
+    read_engine = create_read_engine(db_name, pool_size)
+    warm_read_pool(read_engine, pool_size)
+    server = ThreadingHTTPServer((host, port), WarehouseRequestHandler)
+    server.daemon_threads = True
+    server.read_engine = read_engine
+    server.Session = sessionmaker(bind=read_engine)
+    return server
+
+
+def serve_queries(sqlite_engine, db_name, host="127.0.0.1", port=8765, pool_size=READ_POOL_SIZE):
+    enable_wal(sqlite_engine)
+    server = create_query_server(db_name, host, port, pool_size)
+    print(f"serving warehouse queries on http://{host}:{server.server_address[1]} ({', '.join(sorted(ROUTES))})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.read_engine.dispose()
+        print("query server stopped")
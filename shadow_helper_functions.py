@@ -0,0 +1,119 @@
+from sqlite_helper_classes import *
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import DisconnectionError
+from contextlib import closing
+from pathlib import Path
+import os
+import sqlite3
+
+
+# pragmas for the shadow file only: nothing reads it until it is validated and swapped in, and a crash just means
+# building it again, so there is no journal and no fsync until the very end
+SHADOW_PRAGMAS = [
+    "PRAGMA journal_mode = OFF",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -65536",
+]
+
+
+def shadow_path(db_name):
+    return Path(f"{db_name}_shadow.db")
+
+
+def create_shadow_engine(db_name):
+    path = shadow_path(db_name)
+    if path.exists():
+        os.remove(path)
+    engine = create_engine(f"sqlite:///{path}", echo=False, connect_args={"timeout": 300})
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in SHADOW_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    Base.metadata.create_all(engine)
+    print(f"shadow database {path} created")
+    return engine
+
+
+def reopen_after_swap(engine):
+    '''
+    every pooled connection remembers the inode of the file it opened, and one whose file was replaced by a shadow
+    swap is thrown away on checkout. Long-lived engines (the daemon's, the group commit and lease engines, the read
+    pool) then move on to the new warehouse instead of writing to the unlinked old file.
+    '''
+    database = engine.url.database
+    if not database or database == ":memory:":
+        return engine
+    db_path = Path(database).resolve()
+
+    @event.listens_for(engine, "connect")
+    def remember_inode(dbapi_connection, connection_record):
+        connection_record.info["inode"] = os.stat(db_path).st_ino
+
+    @event.listens_for(engine, "checkout")
+    def check_inode(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info.get("inode") != os.stat(db_path).st_ino:
+            raise DisconnectionError("warehouse file was replaced")
+
+    return engine
+
+
+def copy_source_registry(live_engine, shadow_engine):
+    '''source indexes are not derived from sakila, so they are carried over to keep every source's key offset'''
+    warehouse_source.__table__.create(live_engine, checkfirst=True)
+    with live_engine.connect() as connection:
+        sources = [dict(row._mapping) for row in connection.execute(warehouse_source.__table__.select())]
+    if sources:
+        with shadow_engine.begin() as connection:
+            connection.execute(warehouse_source.__table__.insert(), sources)
+
+
+def fsync_path(path):
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def journal_mode(engine):
+    with engine.connect() as connection:
+        return connection.execute(text("PRAGMA journal_mode")).scalar()
+
+
+def replace_warehouse_file(live_engine, new_path, live_path):
+    '''
+    moves a finished database file over the live warehouse with one rename. Processes that already have the old file
+    open keep reading their snapshot of it until they reconnect; every connection opened afterwards sees the new file,
+    and engines set up with reopen_after_swap reconnect on their next checkout. A WAL warehouse stays WAL. The old
+    file's WAL is checkpointed into it and its -wal/-shm files are unlinked before the rename, so the new file can
+    never open next to a log written for the old one.
+    '''
+    wal_mode = live_path.exists() and journal_mode(live_engine) == "wal"
+    with closing(sqlite3.connect(new_path)) as connection:
+        connection.execute(f"PRAGMA journal_mode = {'WAL' if wal_mode else 'DELETE'}")
+    live_engine.dispose()
+    if wal_mode:
+        with closing(sqlite3.connect(live_path)) as connection:
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    # the new file may have been written without fsync, this is the one flush that makes it durable before it goes live
+    fsync_path(new_path)
+    for suffix in ("-wal", "-shm"):
+        sidecar = Path(f"{live_path}{suffix}")
+        if sidecar.exists():
+            os.remove(sidecar)
+    os.replace(new_path, live_path)
+    fsync_path(live_path.parent)
+
+
+def swap_in_shadow(live_engine, shadow_engine, db_name):
+    '''moves the validated shadow over the live file, see replace_warehouse_file'''
+    live_path = Path(f"{db_name}.db").resolve()
+    shadow_engine.dispose()
+    replace_warehouse_file(live_engine, shadow_path(db_name).resolve(), live_path)
+    print(f"shadow database swapped in as {live_path.name}")
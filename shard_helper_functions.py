@@ -0,0 +1,85 @@
+from sakila_helper_classes import *
+from sqlite_helper_classes import *
+from sqlite_helper_functions import rental_fact_values, payment_fact_values, rental_fact_query, payment_fact_query
+from scd_helper_functions import fact_key_map
+from key_helper_functions import surrogate_key
+from progress_helper_functions import ProgressReporter
+from sqlalchemy import create_engine, func, insert
+from sqlalchemy.orm import sessionmaker
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+# more shards than workers keeps every core busy when the ids are unevenly spread
+SHARDS_PER_WORKER = 4
+
+# fact table -> (warehouse model, source id column)
+SHARDED_FACTS = {
+    "fact_rental": (fact_rental, Rental.rental_id),
+    "fact_payment": (fact_payment, Payment.payment_id),
+}
+
+
+def shard_ranges(mysql_session, id_column, shards):
+    '''splits [min id, max id] of the source table into at most `shards` contiguous, inclusive ranges'''
+    lower, upper = mysql_session.query(func.min(id_column), func.max(id_column)).one()
+    if lower is None:
+        return []
+    step = max(-(-(upper - lower + 1) // shards), 1)
+    return [(start, min(start + step - 1, upper)) for start in range(lower, upper + 1, step)]
+
+
+def extract_shard(mysql_url, fact_name, lower, upper, key_offset, key_map=None):
+    '''
+    runs in a worker process: opens its own connection, extracts one id range and returns the transformed rows with
+    the surrogate keys of their natural ids. key_map is the parent's dimension key map, shipped with the task.
+    '''
+    engine = create_engine(mysql_url, echo=False)
+    mysql_session = sessionmaker(bind=engine)()
+    try:
+        if fact_name == "fact_rental":
+            rows = rental_fact_query(mysql_session).filter(Rental.rental_id.between(lower, upper))
+            return [{"fact_rental_key": surrogate_key("fact_rental", rental.rental_id, key_offset),
+                     **rental_fact_values(rental, inventory, film, key_offset, key_map)} for rental, inventory, film in rows]
+        rows = payment_fact_query(mysql_session).filter(Payment.payment_id.between(lower, upper))
+        return [{"fact_payment_key": surrogate_key("fact_payment", payment.payment_id, key_offset),
+                 **payment_fact_values(payment, staff, key_offset, key_map)} for payment, staff in rows]
+    finally:
+        mysql_session.close()
+        engine.dispose()
+
+
+def load_fact_sharded(sqlite_session, mysql_session, fact_name, workers, key_offset=0):
+    '''
+    extracts and transforms the fact table on a pool of `workers` processes, one id range per task, while this
+    process stays the only SQLite writer. Every key is derived from its natural id, so shards are written in whatever
+    order they finish and the keys are still the ones create_fact_rental/create_fact_payment assign on their own.
+    '''
+    model, id_column = SHARDED_FACTS[fact_name]
+    ranges = shard_ranges(mysql_session, id_column, workers * SHARDS_PER_WORKER)
+    mysql_url = mysql_session.get_bind().url.render_as_string(hide_password=False)
+    key_map = fact_key_map(sqlite_session, key_offset)
+    # a count on the primary key is cheap next to the extract, and gives the ETA something to aim at
+    progress = ProgressReporter(fact_name, mysql_session.query(func.count(id_column)).scalar())
+
+    loaded = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        shards = [executor.submit(extract_shard, mysql_url, fact_name, lower, upper, key_offset, key_map) for lower, upper in ranges]
+        for shard in as_completed(shards):
+            rows = shard.result()
+            if not rows:
+                continue
+            sqlite_session.execute(insert(model).prefix_with("OR REPLACE"), rows)
+            sqlite_session.commit()
+            loaded += len(rows)
+            progress.advance(len(rows))
+    progress.finish()
+    print(f"{fact_name}: {loaded} rows loaded from {len(ranges)} shards on {workers} processes")
+    return loaded
+
+
+def create_fact_rental_sharded(sqlite_session, mysql_session, key_offset=0, workers=4):
+    return load_fact_sharded(sqlite_session, mysql_session, "fact_rental", workers, key_offset)
+
+
+def create_fact_payment_sharded(sqlite_session, mysql_session, key_offset=0, workers=4):
+    return load_fact_sharded(sqlite_session, mysql_session, "fact_payment", workers, key_offset)
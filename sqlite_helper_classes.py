@@ -1,19 +1,24 @@
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import String, Integer, Float, Index
+from sqlalchemy import String, Integer, Float, Index, text
 from typing import Optional
 
+
+# every source owns one block of surrogate keys, so film 1 of the second region is film_key 1000000101 instead of 101.
+# The first source registered keeps the original single-source keys.
+SOURCE_KEY_STRIDE = 10**9
+
 class Base(DeclarativeBase):
     pass
 
 class dim_date(Base):
     __tablename__ = "dim_date"
-    date_key: Mapped[str] = mapped_column(String(8), primary_key=True, nullable=False)
+    date_key: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False)
     date: Mapped[str] = mapped_column(String(10), nullable=False)
-    year: Mapped[str] = mapped_column(String(4), nullable=False)
-    quarter: Mapped[str] = mapped_column(String(1), nullable=False)
-    month: Mapped[str] = mapped_column(String(1), nullable=False)
-    day_of_month: Mapped[str] = mapped_column(String(1), nullable=False)
-    day_of_week: Mapped[str] = mapped_column(String(1), nullable=False)
+    year: Mapped[int] = mapped_column(Integer, nullable=False)
+    quarter: Mapped[int] = mapped_column(Integer, nullable=False)
+    month: Mapped[int] = mapped_column(Integer, nullable=False)
+    day_of_month: Mapped[int] = mapped_column(Integer, nullable=False)
+    day_of_week: Mapped[int] = mapped_column(Integer, nullable=False)
     is_weekend: Mapped[Optional[int]] = mapped_column(Integer)
 
     __table_args__ = (
@@ -32,10 +37,14 @@ class dim_film(Base):
     language: Mapped[str] = mapped_column(String(20), nullable=False)
     release_year: Mapped[str] = mapped_column(String(4), nullable=False)
     last_update: Mapped[str] = mapped_column(String(10), nullable=False)
+    # type 2 history: one row per version, the current one has is_current = 1 and expiry_date 9999-12-31
+    effective_date: Mapped[str] = mapped_column(String(10), nullable=False)
+    expiry_date: Mapped[str] = mapped_column(String(10), nullable=False)
+    is_current: Mapped[int] = mapped_column(Integer, nullable=False)
+    row_hash: Mapped[str] = mapped_column(String(16), nullable=False)
 
     __table_args__ = (
         Index('index_dim_film_film_id', 'film_id'),
-        Index('index_')
     )
 
 
@@ -46,6 +55,12 @@ class dim_actor(Base):
     first_name: Mapped[str] = mapped_column(String(25), nullable=False)
     last_name: Mapped[str] = mapped_column(String(25), nullable=False)
     last_update: Mapped[str] = mapped_column(String(10), nullable=False)
+    # hash of the attributes, so a refresh can tell a real change from a bumped last_update
+    row_hash: Mapped[str] = mapped_column(String(16), nullable=False)
+
+    __table_args__ = (
+        Index('index_dim_actor_actor_id', 'actor_id'),
+    )
 
 
 class dim_category(Base):
@@ -54,6 +69,11 @@ class dim_category(Base):
     category_id: Mapped[int] = mapped_column(Integer, nullable=False)
     name: Mapped[str] = mapped_column(String(10), nullable=False)
     last_update: Mapped[str] = mapped_column(String(10), nullable=False)
+    row_hash: Mapped[str] = mapped_column(String(16), nullable=False)
+
+    __table_args__ = (
+        Index('index_dim_category_category_id', 'category_id'),
+    )
 
 
 class dim_store(Base):
@@ -63,6 +83,14 @@ class dim_store(Base):
     city: Mapped[str] = mapped_column(String(20), nullable=False)
     country: Mapped[str] = mapped_column(String(20), nullable=False)
     last_update: Mapped[str] = mapped_column(String(10), nullable=False)
+    effective_date: Mapped[str] = mapped_column(String(10), nullable=False)
+    expiry_date: Mapped[str] = mapped_column(String(10), nullable=False)
+    is_current: Mapped[int] = mapped_column(Integer, nullable=False)
+    row_hash: Mapped[str] = mapped_column(String(16), nullable=False)
+
+    __table_args__ = (
+        Index('index_dim_store_store_id', 'store_id'),
+    )
 
 
 class dim_customer(Base):
@@ -75,6 +103,14 @@ class dim_customer(Base):
     city: Mapped[str] = mapped_column(String(20), nullable=False)
     country: Mapped[str] = mapped_column(String(20), nullable=False)
     last_update: Mapped[str] = mapped_column(String(10), nullable=False)
+    effective_date: Mapped[str] = mapped_column(String(10), nullable=False)
+    expiry_date: Mapped[str] = mapped_column(String(10), nullable=False)
+    is_current: Mapped[int] = mapped_column(Integer, nullable=False)
+    row_hash: Mapped[str] = mapped_column(String(16), nullable=False)
+
+    __table_args__ = (
+        Index('index_dim_customer_customer_id', 'customer_id'),
+    )
 
 
 class bridge_film_actor(Base):
@@ -82,37 +118,79 @@ class bridge_film_actor(Base):
     film_key: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False)
     actor_key: Mapped[int] = mapped_column(Integer, primary_key = True, nullable=False)
 
+    # clustered on the composite primary key, which saves the hidden rowid and the separate primary key index
+    __table_args__ = (
+        Index('index_bridge_film_actor_actor_key', 'actor_key'),
+        {"sqlite_with_rowid": False},
+    )
+
 
 class bridge_film_category(Base):
     __tablename__ = "bridge_film_category"
     film_key: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False)
     category_key: Mapped[int] = mapped_column(Integer, nullable=False)
 
+    __table_args__ = (
+        Index('index_bridge_film_category_category_key', 'category_key'),
+    )
+
 
 class fact_rental(Base):
     __tablename__ = "fact_rental"
     fact_rental_key: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False)
     rental_id: Mapped[int] = mapped_column(Integer, nullable=False)
-    date_key_rented: Mapped[Optional[str]] = mapped_column(String(8))
-    date_key_returned: Mapped[Optional[str]] = mapped_column(String(8))
+    date_key_rented: Mapped[Optional[int]] = mapped_column(Integer)
+    date_key_returned: Mapped[Optional[int]] = mapped_column(Integer)
     film_key: Mapped[int] = mapped_column(Integer, nullable=False)
     store_key: Mapped[int] = mapped_column(Integer, nullable=False)
     customer_key: Mapped[int] = mapped_column(Integer, nullable=False)
     staff_id: Mapped[int] = mapped_column(Integer, nullable=False)
     rental_duration_days: Mapped[Optional[int]] = mapped_column(Integer)
 
+    __table_args__ = (
+        # a rental is unique within its source's key block, store_key is versioned and changes when the rental is reloaded
+        Index('index_fact_rental_rental_id_source', 'rental_id', text(f'fact_rental_key / {SOURCE_KEY_STRIDE}'), unique=True),
+        Index('index_fact_rental_date_key_rented', 'date_key_rented'),
+        Index('index_fact_rental_film_key', 'film_key'),
+        Index('index_fact_rental_customer_key', 'customer_key'),
+        Index('index_fact_rental_store_key', 'store_key'),
+        # partial index holding only the rentals that are still out, which is all the return recheck has to read
+        Index('index_fact_rental_open', 'fact_rental_key', 'rental_id', sqlite_where=text('date_key_returned IS NULL')),
+    )
+
 
 class fact_payment(Base):
     __tablename__ = "fact_payment"
     fact_payment_key: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False)
     payment_id: Mapped[int] = mapped_column(Integer, nullable=False)
-    date_key_paid: Mapped[str] = mapped_column(String(8), nullable=False)
+    date_key_paid: Mapped[int] = mapped_column(Integer, nullable=False)
     customer_key: Mapped[int] = mapped_column(Integer, nullable=False)
     store_key: Mapped[int] = mapped_column(Integer, nullable=False)
     staff_id: Mapped[int] = mapped_column(Integer, nullable=False)
     amount: Mapped[float] = mapped_column(Float, nullable=False)
 
+    __table_args__ = (
+        Index('index_fact_payment_payment_id_source', 'payment_id', text(f'fact_payment_key / {SOURCE_KEY_STRIDE}'), unique=True),
+        Index('index_fact_payment_date_key_paid', 'date_key_paid'),
+        Index('index_fact_payment_customer_key', 'customer_key'),
+        Index('index_fact_payment_store_key', 'store_key'),
+    )
+
 class sync_state(Base):
     __tablename__ = "sync_state"
     table_name: Mapped[str] = mapped_column(String(30), primary_key=True, nullable=False)
-    last_update: Mapped[str] = mapped_column(String(30), nullable=False)
\ No newline at end of file
+    last_update: Mapped[str] = mapped_column(String(30), nullable=False)
+
+class sync_lease(Base):
+    # one row per table (or bridge, or step) an incremental worker is syncing, held until expires_at unless renewed
+    __tablename__ = "sync_lease"
+    lease_name: Mapped[str] = mapped_column(String(40), primary_key=True, nullable=False)
+    owner: Mapped[str] = mapped_column(String(80), nullable=False)
+    acquired_at: Mapped[str] = mapped_column(String(26), nullable=False)
+    heartbeat_at: Mapped[str] = mapped_column(String(26), nullable=False)
+    expires_at: Mapped[str] = mapped_column(String(26), nullable=False)
+
+class warehouse_source(Base):
+    __tablename__ = "warehouse_source"
+    source_name: Mapped[str] = mapped_column(String(16), primary_key=True, nullable=False)
+    source_index: Mapped[int] = mapped_column(Integer, nullable=False, unique=True)
@@ -1,9 +1,33 @@
 from sakila_helper_classes import *
 from sqlite_helper_classes import *
+from source_helper_functions import sync_state_name
+from key_helper_functions import surrogate_key
+from scd_helper_functions import (
+    merge_scd_rows, merge_changed_rows, copy_film_links, fact_key_map, version_key_on, film_version_keys,
+)
+from progress_helper_functions import ProgressReporter, track
 from datetime import timedelta
 from sqlalchemy import func
 
 
+def to_date_key(day):
+    # integer YYYYMMDD key, so star joins compare integers instead of strings
+    return day.year * 10000 + day.month * 100 + day.day
+
+
+def build_dim_date(current):
+    return dim_date(
+        date_key = to_date_key(current),
+        date = current.strftime("%Y-%m-%d"),
+        year = current.year,
+        quarter = (current.month - 1) // 3 + 1,
+        month = current.month,
+        day_of_month = current.day,
+        day_of_week = current.isoweekday(),
+        is_weekend = 1 if current.isoweekday() >= 6 else 0
+    )
+
+
 def create_dim_date(sqlite_session, mysql_session):
     '''
     I used generative AI to stratgegize how to write this function to populate the table
@@ -37,165 +61,217 @@ def create_dim_date(sqlite_session, mysql_session):
     start_date = min(valid_dates)
     end_date = max(valid_dates)
     current = start_date
+    progress = ProgressReporter("dim_date", (end_date - start_date).days + 1)
     while current <= end_date:
-        sqlite_session.merge(dim_date(
-            date_key = current.strftime("%Y%m%d"),
-            date = current.strftime("%Y-%m-%d"),
-            year = str(current.year),
-            quarter = str((current.month - 1) // 3 + 1),
-            month = str(current.month),
-            day_of_month = str(current.day),
-            day_of_week = str(current.isoweekday()),
-            is_weekend = 1 if current.isoweekday() >= 6 else 0
-        ))
+        sqlite_session.merge(build_dim_date(current))
         current += timedelta(days=1)
+        progress.advance()
     sqlite_session.commit()
+    progress.finish()
 
 
-def create_dim_film(sqlite_session, mysql_session):
-    films = mysql_session.query(Film, Language).join(
-        Language, Film.language_id == Language.language_id
-    ).all()
-    for film, language in films:
-        sqlite_session.merge(dim_film(
-            film_key = film.film_id*100 + 1,
-            film_id = film.film_id,
-            title = film.title,
-            rating = film.rating,
-            length = film.length,
-            language = language.name,
-            release_year = film.release_year,
-            last_update = film.last_update.strftime("%Y-%m-%d")
-        ))
-    sqlite_session.commit()
+def film_dim_values(film, language):
+    # the natural id and attributes of one version, merge_scd_rows works out its key
+    return dict(
+        film_id = film.film_id,
+        title = film.title,
+        rating = film.rating,
+        length = film.length,
+        language = language.name,
+        release_year = film.release_year,
+        last_update = film.last_update.strftime("%Y-%m-%d")
+    )
 
 
-def create_dim_actor(sqlite_session, mysql_session):
-    actors = mysql_session.query(Actor).all()
-    for actor in actors:
-        sqlite_session.merge(dim_actor(
-            actor_key = 50000 + actor.actor_id,
-            actor_id = actor.actor_id,
-            first_name = actor.first_name,
-            last_name = actor.last_name,
-            last_update = actor.last_update.strftime("%Y-%m-%d")
-        ))
-    sqlite_session.commit()
+def store_dim_values(store, city, country):
+    return dict(
+        store_id = store.store_id,
+        city = city.city,
+        country = country.country,
+        last_update = store.last_update.strftime("%Y-%m-%d")
+    )
 
 
-def create_dim_category(sqlite_session, mysql_session):
-    categories = mysql_session.query(Category).all()
-    for category in categories:
-        sqlite_session.merge(dim_category(
-            category_key = 30000 + category.category_id * 10 + 1,
-            category_id = category.category_id,
-            name = category.name,
-            last_update = category.last_update.strftime("%Y-%m-%d")
-        ))
-    sqlite_session.commit()
+def customer_dim_values(customer, city, country):
+    return dict(
+        customer_id = customer.customer_id,
+        first_name = customer.first_name,
+        last_name = customer.last_name,
+        active = int(customer.active),
+        city = city.city,
+        country = country.country,
+        last_update = customer.last_update.strftime("%Y-%m-%d")
+    )
+
+
+def film_dim_query(mysql_session):
+    return mysql_session.query(Film, Language).join(Language, Film.language_id == Language.language_id)
 
 
-def create_dim_store(sqlite_session, mysql_session):
-    stores = mysql_session.query(Store, Address, City, Country).join(
+def store_dim_query(mysql_session):
+    return mysql_session.query(Store, Address, City, Country).join(
         Address, Store.address_id == Address.address_id).join(
         City, Address.city_id == City.city_id).join(
-        Country, City.country_id == Country.country_id
-    ).all()
-    for store, address, city, country in stores:
-        sqlite_session.merge(dim_store(
-            store_key = 1000 + store.store_id,
-            store_id = store.store_id,
-            city = city.city,
-            country = country.country,
-            last_update = store.last_update.strftime("%Y-%m-%d")
-        ))
-    sqlite_session.commit()
+        Country, City.country_id == Country.country_id)
+
 
-def create_dim_customer(sqlite_session, mysql_session):
-    customers = mysql_session.query(Customer, Address, City, Country).join(
+def customer_dim_query(mysql_session):
+    return mysql_session.query(Customer, Address, City, Country).join(
         Address, Customer.address_id == Address.address_id).join(
         City, Address.city_id == City.city_id).join(
-        Country, City.country_id == Country.country_id
-    ).all()
-    for customer, address, city, country in customers:
-        sqlite_session.merge(dim_customer(
-            customer_key = customer.customer_id * 100 + 1,
-            customer_id = customer.customer_id,
-            first_name = customer.first_name,
-            last_name = customer.last_name,
-            active = customer.active,
-            city = city.city,
-            country = country.country,
-            last_update = customer.last_update.strftime("%Y-%m-%d")
-        ))
-    sqlite_session.commit()
+        Country, City.country_id == Country.country_id)
+
+
+def create_dim_film(sqlite_session, mysql_session, key_offset=0):
+    '''
+    film, store and customer keep type 2 history, so loading them merges versions instead of overwriting rows.
+    Into an empty table every film simply becomes version 1.
+    '''
+    films = film_dim_query(mysql_session).all()
+    written, new_versions = merge_scd_rows(
+        sqlite_session, "dim_film", [film_dim_values(film, language) for film, language in films], key_offset
+    )
+    copy_film_links(sqlite_session, new_versions)
+    return written
 
 
+def actor_dim_values(actor, key_offset=0):
+    return dict(
+        actor_key = surrogate_key("dim_actor", actor.actor_id, key_offset),
+        actor_id = actor.actor_id,
+        first_name = actor.first_name,
+        last_name = actor.last_name,
+        last_update = actor.last_update.strftime("%Y-%m-%d")
+    )
 
-def create_bridge_film_actor(sqlite_session, mysql_session):
+
+def category_dim_values(category, key_offset=0):
+    return dict(
+        category_key = surrogate_key("dim_category", category.category_id, key_offset),
+        category_id = category.category_id,
+        name = category.name,
+        last_update = category.last_update.strftime("%Y-%m-%d")
+    )
+
+
+def create_dim_actor(sqlite_session, mysql_session, key_offset=0):
+    actors = mysql_session.query(Actor).all()
+    return merge_changed_rows(sqlite_session, "dim_actor", [actor_dim_values(actor, key_offset) for actor in actors], key_offset)
+
+
+def create_dim_category(sqlite_session, mysql_session, key_offset=0):
+    categories = mysql_session.query(Category).all()
+    return merge_changed_rows(
+        sqlite_session, "dim_category", [category_dim_values(category, key_offset) for category in categories], key_offset
+    )
+
+
+def create_dim_store(sqlite_session, mysql_session, key_offset=0):
+    stores = store_dim_query(mysql_session).all()
+    written, _ = merge_scd_rows(
+        sqlite_session, "dim_store", [store_dim_values(store, city, country) for store, _, city, country in stores], key_offset
+    )
+    return written
+
+def create_dim_customer(sqlite_session, mysql_session, key_offset=0):
+    customers = customer_dim_query(mysql_session).all()
+    written, _ = merge_scd_rows(sqlite_session, "dim_customer", [
+        customer_dim_values(customer, city, country) for customer, _, city, country in customers
+    ], key_offset)
+    return written
+
+
+
+def create_bridge_film_actor(sqlite_session, mysql_session, key_offset=0):
     film_actors = mysql_session.query(FilmActor).all()
-    for film_actor in film_actors:
-        sqlite_session.merge(bridge_film_actor(
-            # these are the same formulas to determine the film_key from the dim_film table and the actor_key from dim_actor
-            film_key = film_actor.film_id*100 + 1,
-            actor_key = 50000 + film_actor.actor_id
-        ))
+    film_keys = film_version_keys(sqlite_session, key_offset)
+    for film_actor in track(film_actors, "bridge_film_actor"):
+        # every version of the film gets the link; a film not loaded yet gets its version 1 key
+        for film_key in film_keys.get(film_actor.film_id) or [surrogate_key("dim_film", film_actor.film_id, key_offset)]:
+            sqlite_session.merge(bridge_film_actor(
+                film_key = film_key,
+                actor_key = surrogate_key("dim_actor", film_actor.actor_id, key_offset)
+            ))
     sqlite_session.commit()
 
 
 
-def create_bridge_film_category(sqlite_session, mysql_session):
+def create_bridge_film_category(sqlite_session, mysql_session, key_offset=0):
     film_categories = mysql_session.query(FilmCategory).all()
-    for film_category in film_categories:
-        sqlite_session.merge(bridge_film_category(
-            film_key = film_category.film_id*100 + 1,
-            category_key = 30000 + film_category.category_id * 10 + 1
-        ))
+    film_keys = film_version_keys(sqlite_session, key_offset)
+    for film_category in track(film_categories, "bridge_film_category"):
+        for film_key in film_keys.get(film_category.film_id) or [surrogate_key("dim_film", film_category.film_id, key_offset)]:
+            sqlite_session.merge(bridge_film_category(
+                film_key = film_key,
+                category_key = surrogate_key("dim_category", film_category.category_id, key_offset)
+            ))
     sqlite_session.commit()
 
 
-def create_fact_rental(sqlite_session, mysql_session):
-    rentals = mysql_session.query(Rental, Inventory, Film).join(
+def rental_fact_values(rental, inventory, film, key_offset=0, key_map=None):
+    # everything but the surrogate key, which incremental loads may keep from the row already stored.
+    # key_map comes from fact_key_map and points the fact at the version of each dimension row valid when it was rented
+    return dict(
+        rental_id = rental.rental_id,
+        date_key_rented = to_date_key(rental.rental_date),
+        date_key_returned = to_date_key(rental.return_date) if rental.return_date is not None else None,
+        film_key = version_key_on(key_map, "film_key", film.film_id, rental.rental_date, key_offset),
+        store_key = version_key_on(key_map, "store_key", inventory.store_id, rental.rental_date, key_offset),
+        customer_key = version_key_on(key_map, "customer_key", rental.customer_id, rental.rental_date, key_offset),
+        staff_id = rental.staff_id,
+        rental_duration_days = (rental.return_date - rental.rental_date).days if rental.return_date is not None else None
+    )
+
+
+def payment_fact_values(payment, staff, key_offset=0, key_map=None):
+    return dict(
+        payment_id = payment.payment_id,
+        date_key_paid = to_date_key(payment.payment_date),
+        customer_key = version_key_on(key_map, "customer_key", payment.customer_id, payment.payment_date, key_offset),
+        store_key = version_key_on(key_map, "store_key", staff.store_id, payment.payment_date, key_offset),
+        staff_id = payment.staff_id,
+        amount = payment.amount
+    )
+
+
+def rental_fact_query(mysql_session):
+    return mysql_session.query(Rental, Inventory, Film).join(
         Inventory, Rental.inventory_id == Inventory.inventory_id).join(
-        Film, Film.film_id == Inventory.film_id).all()
-    for i, (rental, inventory, film) in enumerate(rentals, start=1):
+        Film, Film.film_id == Inventory.film_id)
+
+
+def payment_fact_query(mysql_session):
+    return mysql_session.query(Payment, Staff).join(Staff, Payment.staff_id == Staff.staff_id)
+
+
+def create_fact_rental(sqlite_session, mysql_session, key_offset=0):
+    rentals = rental_fact_query(mysql_session).order_by(Rental.rental_id).all()
+    key_map = fact_key_map(sqlite_session, key_offset)
+    for rental, inventory, film in track(rentals, "fact_rental"):
         sqlite_session.merge(fact_rental(
-            fact_rental_key = 50000 + i,
-            rental_id = rental.rental_id,
-            date_key_rented = rental.rental_date.strftime("%Y%m%d"),
-            date_key_returned = rental.return_date.strftime("%Y%m%d") if rental.return_date is not None else None,
-            film_key = film.film_id*100 + 1,
-            store_key = 1000 + inventory.store_id,
-            customer_key = rental.customer_id * 100 + 1,
-            staff_id = rental.staff_id,
-            rental_duration_days = (rental.return_date - rental.rental_date).days if rental.return_date is not None else None
+            fact_rental_key = surrogate_key("fact_rental", rental.rental_id, key_offset),
+            **rental_fact_values(rental, inventory, film, key_offset, key_map)
         ))
     sqlite_session.commit()
 
 
-def create_fact_payment(sqlite_session, mysql_session):
-    payments = mysql_session.query(Payment, Staff).join(
-        Staff, Payment.staff_id == Staff.staff_id
-    ).all()
-    for i, (payment, staff) in enumerate(payments, start=1):
+def create_fact_payment(sqlite_session, mysql_session, key_offset=0):
+    payments = payment_fact_query(mysql_session).order_by(Payment.payment_id).all()
+    key_map = fact_key_map(sqlite_session, key_offset)
+    for payment, staff in track(payments, "fact_payment"):
         sqlite_session.merge(fact_payment(
-            fact_payment_key = 80000 + i,
-            payment_id = payment.payment_id,
-            date_key_paid = payment.payment_date.strftime("%Y%m%d"),
-            customer_key = payment.customer_id * 100 + 1,
-            store_key = 1000 + staff.store_id,
-            staff_id = payment.staff_id,
-            amount = payment.amount
+            fact_payment_key = surrogate_key("fact_payment", payment.payment_id, key_offset),
+            **payment_fact_values(payment, staff, key_offset, key_map)
         ))
     sqlite_session.commit()
 
-def create_sync_state(sqlite_session):
+def create_sync_state(sqlite_session, source=None):
     current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     tables = ["dim_film", "dim_actor", "dim_category", "dim_store",
               "dim_customer", "fact_rental", "fact_payment"]
     for table_name in tables:
         sqlite_session.merge(sync_state(
-            table_name = table_name,
+            table_name = sync_state_name(table_name, source),
             last_update = current_time
         ))
     sqlite_session.commit()
@@ -0,0 +1,161 @@
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from pathlib import Path
+import json
+import re
+import threading
+import time
+
+
+# expanding IN lists render one placeholder per value, so the same query would otherwise show up once per list length
+PLACEHOLDER_LIST = re.compile(r"\bIN \((?:\?|%s|%\(\w+\)s)(?:\s*,\s*(?:\?|%s|%\(\w+\)s))*\)")
+EXPLAINED_STATEMENTS = ("SELECT", "WITH", "UPDATE", "DELETE")
+STATEMENT_PREVIEW_LENGTH = 160
+
+
+class StatementStats:
+    def __init__(self, engine_label, statement):
+        self.engine_label = engine_label
+        self.statement = statement
+        self.executions = 0
+        self.total_seconds = 0.0
+        self.plan = []
+        self.full_scans = []
+
+    def as_dict(self):
+        return {
+            "engine": self.engine_label,
+            "statement": self.statement,
+            "executions": self.executions,
+            "total_ms": round(self.total_seconds * 1000, 3),
+            "plan": self.plan,
+            "full_scans": self.full_scans,
+        }
+
+
+def normalize_statement(statement):
+    return PLACEHOLDER_LIST.sub("IN (...)", " ".join(statement.split()))
+
+
+def engine_label(engine):
+    database = engine.url.database
+    return f"{engine.dialect.name} {Path(database).name if database else 'memory'}"
+
+
+def is_sqlite_full_scan(detail):
+    # "SCAN film" reads the whole table, "SCAN film USING INDEX ..." walks an index and "SEARCH" seeks into one
+    words = detail.split()
+    return len(words) >= 2 and words[0] == "SCAN" and "USING" not in words and words[1] != "CONSTANT" and not words[1].startswith("(")
+
+
+def explain_sqlite(cursor, statement, parameters):
+    cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+    plan = [row[-1] for row in cursor.fetchall()]
+    return plan, [detail for detail in plan if is_sqlite_full_scan(detail)]
+
+
+def explain_mysql(cursor, statement, parameters):
+    # access type ALL is a full table scan in mysql's tabular EXPLAIN output
+    cursor.execute(f"EXPLAIN {statement}", parameters or None)
+    columns = [column[0] for column in cursor.description]
+    plan, full_scans = [], []
+    for row in cursor.fetchall():
+        step = dict(zip(columns, row))
+        detail = f"{step.get('table')} type={step.get('type')} key={step.get('key')} rows={step.get('rows')} {step.get('Extra') or ''}".strip()
+        plan.append(detail)
+        if step.get("type") == "ALL":
+            full_scans.append(detail)
+    return plan, full_scans
+
+
+EXPLAINERS = {"sqlite": explain_sqlite, "mysql": explain_mysql}
+
+
+class StatementCapture:
+    '''
+    listens on every engine in the process and records each distinct statement the loaders send: how often it ran,
+    how long it took in total and the plan the database chose for it. A statement is explained once, the first time
+    it is seen, on the same DBAPI connection and with the same parameters, so TEMP views and attached partitions
+    resolve exactly as they do for the statement itself. The EXPLAIN goes through a raw cursor and is not captured.
+    '''
+    def __init__(self):
+        self.statements = {}
+        self.lock = threading.Lock()
+
+    def install(self):
+        event.listen(Engine, "before_cursor_execute", self.before_execute)
+        event.listen(Engine, "after_cursor_execute", self.after_execute)
+        return self
+
+    def remove(self):
+        event.remove(Engine, "before_cursor_execute", self.before_execute)
+        event.remove(Engine, "after_cursor_execute", self.after_execute)
+
+    def before_execute(self, connection, cursor, statement, parameters, context, executemany):
+        key = (engine_label(connection.engine), normalize_statement(statement))
+        with self.lock:
+            stats = self.statements.get(key)
+            if stats is None:
+                stats = self.statements[key] = StatementStats(*key)
+                new_statement = True
+            else:
+                new_statement = False
+        if new_statement:
+            self.explain(connection, stats, statement, parameters[0] if executemany and parameters else parameters)
+        # kept on the execution context, so a statement that raises leaves nothing behind
+        context.statement_capture = (stats, time.perf_counter())
+
+    def after_execute(self, connection, cursor, statement, parameters, context, executemany):
+        stats, started = context.statement_capture
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            stats.executions += 1
+            stats.total_seconds += elapsed
+
+    def explain(self, connection, stats, statement, parameters):
+        explainer = EXPLAINERS.get(connection.dialect.name)
+        if explainer is None or not statement.lstrip().upper().startswith(EXPLAINED_STATEMENTS):
+            return
+        cursor = connection.connection.dbapi_connection.cursor()
+        try:
+            stats.plan, stats.full_scans = explainer(cursor, statement, parameters)
+        except Exception as e:
+            stats.plan = [f"EXPLAIN failed: {e}"]
+        finally:
+            cursor.close()
+
+    def ranked(self):
+        '''statements ordered by total time, the hottest first'''
+        with self.lock:
+            return sorted(self.statements.values(), key=lambda stats: stats.total_seconds, reverse=True)
+
+    def full_scans(self):
+        return [stats for stats in self.ranked() if stats.full_scans]
+
+
+def install_statement_capture():
+    return StatementCapture().install()
+
+
+def print_statement_report(capture, limit=20):
+    ranked = capture.ranked()
+    print(f"statement capture: {len(ranked)} distinct statements, {sum(stats.executions for stats in ranked)} executions")
+    for stats in ranked[:limit]:
+        flag = "FULL SCAN " if stats.full_scans else ""
+        print(f"{flag}{stats.engine_label}: {stats.executions}x {stats.total_seconds * 1000:.1f} ms "
+              f"{stats.statement[:STATEMENT_PREVIEW_LENGTH]}")
+        for detail in stats.plan:
+            print(f"    {detail}")
+    full_scans = capture.full_scans()
+    if full_scans:
+        print(f"{len(full_scans)} statements scan a whole table:")
+        for stats in full_scans:
+            print(f"    {stats.engine_label}: {', '.join(stats.full_scans)} in {stats.statement[:STATEMENT_PREVIEW_LENGTH]}")
+    else:
+        print("no statement scans a whole table")
+
+
+def write_statement_report(capture, path):
+    with open(path, "w") as report:
+        json.dump([stats.as_dict() for stats in capture.ranked()], report, indent=2)
+    print(f"statement report written to {path}")
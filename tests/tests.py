@@ -1,8 +1,37 @@
 import pytest
 
-from sqlalchemy import inspect
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError
+from datetime import timedelta
+import json
+import sys
+import threading
+import urllib.request
 from main import *
 from sakila_helper_classes import *
+from query_helper_functions import *
+from index_helper_functions import *
+from partition_helper_functions import *
+from changelog_helper_functions import *
+from reconcile_helper_functions import *
+from planner_helper_functions import *
+from source_helper_functions import *
+from shard_helper_functions import *
+from optimize_helper_functions import *
+from shadow_helper_functions import *
+from scd_helper_functions import *
+from sqlite_helper_functions import *
+from incremental_helper_functions import *
+from migration_helper_functions import *
+from server_helper_functions import *
+from key_helper_functions import *
+from statement_helper_functions import *
+from progress_helper_functions import *
+from benchmark_helper_functions import *
+from backend_helper_functions import *
+from transaction_helper_functions import *
+from integrity_helper_functions import *
+from lease_helper_functions import *
 
 #declare path constants to allow the tests to run properly
 PROJECT_DIR = Path(__file__).resolve().parent.parent
@@ -83,7 +112,8 @@ class TestInit:
         inspector = inspect(sqlite_engine)
         columns = [col["name"] for col in inspector.get_columns("dim_film")]
         expected = ["film_key", "film_id", "title", "rating", "length",
-                    "language", "release_year", "last_update"]
+                    "language", "release_year", "last_update",
+                    "effective_date", "expiry_date", "is_current", "row_hash"]
         for col in expected:
             assert col in columns, f"dim_film should have column '{col}'"
 
@@ -185,10 +215,11 @@ class TestFullLoad:
 
     #data quality tests
     def test_dim_date_key_format(self, sqlite_session):
-        """date_key should be 8-char YYYYMMDD"""
+        """date_key should be an integer YYYYMMDD"""
         dates = sqlite_session.query(dim_date).all()
         for date in dates:
-            assert len(date.date_key) == 8, f"date_key '{d.date_key}' should be 8 chars"
+            assert isinstance(date.date_key, int), f"date_key '{date.date_key}' should be an integer"
+            assert len(str(date.date_key)) == 8, f"date_key '{date.date_key}' should be 8 digits"
 
     def test_dim_date_date_format(self, sqlite_session):
         """date should be YYYY-MM-DD"""
@@ -201,7 +232,7 @@ class TestFullLoad:
         '''is_weekend should be 1 for Saturday/Sunday, 0 otherwise'''
         dates = sqlite_session.query(dim_date).all()
         for date in dates:
-            parsed = datetime.strptime(date.date_key, "%Y%m%d")
+            parsed = datetime.strptime(str(date.date_key), "%Y%m%d")
             expected = 1 if parsed.isoweekday() >= 6 else 0
             assert date.is_weekend == expected, \
                 f"is_weekend for {date.date} should be {expected}, got {date.is_weekend}"
@@ -210,13 +241,13 @@ class TestFullLoad:
         '''quarter should be 1, 2, 3, or 4'''
         dates = sqlite_session.query(dim_date).all()
         for date in dates:
-            assert date.quarter in ("1", "2", "3", "4"), \
+            assert date.quarter in (1, 2, 3, 4), \
                 f"quarter should be 1-4, got {date.quarter}"
 
     #row counts match
     def test_film_count_matches_mysql(self, sqlite_session, mysql_session):
         '''confirm dim_film row count matches mysql film source'''
-        sqlite_count = sqlite_session.query(dim_film).count()
+        sqlite_count = sqlite_session.query(dim_film).filter(current_version_filter(dim_film)).count()
         mysql_count = mysql_session.query(Film).count()
         assert sqlite_count == mysql_count, \
             f"Film counts differ: SQLite={sqlite_count}, MySQL={mysql_count}"
@@ -235,13 +266,13 @@ class TestFullLoad:
 
     def test_store_count_matches_mysql(self, sqlite_session, mysql_session):
         '''confirm dim_store row count matches mysql store source'''
-        sqlite_count = sqlite_session.query(dim_store).count()
+        sqlite_count = sqlite_session.query(dim_store).filter(current_version_filter(dim_store)).count()
         mysql_count = mysql_session.query(Store).count()
         assert sqlite_count == mysql_count
 
     def test_customer_count_matches_mysql(self, sqlite_session, mysql_session):
         '''confirm dim_customer row count matches mysql customer source'''
-        sqlite_count = sqlite_session.query(dim_customer).count()
+        sqlite_count = sqlite_session.query(dim_customer).filter(current_version_filter(dim_customer)).count()
         mysql_count = mysql_session.query(Customer).count()
         assert sqlite_count == mysql_count
 
@@ -259,13 +290,13 @@ class TestFullLoad:
 
     def test_bridge_film_actor_count_matches_mysql(self, sqlite_session, mysql_session):
         '''confirm bridge_film_actor row count matches mysql film_actor source'''
-        sqlite_count = sqlite_session.query(bridge_film_actor).count()
+        sqlite_count = sqlite_session.query(bridge_film_actor).filter(current_version_filter(bridge_film_actor)).count()
         mysql_count = mysql_session.query(FilmActor).count()
         assert sqlite_count == mysql_count
 
     def test_bridge_film_category_count_matches_mysql(self, sqlite_session, mysql_session):
         '''confirm bridge_film_category row count matches mysql film_category source'''
-        sqlite_count = sqlite_session.query(bridge_film_category).count()
+        sqlite_count = sqlite_session.query(bridge_film_category).filter(current_version_filter(bridge_film_category)).count()
         mysql_count = mysql_session.query(FilmCategory).count()
         assert sqlite_count == mysql_count
 
@@ -477,3 +508,1175 @@ class TestValidate:
         # dim_film and dim_date have different row counts, so this should be False
         result = validate_table(sqlite_session, dim_film, sqlite_session, dim_date)
         assert result is False
+
+
+#tests for the cached query api
+class TestQueries:
+    def test_revenue_by_period_matches_payment_total(self, sqlite_session):
+        '''monthly revenue should add up to the total of fact_payment'''
+        rows = revenue_by_period(sqlite_session, "month", cache=QueryCache())
+        total = sqlite_session.query(func.sum(fact_payment.amount)).scalar()
+        assert round(sum(row.revenue for row in rows), 2) == round(total, 2)
+
+    def test_top_films_respects_limit(self, sqlite_session):
+        '''top_films should return at most limit rows, busiest film first'''
+        rows = top_films(sqlite_session, limit=5, cache=QueryCache())
+        assert 0 < len(rows) <= 5
+        assert rows == sorted(rows, key=lambda row: row.rentals, reverse=True)
+
+    def test_rentals_by_category_populated(self, sqlite_session):
+        '''every category row should carry a positive rental count'''
+        rows = rentals_by_category(sqlite_session, cache=QueryCache())
+        assert len(rows) > 0
+        assert all(row.rentals > 0 for row in rows)
+
+    def test_repeated_query_served_from_cache(self, sqlite_session):
+        '''a second identical query between syncs should be a cache hit'''
+        cache = QueryCache()
+        first = top_films(sqlite_session, limit=3, cache=cache)
+        second = top_films(sqlite_session, limit=3, cache=cache)
+        assert first == second
+        assert cache.hits == 1 and cache.misses == 1
+
+    def test_cache_invalidated_when_watermark_moves(self, sqlite_session):
+        '''moving the fact_payment watermark should force a recompute'''
+        cache = QueryCache()
+        revenue_by_period(sqlite_session, "year", cache=cache)
+        sqlite_session.merge(sync_state(table_name="fact_payment", last_update="2999-01-01 00:00:00"))
+        try:
+            revenue_by_period(sqlite_session, "year", cache=cache)
+        finally:
+            sqlite_session.rollback()
+        assert cache.misses == 2
+
+    def test_cache_evicts_least_recently_used(self, sqlite_session):
+        '''the cache should never grow past maxsize'''
+        cache = QueryCache(maxsize=2)
+        for limit in (1, 2, 3):
+            top_films(sqlite_session, limit=limit, cache=cache)
+        assert len(cache) == 2
+
+    def test_returned_rental_changes_cached_revenue(self, scd_sessions):
+        '''a rental returned through the change log with a late fee on its payment should change the cached revenue'''
+        warehouse_session, source_session = scd_sessions
+        source_session.add(Rental(rental_id=1, rental_date=datetime(2006, 2, 1), inventory_id=1, customer_id=1, staff_id=1))
+        source_session.add(Payment(payment_id=1, payment_date=datetime(2006, 2, 1), customer_id=1, staff_id=1, amount=2.99, rental_id=1))
+        source_session.commit()
+        create_fact_rental(warehouse_session, source_session)
+        create_fact_payment(warehouse_session, source_session)
+        create_dim_date(warehouse_session, source_session)
+        cache = QueryCache()
+        assert revenue_by_period(warehouse_session, "month", cache=cache) == [RevenueRow("2006-02", 2.99)]
+
+        source_session.query(Rental).filter_by(rental_id=1).update({"return_date": datetime(2006, 2, 9)})
+        source_session.query(Payment).filter_by(payment_id=1).update({"amount": 4.99})
+        source_session.commit()
+        apply_table_changes(warehouse_session, source_session, "rental", increment_fact_rental, {1: "U"})
+        apply_table_changes(warehouse_session, source_session, "payment", increment_fact_payment, {1: "U"})
+        assert revenue_by_period(warehouse_session, "month", cache=cache) == [RevenueRow("2006-02", 4.99)]
+
+    def test_open_rental_refresh_invalidates_cache(self, scd_sessions):
+        '''returning rentals moves no watermark, the rental queries should still be recomputed afterwards'''
+        warehouse_session, source_session = scd_sessions
+        source_session.add(Rental(rental_id=1, rental_date=datetime(2006, 2, 1), inventory_id=1, customer_id=1, staff_id=1))
+        source_session.commit()
+        create_fact_rental(warehouse_session, source_session)
+        cache = QueryCache()
+        top_films(warehouse_session, cache=cache)
+        source_session.query(Rental).filter_by(rental_id=1).update({"return_date": datetime(2006, 2, 9)})
+        source_session.commit()
+        assert refresh_open_rentals(warehouse_session, source_session) == 1
+        top_films(warehouse_session, cache=cache)
+        assert cache.misses == 2
+
+    def test_bridge_rebuild_changes_cached_categories(self, scd_sessions):
+        '''moving a film to another category should change the cached rentals by category'''
+        warehouse_session, source_session = scd_sessions
+        source_session.add_all([Category(category_id=1, name="Action", last_update=datetime(2006, 2, 15)),
+                                Category(category_id=2, name="Drama", last_update=datetime(2006, 2, 15))])
+        source_session.add(Rental(rental_id=1, rental_date=datetime(2006, 2, 1), inventory_id=1, customer_id=1, staff_id=1))
+        source_session.commit()
+        create_dim_category(warehouse_session, source_session)
+        create_fact_rental(warehouse_session, source_session)
+        cache = QueryCache()
+        assert rentals_by_category(warehouse_session, cache=cache) == [CategoryRentalsRow("Action", 1)]
+
+        source_session.query(FilmCategory).filter_by(film_id=1).update({"category_id": 2})
+        source_session.commit()
+        increment_bridge_film_category(warehouse_session, source_session, [1])
+        assert rentals_by_category(warehouse_session, cache=cache) == [CategoryRentalsRow("Drama", 1)]
+
+
+#tests for index management
+class TestIndexes:
+    def test_declared_indexes_exist(self, sqlite_engine):
+        '''every index declared on the warehouse models should exist in the database'''
+        # PRAGMA index_list rather than the inspector, which skips expression indexes
+        with sqlite_engine.connect() as connection:
+            for index in warehouse_indexes():
+                names = [row[1] for row in connection.exec_driver_sql(f"PRAGMA index_list({index.table.name})")]
+                assert index.name in names, f"index '{index.name}' should exist on {index.table.name}"
+
+    def test_natural_keys_unique_indexed(self, sqlite_engine):
+        '''rental_id and payment_id should be unique per source, through a unique index with the key block'''
+        with sqlite_engine.connect() as connection:
+            for table, column in (("fact_rental", "rental_id"), ("fact_payment", "payment_id")):
+                unique_keys = [
+                    [row[2] for row in connection.exec_driver_sql(f"PRAGMA index_xinfo({index[1]})") if row[5]]
+                    for index in connection.exec_driver_sql(f"PRAGMA index_list({table})") if index[2]
+                ]
+                # the key block is an expression, which index_xinfo reports without a column name
+                assert [column, None] in unique_keys, f"{table}.{column} should be unique indexed per source"
+
+    def test_new_store_version_cannot_duplicate_rental(self):
+        '''a rental reloaded with a newer store_key should collide with its old row, but not with another source'''
+        engine = create_engine("sqlite://", echo=False)
+        Base.metadata.create_all(engine, tables=[fact_rental.__table__])
+        row = dict(rental_id=1, film_key=101, customer_key=20001, staff_id=1)
+        with engine.begin() as connection:
+            connection.execute(insert(fact_rental), [dict(row, fact_rental_key=50001, store_key=10001),
+                                                     dict(row, fact_rental_key=SOURCE_KEY_STRIDE + 50001, store_key=10001)])
+        with pytest.raises(IntegrityError):
+            with engine.begin() as connection:
+                connection.execute(insert(fact_rental), [dict(row, fact_rental_key=50002, store_key=10002)])
+
+    def test_star_queries_use_indexes(self, sqlite_engine):
+        '''no representative star join should fall back to a full fact table scan'''
+        plans_ok, failed_queries = verify_star_query_plans(sqlite_engine)
+        assert plans_ok is True, f"star queries scanning a fact table: {failed_queries}"
+
+
+#tests for time-partitioned fact storage
+@pytest.fixture()
+def rental_warehouse(scd_sessions, tmp_path):
+    '''a warehouse file, so partitions can be written next to it, and the in-memory sakila stand-in'''
+    _, source_session = scd_sessions
+    engine = create_engine(f"sqlite:///{tmp_path / 'warehouse.db'}", echo=False)
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)(), source_session, str(tmp_path / "warehouse")
+
+
+def partitioned_rental_ids(db_name):
+    partitioned_session = create_partitioned_session(db_name)
+    try:
+        return sorted(rental_id for rental_id, in partitioned_session.query(fact_rental.rental_id))
+    finally:
+        partitioned_session.close()
+
+
+class TestPartitions:
+    def test_partition_for_date_key(self):
+        '''date keys should map onto yearly and monthly partitions'''
+        assert partition_for_date_key(20050524, "year") == 2005
+        assert partition_for_date_key(20050524, "month") == 200505
+
+    def test_partition_bounds_cover_period(self):
+        '''partition bounds should span the whole year or month'''
+        assert partition_bounds(2005) == (20050101, 20051231)
+        assert partition_bounds(200505) == (20050501, 20050531)
+
+    def test_partitioned_session_sees_all_facts(self, sqlite_session, mysql_session):
+        '''the union views should expose every fact row whether or not it has been partitioned'''
+        partitioned_session = create_partitioned_session(DB_PATH)
+        try:
+            assert partitioned_session.query(fact_rental).count() == mysql_session.query(Rental).count()
+            assert partitioned_session.query(fact_payment).count() == mysql_session.query(Payment).count()
+        finally:
+            partitioned_session.close()
+
+    def test_open_rentals_stay_and_deletes_reach_partitions(self, rental_warehouse):
+        '''open rentals should stay in main, and rows deleted in sakila should go from the partitions too'''
+        warehouse_session, source_session, db_name = rental_warehouse
+        for rental_id, year, returned in ((1, 2004, True), (2, 2004, False), (3, 2005, True), (4, 2006, True)):
+            source_session.add(Rental(rental_id=rental_id, rental_date=datetime(year, 2, 1), inventory_id=1, customer_id=1,
+                                      staff_id=1, return_date=datetime(year, 2, 2) if returned else None))
+        source_session.commit()
+        create_fact_rental(warehouse_session, source_session)
+        partition_fact_tables(warehouse_session.get_bind(), db_name)
+        assert sorted(rental_id for rental_id, in warehouse_session.query(fact_rental.rental_id)) == [2, 4]
+
+        source_session.query(Rental).filter_by(rental_id=1).delete()
+        source_session.commit()
+        assert reconcile_deletes(warehouse_session, source_session)["fact_rental"] == 1
+        assert partitioned_rental_ids(db_name) == [2, 3, 4]
+        source_session.query(Rental).filter_by(rental_id=3).delete()
+        source_session.commit()
+        apply_table_changes(warehouse_session, source_session, "rental", increment_fact_rental, {3: "D"})
+        assert partitioned_rental_ids(db_name) == [2, 4]
+        assert is_frozen(partition_path(db_name, 2004))
+
+    def test_monthly_partitions_past_attach_limit(self, rental_warehouse):
+        '''more monthly partitions than sqlite can attach should still all be readable through the views'''
+        warehouse_session, source_session, db_name = rental_warehouse
+        for rental_id in range(1, 15):
+            rental_date = datetime(2005 + rental_id // 12, rental_id % 12 + 1, 1)
+            source_session.add(Rental(rental_id=rental_id, rental_date=rental_date, return_date=rental_date + timedelta(days=1),
+                                      inventory_id=1, customer_id=1, staff_id=1))
+        source_session.commit()
+        create_fact_rental(warehouse_session, source_session)
+        partition_fact_tables(warehouse_session.get_bind(), db_name, "month")
+        assert len(list_partitions(db_name)) == MAX_ATTACHED_PARTITIONS
+        assert archived_partitions(db_name) == {200502, 200503, 200504, 200505}
+        assert not partition_path(db_name, 200502).exists() and is_frozen(partition_path(db_name, ARCHIVE_PARTITION))
+        assert partitioned_rental_ids(db_name) == list(range(1, 15))
+
+    def test_full_load_swap_never_doubles_partitioned_facts(self, rental_warehouse, monkeypatch):
+        '''a connection opened right after a Full-load swap should not see the old partitions next to the new file'''
+        warehouse_session, source_session, db_name = rental_warehouse
+        for rental_id, year in ((1, 2004), (2, 2005)):
+            source_session.add(Rental(rental_id=rental_id, rental_date=datetime(year, 2, 1), return_date=datetime(year, 2, 2),
+                                      inventory_id=1, customer_id=1, staff_id=1))
+        source_session.commit()
+        create_fact_rental(warehouse_session, source_session)
+        partition_fact_tables(warehouse_session.get_bind(), db_name)
+        warehouse_session.close()
+        seen = []
+
+        def swap_then_read(*args):
+            swap_in_shadow(*args)
+            seen.append(partitioned_rental_ids(db_name))
+
+        monkeypatch.setattr("shadow_helper_functions.swap_in_shadow", swap_then_read)
+        try:
+            shadow_full_load(warehouse_session.get_bind(), db_name, [(SakilaSource("sakila", None, 0), source_session.get_bind())])
+        finally:
+            set_progress_source(None)
+        assert seen == [[1, 2]] and not partition_files(db_name)
+
+    def test_pooled_readers_attach_partitions_made_later(self, rental_warehouse):
+        '''a read pool opened before Partition ran should attach the partitions on its next checkout'''
+        warehouse_session, source_session, db_name = rental_warehouse
+        for rental_id, year in ((1, 2004), (2, 2005)):
+            source_session.add(Rental(rental_id=rental_id, rental_date=datetime(year, 2, 1), return_date=datetime(year, 2, 2),
+                                      inventory_id=1, customer_id=1, staff_id=1))
+        source_session.commit()
+        create_fact_rental(warehouse_session, source_session)
+        engine = create_read_engine(db_name, pool_size=1)
+        with engine.connect() as connection:
+            assert connection.execute(text("SELECT COUNT(*) FROM fact_rental")).scalar() == 2
+        partition_fact_tables(warehouse_session.get_bind(), db_name)
+        with engine.connect() as connection:
+            assert connection.execute(text("SELECT COUNT(*) FROM fact_rental")).scalar() == 2
+            assert connection.execute(text("SELECT COUNT(*) FROM main.fact_rental")).scalar() == 1
+        engine.dispose()
+
+    def test_payment_amounts_validate_over_partitions(self, rental_warehouse):
+        '''payment totals read through the partition views should still match sakila'''
+        warehouse_session, source_session, db_name = rental_warehouse
+        for payment_id, amount in ((1, 0.99), (2, 0.99), (3, 0.2)):
+            source_session.add(Payment(payment_id=payment_id, payment_date=datetime(2003 + payment_id, 1, 1), amount=amount,
+                                       customer_id=1, staff_id=1, rental_id=payment_id))
+            warehouse_session.add(fact_payment(fact_payment_key=80000 + payment_id, payment_id=payment_id, amount=amount,
+                                               date_key_paid=(2003 + payment_id) * 10000 + 101, customer_key=1, store_key=1, staff_id=1))
+        source_session.commit()
+        warehouse_session.commit()
+        partition_fact_tables(warehouse_session.get_bind(), db_name)
+        partitioned_session = create_partitioned_session(db_name)
+        try:
+            assert validate_payment_amounts(partitioned_session, source_session)[0]
+        finally:
+            partitioned_session.close()
+
+
+#tests for trigger based change capture, run against an in-memory sqlite stand-in for sakila
+@pytest.fixture()
+def standin_mysql_engine():
+    engine = create_engine("sqlite://", echo=False)
+    SakilaBase.metadata.create_all(engine)
+    install_change_log(engine)
+    return engine
+
+
+class TestChangeLog:
+    def test_trigger_ddl_per_dialect(self):
+        '''one trigger per insert/update/delete should be generated for mysql and sqlite'''
+        for dialect_name in ("mysql", "sqlite"):
+            statements = change_log_trigger_ddl(dialect_name, "film", "film_id")
+            assert len(statements) == 3
+            assert all("etl_change_log" in statement for statement in statements)
+
+    def test_changes_captured_and_collapsed(self, standin_mysql_engine):
+        '''the last operation per row should win when the change log is read'''
+        session = sessionmaker(bind=standin_mysql_engine)()
+        session.add(Actor(actor_id=1, first_name="A", last_name="B", last_update=datetime(2006, 1, 1)))
+        session.add(Actor(actor_id=2, first_name="C", last_name="D", last_update=datetime(2006, 1, 1)))
+        session.commit()
+        session.query(Actor).filter_by(actor_id=2).delete()
+        session.commit()
+        change_ids, changes, logged_at = read_change_log(session)
+        assert change_ids == [1, 2, 3]
+        assert changes == {"actor": {1: "I", 2: "D"}}
+        assert logged_at.year >= 2024
+
+    def test_truncate_keeps_unread_changes(self, standin_mysql_engine):
+        '''truncating should only remove the changes that were consumed'''
+        session = sessionmaker(bind=standin_mysql_engine)()
+        session.add(Category(category_id=1, name="Action", last_update=datetime(2006, 1, 1)))
+        session.commit()
+        change_ids, _, _ = read_change_log(session)
+        session.add(Category(category_id=2, name="Drama", last_update=datetime(2006, 1, 1)))
+        session.commit()
+        truncate_change_log(session, change_ids)
+        assert read_change_log(session)[1] == {"category": {2: "I"}}
+
+    def test_truncate_keeps_late_lower_ids(self, standin_mysql_engine):
+        '''a change committed after the read with a lower change_id than one that was read should be kept'''
+        session = sessionmaker(bind=standin_mysql_engine)()
+        session.add(Category(category_id=1, name="Action", last_update=datetime(2006, 1, 1)))
+        session.commit()
+        session.execute(text("UPDATE etl_change_log SET change_id = 5"))
+        session.commit()
+        change_ids, _, _ = read_change_log(session)
+        session.execute(text("INSERT INTO etl_change_log (change_id, table_name, row_id, operation) VALUES (4, 'category', 2, 'I')"))
+        session.commit()
+        truncate_change_log(session, change_ids)
+        assert read_change_log(session)[:2] == ([4], {"category": {2: "I"}})
+
+    def test_watermark_from_business_dates_of_changed_rows(self, standin_mysql_engine):
+        '''a change log watermark should be the latest date of the upserted rows, not when they were logged'''
+        session = sessionmaker(bind=standin_mysql_engine)()
+        session.add_all([Rental(rental_id=rental_id, rental_date=datetime(2005, 5, rental_id), inventory_id=1, customer_id=1,
+                                staff_id=1) for rental_id in (1, 2, 3)])
+        session.commit()
+        _, changes, _ = read_change_log(session)
+        assert changed_rows_watermark(session, Rental.rental_date, {**changes["rental"], 3: "D"}) == datetime(2005, 5, 2)
+
+    def test_reinstall_adds_changed_at(self):
+        '''reinstalling over a change log created before changed_at was logged should add it and keep the old rows'''
+        engine = create_engine("sqlite://", echo=False)
+        SakilaBase.metadata.create_all(engine, tables=[table for table in SakilaBase.metadata.sorted_tables
+                                                       if table is not ChangeLog.__table__])
+        with engine.begin() as connection:
+            connection.execute(text("CREATE TABLE etl_change_log (change_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                    "table_name VARCHAR(30), row_id INTEGER, operation VARCHAR(1))"))
+            connection.execute(text("INSERT INTO etl_change_log (table_name, row_id, operation) VALUES ('category', 1, 'U')"))
+        install_change_log(engine)
+        session = sessionmaker(bind=engine)()
+        assert read_change_log(session)[1:] == ({"category": {1: "U"}}, None)
+        session.add(Category(category_id=2, name="Drama", last_update=datetime(2006, 1, 1)))
+        session.commit()
+        assert read_change_log(session)[2] is not None
+
+
+#tests for chunked delete reconciliation, using in-memory sqlite on both sides
+@pytest.fixture()
+def reconcile_sessions():
+    source_engine = create_engine("sqlite://", echo=False)
+    SakilaBase.metadata.create_all(source_engine)
+    warehouse_engine = create_engine("sqlite://", echo=False)
+    Base.metadata.create_all(warehouse_engine)
+    source_session = sessionmaker(bind=source_engine)()
+    warehouse_session = sessionmaker(bind=warehouse_engine)()
+    for actor_id in range(1, 2501):
+        source_session.add(Actor(actor_id=actor_id, first_name="A", last_name="B", last_update=datetime(2006, 1, 1)))
+        warehouse_session.add(dim_actor(actor_key=50000 + actor_id, actor_id=actor_id, first_name="A",
+                                        last_name="B", last_update="2006-01-01", row_hash=""))
+    source_session.commit()
+    warehouse_session.commit()
+    return warehouse_session, source_session
+
+
+class TestReconcile:
+    def test_matching_chunks_have_matching_digests(self, reconcile_sessions):
+        '''identical key sets should produce identical chunk digests'''
+        warehouse_session, source_session = reconcile_sessions
+        assert chunk_digests(warehouse_session, dim_actor.actor_id) == chunk_digests(source_session, Actor.actor_id)
+
+    def test_digests_tell_equal_sums_apart(self, reconcile_sessions):
+        '''key sets with the same count, sum and sum of squares should still get different digests'''
+        warehouse_session, _ = reconcile_sessions
+        digests = [
+            chunk_digests(warehouse_session, dim_actor.actor_id, scope=dim_actor.actor_id.in_(keys))[0]
+            for keys in ([1, 5, 6], [2, 3, 7])
+        ]
+        assert digests[0][0] == digests[1][0] and digests[0] != digests[1]
+        assert digests[0][1] == sum(key_hash(key) for key in (1, 5, 6))
+
+    def test_delete_hidden_by_insert_found_once_loaded(self, reconcile_sessions):
+        '''a delete next to an insert that is not loaded yet should be found once the insert is loaded'''
+        warehouse_session, source_session = reconcile_sessions
+        source_session.query(Actor).filter_by(actor_id=3).delete()
+        source_session.add(Actor(actor_id=2501, first_name="A", last_name="B", last_update=datetime(2006, 1, 1)))
+        source_session.commit()
+        assert find_deleted_keys(warehouse_session, source_session, Actor.actor_id, dim_actor.actor_id) == []
+        warehouse_session.add(dim_actor(actor_key=52501, actor_id=2501, first_name="A", last_name="B",
+                                        last_update="2006-01-01", row_hash=""))
+        warehouse_session.commit()
+        assert find_deleted_keys(warehouse_session, source_session, Actor.actor_id, dim_actor.actor_id) == [3]
+
+    def test_deleted_source_rows_removed(self, reconcile_sessions):
+        '''rows deleted in sakila should be found and deleted from the warehouse'''
+        warehouse_session, source_session = reconcile_sessions
+        source_session.query(Actor).filter(Actor.actor_id.in_([3, 1500, 2500])).delete()
+        source_session.commit()
+        counts = reconcile_deletes(warehouse_session, source_session)
+        assert counts["dim_actor"] == 3
+        assert warehouse_session.query(dim_actor).count() == 2497
+
+    def test_new_source_rows_not_deleted(self, reconcile_sessions):
+        '''rows only present in sakila are left for the incremental load'''
+        warehouse_session, source_session = reconcile_sessions
+        source_session.add(Actor(actor_id=2501, first_name="A", last_name="B", last_update=datetime(2006, 1, 1)))
+        source_session.commit()
+        assert find_deleted_keys(warehouse_session, source_session, Actor.actor_id, dim_actor.actor_id) == []
+
+
+#tests for the daemon's adaptive interval
+class TestDaemon:
+    def test_quiet_cycles_back_off(self):
+        '''an idle cycle should double the interval up to the maximum'''
+        assert next_sync_interval(10, 0, 5, 300) == 20
+        assert next_sync_interval(200, 0, 5, 300) == 300
+
+    def test_busy_cycles_speed_up(self):
+        '''a cycle with changes should halve the interval down to the minimum'''
+        assert next_sync_interval(40, 10, 5, 300) == 20
+        assert next_sync_interval(6, 10, 5, 300) == 5
+
+    def test_write_burst_resets_interval(self):
+        '''a write burst should go straight back to the minimum interval'''
+        assert next_sync_interval(300, 5000, 5, 300) == 5
+
+
+#tests for the incremental strategy planner, using in-memory sqlite on both sides
+class TestPlanner:
+    def test_plan_strategy_follows_delta_size(self, reconcile_sessions):
+        '''no changes should skip, a small delta should merge and a large one should reload'''
+        warehouse_session, source_session = reconcile_sessions
+        source_session.query(Actor).filter(Actor.actor_id <= 100).update({"last_update": datetime(2007, 1, 1)})
+        source_session.commit()
+
+        plan_cases = [("2008-01-01 00:00:00", "skip"), ("2006-06-01 00:00:00", "incremental"), ("2005-01-01 00:00:00", "reload")]
+        for last_update, strategy in plan_cases:
+            warehouse_session.merge(sync_state(table_name="dim_actor", last_update=last_update))
+            warehouse_session.commit()
+            plan = plan_table(warehouse_session, source_session, "dim_actor", Actor, Actor.last_update)
+            assert plan.strategy == strategy, f"{last_update} should plan {strategy}, got {plan.strategy}"
+
+    def test_reload_disallowed_falls_back_to_incremental(self, reconcile_sessions):
+        '''a table that may not be reloaded should always be merged'''
+        warehouse_session, source_session = reconcile_sessions
+        plan = plan_table(warehouse_session, source_session, "dim_actor", Actor, Actor.last_update, allow_reload=False)
+        assert plan.strategy == "incremental"
+        assert plan.delta_rows == 2500
+
+
+#tests for multi-source consolidation, using in-memory sqlite on both sides
+class TestSources:
+    def test_source_spec_parsed(self):
+        '''NAME=URL specs should split on the first = and reject bad names'''
+        assert parse_source_spec("emea=mysql+pymysql://u:p@host/sakila?x=1") == ("emea", "mysql+pymysql://u:p@host/sakila?x=1")
+        with pytest.raises(ValueError):
+            parse_source_spec("no-url")
+        with pytest.raises(ValueError):
+            parse_source_spec("bad name=sqlite://")
+
+    def test_source_indexes_are_stable(self, reconcile_sessions):
+        '''a source should keep its key offset however the sources are listed'''
+        warehouse_session, _ = reconcile_sessions
+        first = register_sources(warehouse_session, [("east", "sqlite://"), ("west", "sqlite://")])
+        second = register_sources(warehouse_session, [("north", "sqlite://"), ("west", "sqlite://"), ("east", "sqlite://")])
+        assert [(source.name, source.key_offset) for source in first] == [("east", 0), ("west", SOURCE_KEY_STRIDE)]
+        assert {source.name: source.index for source in second} == {"north": 2, "west": 1, "east": 0}
+
+    def test_sync_state_names_per_source(self):
+        '''the first source keeps the plain table names, later ones get their own watermark rows'''
+        assert sync_state_name("fact_rental", SakilaSource("east", "sqlite://", 0)) == "fact_rental"
+        assert sync_state_name("fact_rental", SakilaSource("west", "sqlite://", 1)) == "fact_rental@west"
+
+    def test_deletes_stay_inside_source_range(self, reconcile_sessions):
+        '''reconciling one source should never delete another source's rows with the same natural id'''
+        warehouse_session, source_session = reconcile_sessions
+        warehouse_session.add(dim_actor(actor_key=SOURCE_KEY_STRIDE + 50001, actor_id=1, first_name="A",
+                                        last_name="B", last_update="2006-01-01", row_hash=""))
+        warehouse_session.commit()
+        source_session.query(Actor).filter(Actor.actor_id == 1).delete()
+        source_session.commit()
+        assert reconcile_deletes(warehouse_session, source_session)["dim_actor"] == 1
+        assert warehouse_session.query(dim_actor).filter_by(actor_id=1).one().actor_key == SOURCE_KEY_STRIDE + 50001
+
+
+#tests for process-pool sharded fact extraction, using a sqlite file as the source so worker processes can open it
+@pytest.fixture()
+def payment_source_session(tmp_path):
+    source_engine = create_engine(f"sqlite:///{tmp_path / 'sakila.db'}", echo=False)
+    SakilaBase.metadata.create_all(source_engine)
+    source_session = sessionmaker(bind=source_engine)()
+    source_session.add_all([Staff(staff_id=1, store_id=1), Staff(staff_id=2, store_id=2)])
+    # gaps in the ids, so shards are not all the same size
+    for payment_id in [payment_id for payment_id in range(1, 600) if payment_id % 7 != 0]:
+        source_session.add(Payment(payment_id=payment_id, payment_date=datetime(2005, 6, 1) + timedelta(hours=payment_id),
+                                   customer_id=payment_id % 40 + 1, staff_id=payment_id % 2 + 1, amount=2.99, rental_id=payment_id))
+    source_session.commit()
+    return source_session
+
+
+class TestShards:
+    def test_shard_ranges_cover_ids(self, payment_source_session):
+        '''shards should be contiguous and cover every id from min to max'''
+        ranges = shard_ranges(payment_source_session, Payment.payment_id, 8)
+        assert ranges[0][0] == 1 and ranges[-1][1] == 599
+        assert all(upper + 1 == next_lower for (_, upper), (next_lower, _) in zip(ranges, ranges[1:]))
+
+    def test_sharded_load_matches_serial_load(self, payment_source_session):
+        '''the process pool should produce exactly the rows and keys of a serial load'''
+        loaded_rows = []
+        for workers in (1, 3):
+            warehouse_engine = create_engine("sqlite://", echo=False)
+            Base.metadata.create_all(warehouse_engine)
+            warehouse_session = sessionmaker(bind=warehouse_engine)()
+            if workers == 1:
+                create_fact_payment(warehouse_session, payment_source_session)
+            else:
+                create_fact_payment_sharded(warehouse_session, payment_source_session, workers=workers)
+            loaded_rows.append(warehouse_session.execute(text("SELECT * FROM fact_payment ORDER BY fact_payment_key")).all())
+        assert len(loaded_rows[0]) == 514
+        assert loaded_rows[0] == loaded_rows[1]
+
+
+#tests for the storage layout optimizer, run against a throwaway warehouse file
+@pytest.fixture()
+def rowid_warehouse_engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'warehouse.db'}", echo=False)
+    Base.metadata.create_all(engine, tables=[table for table in Base.metadata.sorted_tables if table.name != "bridge_film_actor"])
+    with engine.begin() as connection:
+        # the layout bridge_film_actor had before it was declared WITHOUT ROWID
+        connection.execute(text("CREATE TABLE bridge_film_actor (film_key INTEGER NOT NULL, actor_key INTEGER NOT NULL, "
+                                "PRIMARY KEY (film_key, actor_key))"))
+        connection.execute(text("INSERT INTO bridge_film_actor VALUES (101, 50001), (101, 50002), (201, 50001)"))
+        connection.execute(text("CREATE INDEX index_bridge_film_actor_actor_key ON bridge_film_actor (actor_key)"))
+    return engine
+
+
+class TestOptimize:
+    def test_bridge_rebuilt_without_rowid(self, rowid_warehouse_engine):
+        '''the bridge should move to its WITHOUT ROWID layout and keep every row'''
+        optimize_warehouse(rowid_warehouse_engine)
+        with rowid_warehouse_engine.connect() as connection:
+            assert has_rowid(connection, "bridge_film_actor") is False
+            assert connection.execute(text("SELECT COUNT(*) FROM bridge_film_actor")).scalar() == 3
+            assert connection.execute(text("PRAGMA integrity_check")).scalar() == "ok"
+
+    def test_requested_page_size_applied(self, rowid_warehouse_engine):
+        '''an explicit page size should be used for the rebuilt file'''
+        before, after = optimize_warehouse(rowid_warehouse_engine, 8192)
+        assert after["page_size"] == 8192
+        assert after["freelist_count"] == 0
+        with pytest.raises(ValueError):
+            optimize_warehouse(rowid_warehouse_engine, 5000)
+
+    def test_wal_warehouse_checkpointed_before_swap(self, rowid_warehouse_engine):
+        '''rows still in the WAL should survive the swap and the rebuilt file should stay in WAL mode'''
+        path = rowid_warehouse_engine.url.database
+        with rowid_warehouse_engine.begin() as connection:
+            connection.execute(text("PRAGMA journal_mode = WAL"))
+        writer = sqlite3.connect(path)
+        writer.execute("PRAGMA wal_autocheckpoint = 0")
+        writer.execute("INSERT INTO bridge_film_actor VALUES (301, 50003)")
+        writer.commit()
+        optimize_warehouse(rowid_warehouse_engine)
+        writer.close()
+        with rowid_warehouse_engine.connect() as connection:
+            assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+            assert connection.execute(text("SELECT COUNT(*) FROM bridge_film_actor")).scalar() == 4
+            assert connection.execute(text("PRAGMA integrity_check")).scalar() == "ok"
+
+
+#tests for the shadow build and swap used by Full-load
+class TestShadow:
+    def test_swap_replaces_file_and_keeps_old_snapshot(self, tmp_path):
+        '''new connections should see the shadow, a reader already open keeps the old file'''
+        db_name = str(tmp_path / "warehouse")
+        live_engine = create_engine(f"sqlite:///{db_name}.db", echo=False)
+        Base.metadata.create_all(live_engine)
+        with live_engine.begin() as connection:
+            connection.execute(text("INSERT INTO warehouse_source VALUES ('east', 0)"))
+            connection.execute(text("INSERT INTO dim_category VALUES (30011, 1, 'Action', '2006-02-15', '')"))
+
+        shadow_engine = create_shadow_engine(db_name)
+        copy_source_registry(live_engine, shadow_engine)
+        with shadow_engine.begin() as connection:
+            assert connection.execute(text("PRAGMA journal_mode")).scalar() == "off"
+            connection.execute(text("INSERT INTO dim_category VALUES (30021, 2, 'Animation', '2006-02-15', '')"))
+
+        reader = sqlite3.connect(f"{db_name}.db")
+        reader.execute("BEGIN")
+        assert reader.execute("SELECT name FROM dim_category").fetchall() == [("Action",)]
+        swap_in_shadow(live_engine, shadow_engine, db_name)
+
+        assert reader.execute("SELECT name FROM dim_category").fetchall() == [("Action",)]
+        reader.close()
+        with live_engine.connect() as connection:
+            assert connection.execute(text("SELECT name FROM dim_category")).scalars().all() == ["Animation"]
+            assert connection.execute(text("SELECT source_name FROM warehouse_source")).scalar() == "east"
+            assert connection.execute(text("PRAGMA journal_mode")).scalar() == "delete"
+        assert not shadow_path(db_name).exists()
+
+    def test_pooled_writers_reopen_after_swap(self, tmp_path):
+        '''a long-lived engine should write to the new file after a swap, and a WAL warehouse should stay WAL'''
+        db_name = str(tmp_path / "warehouse")
+        live_engine = create_engine(f"sqlite:///{db_name}.db", echo=False)
+        Base.metadata.create_all(live_engine)
+        assert enable_wal(live_engine) == "wal"
+        writer_engine = reopen_after_swap(create_engine(f"sqlite:///{db_name}.db", echo=False))
+        with writer_engine.begin() as connection:
+            connection.execute(text("INSERT INTO dim_category VALUES (30011, 1, 'Action', '2006-02-15', '')"))
+
+        shadow_engine = create_shadow_engine(db_name)
+        swap_in_shadow(live_engine, shadow_engine, db_name)
+        with writer_engine.begin() as connection:
+            connection.execute(text("INSERT INTO dim_category VALUES (30021, 2, 'Animation', '2006-02-15', '')"))
+        writer_engine.dispose()
+        with sqlite3.connect(f"{db_name}.db") as reader:
+            assert reader.execute("SELECT name FROM dim_category").fetchall() == [("Animation",)]
+            assert reader.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+
+
+#tests for the read-serving query endpoint
+class TestServer:
+    @pytest.fixture
+    def query_server(self, tmp_path):
+        db_name = str(tmp_path / "warehouse")
+        engine = create_engine(f"sqlite:///{db_name}.db", echo=False)
+        Base.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute(text("INSERT INTO dim_category VALUES (30011, 1, 'Action', '2006-02-15', '')"))
+        assert enable_wal(engine) == "wal"
+        server = create_query_server(db_name, port=0, pool_size=2)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+        server.shutdown()
+        server.server_close()
+        server.read_engine.dispose()
+        engine.dispose()
+
+    def test_routes_return_json(self, query_server):
+        '''known endpoints should answer 200 with json rows and a query time header'''
+        response = urllib.request.urlopen(f"{query_server}/rentals-by-category")
+        assert response.status == 200
+        assert response.headers["X-Query-Time-Ms"]
+        assert json.loads(response.read()) == []
+        health = json.loads(urllib.request.urlopen(f"{query_server}/health").read())
+        assert "Pool size: 2" in health["pool"]
+
+    def test_bad_requests_rejected(self, query_server):
+        '''unknown endpoints should answer 404 and invalid parameters 400'''
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(f"{query_server}/nope")
+        assert error.value.code == 404
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(f"{query_server}/revenue?period=week")
+        assert error.value.code == 400
+
+    def test_read_connections_are_query_only(self, query_server, tmp_path):
+        '''pooled read connections should refuse writes'''
+        engine = create_read_engine(str(tmp_path / "warehouse"), pool_size=1)
+        with engine.connect() as connection:
+            with pytest.raises(Exception):
+                connection.execute(text("DELETE FROM dim_category"))
+        engine.dispose()
+
+    def test_warm_up_queries_every_connection(self, tmp_path):
+        '''warming the pool should run every route on each connection, not answer all but the first from the cache'''
+        db_name = str(tmp_path / "warehouse")
+        Base.metadata.create_all(create_engine(f"sqlite:///{db_name}.db", echo=False))
+        engine = create_read_engine(db_name, pool_size=2)
+        queried = {}
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def count_queries(connection, cursor, statement, *args):
+            if "sync_state" not in statement:
+                queried[id(connection.connection.dbapi_connection)] = queried.get(id(connection.connection.dbapi_connection), 0) + 1
+
+        query_cache.invalidate()
+        warm_read_pool(engine, pool_size=2)
+        assert list(queried.values()) == [len(ROUTES), len(ROUTES)]
+        assert len(query_cache) == len(ROUTES)
+        engine.dispose()
+
+
+#tests for type 2 history on the film, store and customer dimensions, using in-memory sqlite on both sides
+@pytest.fixture()
+def scd_sessions():
+    source_engine = create_engine("sqlite://", echo=False)
+    SakilaBase.metadata.create_all(source_engine)
+    warehouse_engine = create_engine("sqlite://", echo=False)
+    Base.metadata.create_all(warehouse_engine)
+    source_session = sessionmaker(bind=source_engine)()
+    source_session.add_all([
+        Language(language_id=1, name="English"), Country(country_id=1, country="Canada"),
+        City(city_id=1, city="Lethbridge", country_id=1), City(city_id=2, city="Woodridge", country_id=1),
+        Address(address_id=1, city_id=1), Address(address_id=2, city_id=2),
+        Store(store_id=1, address_id=1, last_update=datetime(2006, 2, 15)), Staff(staff_id=1, store_id=1),
+        Customer(customer_id=1, first_name="MARY", last_name="SMITH", active=True, address_id=1, last_update=datetime(2006, 2, 15)),
+        Inventory(inventory_id=1, film_id=1, store_id=1),
+        FilmActor(film_id=1, actor_id=1), FilmCategory(film_id=1, category_id=1),
+    ])
+    source_session.add(Film(film_id=1, title="ACADEMY DINOSAUR", rating="PG", length=86, release_year=2006,
+                            last_update=datetime(2006, 2, 15), language_id=1))
+    source_session.commit()
+    warehouse_session = sessionmaker(bind=warehouse_engine)()
+    create_dim_film(warehouse_session, source_session)
+    create_dim_store(warehouse_session, source_session)
+    create_dim_customer(warehouse_session, source_session)
+    create_bridge_film_actor(warehouse_session, source_session)
+    create_bridge_film_category(warehouse_session, source_session)
+    return warehouse_session, source_session
+
+
+class TestScd:
+    def test_first_load_is_version_one(self, scd_sessions):
+        '''a full load should write the usual keys as current versions'''
+        warehouse_session, _ = scd_sessions
+        film = warehouse_session.query(dim_film).one()
+        assert (film.film_key, film.is_current, film.effective_date, film.expiry_date) == (101, 1, "2006-02-15", OPEN_EXPIRY_DATE)
+        assert warehouse_session.query(dim_store.store_key).scalar() == 1001
+        assert len(film.row_hash) == 16
+
+    def test_touch_without_change_writes_nothing(self, scd_sessions):
+        '''a bumped last_update with the same attributes should not create a version'''
+        warehouse_session, source_session = scd_sessions
+        source_session.query(Film).update({"last_update": datetime(2007, 1, 1)})
+        source_session.commit()
+        assert increment_dim_film(warehouse_session, source_session, datetime(2006, 12, 31)) == 0
+        assert warehouse_session.query(dim_film).count() == 1
+
+    def test_change_creates_new_version(self, scd_sessions):
+        '''a changed attribute should expire the current version and add the next key'''
+        warehouse_session, source_session = scd_sessions
+        source_session.query(Film).update({"title": "ACADEMY DINOSAUR II", "last_update": datetime(2007, 1, 1)})
+        source_session.query(Customer).update({"address_id": 2, "last_update": datetime(2007, 1, 1)})
+        source_session.commit()
+        assert increment_dim_film(warehouse_session, source_session, datetime(2006, 12, 31)) == 1
+        assert increment_dim_customer(warehouse_session, source_session, datetime(2006, 12, 31)) == 1
+        versions = warehouse_session.query(dim_film.film_key, dim_film.is_current, dim_film.expiry_date).order_by(dim_film.film_key).all()
+        assert versions == [(101, 0, "2007-01-01"), (102, 1, OPEN_EXPIRY_DATE)]
+        assert warehouse_session.query(dim_customer.city).filter_by(is_current=1).scalar() == "Woodridge"
+        # the new version keeps the film's actor and category links
+        assert warehouse_session.query(bridge_film_actor.film_key).order_by(bridge_film_actor.film_key).all() == [(101,), (102,)]
+        assert warehouse_session.query(bridge_film_category).filter(current_version_filter(bridge_film_category)).count() == 1
+
+    def test_facts_point_at_version_valid_on_their_date(self, scd_sessions):
+        '''fact loads should take the key of the version valid on the fact's date, and the first version before that'''
+        warehouse_session, source_session = scd_sessions
+        source_session.query(Film).update({"rating": "R", "last_update": datetime(2007, 1, 1)})
+        for rental_id, rental_date in ((1, datetime(2007, 2, 1)), (2, datetime(2006, 6, 1)), (3, datetime(2005, 5, 25))):
+            source_session.add(Rental(rental_id=rental_id, rental_date=rental_date, inventory_id=1, customer_id=1, staff_id=1))
+        source_session.commit()
+        create_dim_film(warehouse_session, source_session)
+        assert version_key_on(fact_key_map(warehouse_session), "film_key", 1) == 102
+        create_fact_rental(warehouse_session, source_session)
+        rentals = warehouse_session.query(fact_rental.rental_id, fact_rental.film_key, fact_rental.store_key, fact_rental.customer_key)
+        assert rentals.order_by(fact_rental.rental_id).all() == [(1, 102, 1001, 101), (2, 101, 1001, 101), (3, 101, 1001, 101)]
+
+    def test_deleted_rows_are_expired(self, scd_sessions):
+        '''a row deleted in sakila should be closed, not removed, and come back as a new version'''
+        warehouse_session, source_session = scd_sessions
+        source_session.query(Customer).delete()
+        source_session.commit()
+        assert reconcile_deletes(warehouse_session, source_session)["dim_customer"] == 1
+        assert warehouse_session.query(dim_customer.is_current).one() == (0,)
+        assert validate_table(warehouse_session, dim_customer, source_session, Customer) is True
+        source_session.add(Customer(customer_id=1, first_name="MARY", last_name="SMITH", active=True, address_id=1,
+                                    last_update=datetime(2007, 1, 1)))
+        source_session.commit()
+        create_dim_customer(warehouse_session, source_session)
+        assert warehouse_session.query(dim_customer.customer_key).filter_by(is_current=1).scalar() == 102
+
+    def test_migration_adds_history_columns(self, tmp_path):
+        '''an old warehouse should get the history columns with matching hashes'''
+        engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}", echo=False)
+        with engine.begin() as connection:
+            connection.execute(text("CREATE TABLE dim_store (store_key INTEGER PRIMARY KEY, store_id INTEGER, city VARCHAR(20), "
+                                    "country VARCHAR(20), last_update VARCHAR(10))"))
+            connection.execute(text("INSERT INTO dim_store VALUES (1001, 1, 'Lethbridge', 'Canada', '2006-02-15')"))
+            for table_name in ("dim_film", "dim_customer"):
+                Base.metadata.tables[table_name].create(connection)
+        assert migrate_scd_columns(engine) == ["dim_store"]
+        session = sessionmaker(bind=engine)()
+        store = session.query(dim_store).one()
+        assert (store.effective_date, store.is_current) == ("2006-02-15", 1)
+        assert store.row_hash == row_hash({"city": "Lethbridge", "country": "Canada"}, ["city", "country"])
+
+    def test_touched_type1_rows_not_rewritten(self, reconcile_sessions):
+        '''a bulk touch of last_update should not rewrite actors, a real change should'''
+        warehouse_session, source_session = reconcile_sessions
+        assert create_dim_actor(warehouse_session, source_session) == 2500
+        source_session.query(Actor).update({"last_update": datetime(2007, 1, 1)})
+        source_session.query(Actor).filter(Actor.actor_id == 42).update({"last_name": "C"})
+        source_session.commit()
+        assert increment_dim_actor(warehouse_session, source_session, datetime(2006, 12, 31)) == 1
+        assert warehouse_session.query(dim_actor.last_name).filter_by(actor_id=42).scalar() == "C"
+        assert reload_table(warehouse_session, source_session, "dim_actor") == 2500
+        assert warehouse_session.query(dim_actor.last_update).filter_by(actor_id=1).scalar() == "2006-01-01"
+
+
+#tests for rechecking open rentals against sakila
+class TestOpenRentals:
+    def test_returned_rentals_updated(self, scd_sessions):
+        '''a rental returned after it was loaded should get its return date key and duration'''
+        warehouse_session, source_session = scd_sessions
+        for rental_id in (1, 2, 3):
+            source_session.add(Rental(rental_id=rental_id, rental_date=datetime(2006, 2, 1), inventory_id=1, customer_id=1, staff_id=1))
+        source_session.commit()
+        create_fact_rental(warehouse_session, source_session)
+        assert sorted(open_rentals(warehouse_session)) == [1, 2, 3]
+
+        source_session.query(Rental).filter(Rental.rental_id.in_([1, 3])).update({"return_date": datetime(2006, 2, 4)})
+        source_session.commit()
+        assert refresh_open_rentals(warehouse_session, source_session, batch_size=2) == 2
+        returned = warehouse_session.query(fact_rental.date_key_returned, fact_rental.rental_duration_days).filter_by(rental_id=3).one()
+        assert tuple(returned) == (20060204, 3)
+        assert list(open_rentals(warehouse_session)) == [2]
+
+    def test_open_rentals_read_from_partial_index(self, sqlite_engine):
+        '''the open rental lookup should search the partial index instead of scanning fact_rental'''
+        with sqlite_engine.connect() as connection:
+            plan = connection.execute(text(
+                "EXPLAIN QUERY PLAN SELECT rental_id, fact_rental_key FROM fact_rental "
+                "WHERE date_key_returned IS NULL AND fact_rental_key BETWEEN 0 AND 999999999"
+            )).all()
+        assert "index_fact_rental_open" in plan[-1][-1]
+
+
+#tests for surrogate keys derived from natural ids
+class TestKeys:
+    def test_keys_follow_natural_ids(self, payment_source_session):
+        '''fact keys should come from the payment id, not the row's position in the load'''
+        warehouse_engine = create_engine("sqlite://", echo=False)
+        Base.metadata.create_all(warehouse_engine)
+        warehouse_session = sessionmaker(bind=warehouse_engine)()
+        create_fact_payment(warehouse_session, payment_source_session)
+        assert all(key == 80000 + payment_id for key, payment_id in
+                   warehouse_session.query(fact_payment.fact_payment_key, fact_payment.payment_id))
+        assert (surrogate_key("dim_film", 7), surrogate_key("dim_store", 2, version=2)) == (701, 2002)
+        assert surrogate_key("fact_rental", 5, SOURCE_KEY_STRIDE) == SOURCE_KEY_STRIDE + 50005
+
+    def test_stored_keys_kept_and_collisions_refused(self, scd_sessions):
+        '''a loaded rental should keep its key, and a derived key held by another rental should stop the load'''
+        warehouse_session, _ = scd_sessions
+        warehouse_session.add(fact_rental(fact_rental_key=50001, rental_id=5, film_key=101, store_key=1001, customer_key=101, staff_id=1))
+        warehouse_session.commit()
+        allocator = KeyAllocator(warehouse_session, "fact_rental")
+        allocator.preload([5])
+        assert (allocator.key(5), allocator.key(6)) == (50001, 50006)
+        with pytest.raises(Exception, match="Migrate"):
+            allocator.preload([1])
+
+    def test_migration_renumbers_positional_keys(self, tmp_path):
+        '''Migrate should move every legacy fact key to the key of its natural id'''
+        engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}", echo=False)
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        for position, rental_id in enumerate([3, 1, 2], start=1):
+            session.add(fact_rental(fact_rental_key=50000 + position, rental_id=rental_id, film_key=101, store_key=1001,
+                                    customer_key=101, staff_id=1))
+        session.commit()
+        assert migrate_fact_keys(engine) == 3
+        assert session.query(fact_rental.fact_rental_key, fact_rental.rental_id).order_by(fact_rental.rental_id).all() == [
+            (50001, 1), (50002, 2), (50003, 3)]
+        assert migrate_fact_keys(engine) == 0
+
+    def test_partitioned_rental_updated(self, rental_warehouse):
+        '''an update to a partitioned rental should keep its key and move the row back to main without a copy left behind'''
+        warehouse_session, source_session, db_name = rental_warehouse
+        for rental_id, year in ((1, 2004), (2, 2005), (3, 2006)):
+            source_session.add(Rental(rental_id=rental_id, rental_date=datetime(year, 2, 1), return_date=datetime(year, 2, 2),
+                                      inventory_id=1, customer_id=1, staff_id=1))
+        source_session.commit()
+        create_fact_rental(warehouse_session, source_session)
+        partition_fact_tables(warehouse_session.get_bind(), db_name)
+        assert warehouse_session.query(fact_rental).count() == 1
+
+        source_session.query(Rental).filter_by(rental_id=1).update({"return_date": datetime(2004, 2, 3)})
+        source_session.commit()
+        increment_fact_rental(warehouse_session, source_session, None, changed_ids=[1])
+        partitioned_session = create_partitioned_session(db_name)
+        rentals = partitioned_session.query(fact_rental.rental_id, fact_rental.fact_rental_key, fact_rental.date_key_returned)
+        assert sorted(rentals.all()) == [(1, 50001, 20040203), (2, 50002, 20050202), (3, 50003, 20060202)]
+        assert is_frozen(partition_path(db_name, 2004))
+        partitioned_session.close()
+
+
+#tests for the statement and plan capture hook
+@pytest.fixture()
+def statement_capture():
+    capture = install_statement_capture()
+    yield capture
+    capture.remove()
+
+
+class TestStatementCapture:
+    def test_statements_counted_and_explained(self, statement_capture, reconcile_sessions):
+        '''each distinct statement should be recorded once with its executions and plan'''
+        warehouse_session, _ = reconcile_sessions
+        for actor_key in (50001, 50002, 50003):
+            warehouse_session.query(dim_actor.last_name).filter(dim_actor.actor_key == actor_key).all()
+        lookups = [stats for stats in statement_capture.ranked() if "WHERE dim_actor.actor_key =" in stats.statement]
+        assert len(lookups) == 1 and lookups[0].executions == 3
+        assert lookups[0].plan[0].startswith("SEARCH dim_actor") and lookups[0].full_scans == []
+
+    def test_full_scans_flagged(self, statement_capture, reconcile_sessions):
+        '''a filter on an unindexed column should be reported as a full scan'''
+        warehouse_session, _ = reconcile_sessions
+        warehouse_session.query(dim_actor.actor_key).filter(dim_actor.last_name == "B").all()
+        assert [stats.full_scans for stats in statement_capture.full_scans()] == [["SCAN dim_actor"]]
+
+    def test_in_lists_collapse_to_one_statement(self, statement_capture, reconcile_sessions):
+        '''IN lists of different lengths should count as the same statement'''
+        warehouse_session, _ = reconcile_sessions
+        for actor_keys in ([50001], [50001, 50002], [50001, 50002, 50003]):
+            warehouse_session.query(dim_actor.last_name).filter(dim_actor.actor_key.in_(actor_keys)).all()
+        lookups = [stats for stats in statement_capture.ranked() if "dim_actor.actor_key IN" in stats.statement]
+        assert len(lookups) == 1 and lookups[0].executions == 3
+
+
+#tests for live load progress
+@pytest.fixture()
+def progress_settings():
+    yield configure_progress
+    configure_progress(5.0, "human")
+
+
+class TestProgress:
+    def test_json_lines_carry_rate_and_eta(self, progress_settings, capsys):
+        '''every structured line should report rows done, the expected rows, a rate and an ETA'''
+        progress_settings(0, "json")
+        assert list(track(range(4), "fact_rental")) == [0, 1, 2, 3]
+        lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+        assert [line["event"] for line in lines] == ["progress"] * 4 + ["finished"]
+        assert (lines[1]["rows_done"], lines[1]["rows_expected"]) == (2, 4)
+        assert lines[1]["rows_per_second"] > 0 and lines[1]["eta_seconds"] >= 0
+
+    def test_only_summary_within_interval(self, progress_settings, capsys):
+        '''a table finished inside one interval should print just its summary line'''
+        progress_settings(60, "human")
+        for _ in track(list(range(1000)), "bridge_film_actor"):
+            pass
+        output = capsys.readouterr().out.splitlines()
+        assert len(output) == 1 and output[0].startswith("bridge_film_actor: 1000 rows in")
+
+
+#tests for the hot path micro-benchmarks, run on a handful of rows so they stay quick
+class TestBenchmarks:
+    def test_every_transform_and_strategy_measured(self):
+        '''each transform and write strategy should report a cost per row'''
+        results = run_benchmarks(rows=50, repeats=1)
+        names = {result.name for result in results}
+        assert set(WRITE_STRATEGIES) <= names and {"rental_fact_values", "row_hash", "build_dim_date"} <= names
+        assert all(result.rows == 50 and result.ns_per_row > 0 for result in results)
+
+    def test_synthetic_rows_are_reproducible(self):
+        '''the same seed should produce the same rows to transform'''
+        first, second = synthetic_sakila_rows(20), synthetic_sakila_rows(20)
+        assert fact_payment_rows(first) == fact_payment_rows(second)
+
+    def test_regressions_flagged_against_baseline(self, tmp_path):
+        '''a benchmark slower than its stored baseline by more than the tolerance should be reported'''
+        results = [BenchmarkResult("write_merge", 10, 200.0, 50.0), BenchmarkResult("row_hash", 10, 100.0, 10.0)]
+        save_baseline([BenchmarkResult("write_merge", 10, 100.0, 50.0), BenchmarkResult("row_hash", 10, 95.0, 10.0)],
+                      tmp_path / "baseline.json")
+        ratios, regressions = compare_to_baseline(results, load_baseline(tmp_path / "baseline.json"))
+        assert ratios["write_merge"] == 2.0 and regressions == ["write_merge"]
+
+
+#tests for publishing the warehouse to the columnar duckdb backend, skipped without the optional duckdb packages
+@pytest.fixture()
+def published_warehouse(tmp_path, monkeypatch):
+    pytest.importorskip("duckdb_engine")
+    monkeypatch.chdir(tmp_path)
+    engine = create_engine(f"sqlite:///{tmp_path / 'warehouse.db'}", echo=False)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add_all([dim_date(date_key=20050601 + day, date=f"2005-06-{day + 1:02d}", year=2005, quarter=2, month=6,
+                              day_of_month=day + 1, day_of_week=day % 7 + 1, is_weekend=0) for day in range(3)])
+    session.add_all([fact_payment(fact_payment_key=80000 + payment_id, payment_id=payment_id, date_key_paid=20050601 + payment_id % 3,
+                                  customer_key=101, store_key=1001, staff_id=1, amount=2.99)
+                     for payment_id in range(1, 301)])
+    session.commit()
+    return engine, session
+
+
+class TestBackends:
+    def test_published_copy_answers_like_sqlite(self, published_warehouse):
+        '''queries on the duckdb copy should return what they return on sqlite'''
+        engine, session = published_warehouse
+        counts = publish_warehouse(engine, "warehouse", "duckdb")
+        assert (counts["fact_payment"], counts["dim_date"]) == (300, 3)
+        duckdb_session = create_backend_session("warehouse", "duckdb")
+        assert revenue_by_period(duckdb_session, "day", QueryCache()) == revenue_by_period(session, "day", QueryCache())
+        duckdb_session.close()
+
+    def test_csv_ingest_without_pyarrow(self, published_warehouse, monkeypatch):
+        '''without pyarrow the batches should go through COPY and keep their nulls'''
+        engine, session = published_warehouse
+        for rental_id, returned in ((1, 20050603), (2, None)):
+            session.add(fact_rental(fact_rental_key=50000 + rental_id, rental_id=rental_id, date_key_rented=20050601,
+                                    date_key_returned=returned, film_key=101, store_key=1001, customer_key=101, staff_id=1))
+        session.commit()
+        monkeypatch.setitem(sys.modules, "pyarrow", None)
+        publish_warehouse(engine, "warehouse", "duckdb")
+        duckdb_session = create_backend_session("warehouse", "duckdb")
+        assert duckdb_session.query(fact_rental.rental_id).filter(fact_rental.date_key_returned.is_(None)).all() == [(2,)]
+        assert duckdb_session.query(func.sum(fact_payment.amount)).scalar() == pytest.approx(897.0)
+        duckdb_session.close()
+
+
+#tests for committing an incremental cycle as one transaction or a few, on a sqlite file so two connections can look
+@pytest.fixture()
+def group_commit_warehouse(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'warehouse.db'}", echo=False)
+    Base.metadata.create_all(engine)
+    return engine
+
+
+def committed_sync_states(engine):
+    with engine.connect() as connection:
+        return connection.execute(text("SELECT table_name FROM sync_state ORDER BY table_name")).scalars().all()
+
+
+class TestGroupCommit:
+    def test_loader_commits_stay_inside_the_cycle(self, group_commit_warehouse):
+        '''a loader's commit should not be visible to other connections until the cycle finishes'''
+        cycle = GroupCommit(group_commit_warehouse, 0)
+        cycle.session.merge(sync_state(table_name="dim_actor", last_update="2006-02-15 04:34:33"))
+        cycle.session.commit()
+        cycle.step_done()
+        assert committed_sync_states(group_commit_warehouse) == []
+        cycle.finish()
+        cycle.close()
+        assert committed_sync_states(group_commit_warehouse) == ["dim_actor"]
+
+    def test_failed_cycle_keeps_old_watermarks(self, group_commit_warehouse):
+        '''an error part way through a cycle should roll back its rows and its watermarks'''
+        with pytest.raises(Exception, match="source went away"):
+            with open_cycle_transaction(sessionmaker(bind=group_commit_warehouse)(), 0) as cycle:
+                cycle.session.add(dim_actor(actor_key=50001, actor_id=1, first_name="A", last_name="B",
+                                            last_update="2006-01-01", row_hash=""))
+                cycle.session.merge(sync_state(table_name="dim_actor", last_update="2006-02-15 04:34:33"))
+                cycle.session.commit()
+                cycle.step_done()
+                raise Exception("source went away")
+        assert committed_sync_states(group_commit_warehouse) == []
+        with group_commit_warehouse.connect() as connection:
+            assert connection.execute(text("SELECT COUNT(*) FROM dim_actor")).scalar() == 0
+
+    def test_groups_commit_every_n_steps(self, group_commit_warehouse):
+        '''a group size of 2 should commit after every second step and once more for the remainder'''
+        with open_cycle_transaction(sessionmaker(bind=group_commit_warehouse)(), 2) as cycle:
+            for table_name in ("dim_film", "dim_actor", "dim_category"):
+                cycle.session.merge(sync_state(table_name=table_name, last_update="2006-02-15 04:34:33"))
+                cycle.session.commit()
+                cycle.step_done()
+            assert committed_sync_states(group_commit_warehouse) == ["dim_actor", "dim_film"]
+            cycle.finish()
+        assert cycle.commits == 2
+        assert committed_sync_states(group_commit_warehouse) == ["dim_actor", "dim_category", "dim_film"]
+
+
+#tests for the fact to dimension integrity check, reusing the in-memory type 2 fixture
+@pytest.fixture()
+def orphan_rentals(scd_sessions):
+    warehouse_session, source_session = scd_sessions
+    source_session.add_all([
+        Rental(rental_id=1, rental_date=datetime(2007, 2, 1), inventory_id=1, customer_id=1, staff_id=1),
+        Rental(rental_id=2, rental_date=datetime(2007, 3, 5), inventory_id=1, customer_id=2, staff_id=1),
+    ])
+    source_session.commit()
+    create_fact_rental(warehouse_session, source_session)
+    return warehouse_session, source_session
+
+
+class TestIntegrity:
+    def test_orphans_reported_per_reference(self, orphan_rentals):
+        '''fact keys with no dimension row should be counted under the column that holds them'''
+        warehouse_session, _ = orphan_rentals
+        report = check_fact_integrity(warehouse_session, placeholders=False)
+        assert report["fact_rental.customer_key"] == {201: 1}
+        assert report["fact_rental.date_key_rented"] == {20070201: 1, 20070305: 1}
+        assert report["fact_rental.film_key"] == {} and report["fact_payment.customer_key"] == {}
+
+    def test_scope_only_checks_rows_the_cycle_wrote(self, orphan_rentals):
+        '''a watermark scope should leave fact rows dated before the watermark unchecked'''
+        warehouse_session, _ = orphan_rentals
+        report = check_fact_integrity(warehouse_session, {"fact_rental": cycle_scopes("fact_rental", datetime(2007, 3, 1))},
+                                      placeholders=False)
+        assert report["fact_rental.date_key_rented"] == {20070305: 1}
+        assert "fact_payment.date_key_paid" not in report
+
+    def test_placeholders_taken_over_by_real_rows(self, orphan_rentals):
+        '''placeholder members should clear the orphans and give their key to the real row when it loads'''
+        warehouse_session, source_session = orphan_rentals
+        check_fact_integrity(warehouse_session, placeholders=True)
+        assert not any(check_fact_integrity(warehouse_session, placeholders=False).values())
+        assert warehouse_session.query(dim_customer.customer_id, dim_customer.row_hash).filter_by(customer_key=201).one() == (2, PLACEHOLDER_ROW_HASH)
+        assert warehouse_session.query(dim_date.day_of_week).filter_by(date_key=20070305).scalar() == 1
+        source_session.add(Customer(customer_id=2, first_name="PATRICIA", last_name="JOHNSON", active=True, address_id=1,
+                                    last_update=datetime(2007, 3, 5)))
+        source_session.commit()
+        create_dim_customer(warehouse_session, source_session)
+        assert warehouse_session.query(dim_customer.customer_key, dim_customer.first_name, dim_customer.is_current).filter_by(
+            customer_id=2).all() == [(201, "PATRICIA", 1)]
+
+    def test_natural_id_recovered_from_key(self):
+        '''the natural id should come back from every version's key in every source block'''
+        for table_name, natural_id, version in (("dim_film", 7, 3), ("dim_store", 2, 4), ("dim_customer", 599, 1)):
+            key = surrogate_key(table_name, natural_id, 2 * SOURCE_KEY_STRIDE, version)
+            assert natural_id_from_key(table_name, key) == natural_id
+
+
+#tests for per table leases between incremental workers, on the sqlite file fixture of the group commit tests
+class TestLeases:
+    def test_second_worker_skips_held_tables(self, group_commit_warehouse):
+        '''a table leased by one worker should not be handed to another'''
+        first, second = LeaseHolder(group_commit_warehouse, 30), LeaseHolder(group_commit_warehouse, 30)
+        assert first.acquire(["dim_film", "fact_rental"]) == ["dim_film", "fact_rental"]
+        assert second.acquire(["fact_rental", "dim_actor"]) == ["dim_actor"]
+        assert second.acquire(["dim_film", "dim_category"], all_or_nothing=True) == []
+        assert not second.holds("dim_category")
+
+    def test_expired_lease_reclaimed_and_lost(self, group_commit_warehouse, capsys):
+        '''a lease past its expiry should go to the next worker, and its old owner should stop before the watermark'''
+        stalled, worker = LeaseHolder(group_commit_warehouse, 30), LeaseHolder(group_commit_warehouse, 30)
+        stalled.acquire(["fact_rental"])
+        with group_commit_warehouse.begin() as connection:
+            connection.execute(text("UPDATE sync_lease SET expires_at = '2020-01-01 00:00:00.000000'"))
+        assert worker.acquire(["fact_rental"]) == ["fact_rental"]
+        assert f"reclaimed from {stalled.owner}" in capsys.readouterr().out
+        stalled.renew()
+        with pytest.raises(Exception, match="taken over"):
+            stalled.check("fact_rental")
+
+    def test_stale_expiry_fails_check(self, group_commit_warehouse):
+        '''a lease whose stored expiry passed should fail the check even before another worker reclaims it'''
+        stalled = LeaseHolder(group_commit_warehouse, 30)
+        stalled.acquire(["fact_rental"])
+        stalled.check("fact_rental")
+        with group_commit_warehouse.begin() as connection:
+            connection.execute(text("UPDATE sync_lease SET expires_at = '2020-01-01 00:00:00.000000'"))
+        with pytest.raises(Exception, match="expired at 2020"):
+            stalled.check("fact_rental")
+
+    def test_group_commit_cycle_renews_its_leases(self, group_commit_warehouse):
+        '''a group commit cycle should renew its leases in its own transaction while it holds the write lock'''
+        leases, other = LeaseHolder(group_commit_warehouse, 30), LeaseHolder(group_commit_warehouse, 0.3)
+        leases.acquire(["fact_rental"])
+        with group_commit_warehouse.begin() as connection:
+            connection.execute(text("UPDATE sync_lease SET expires_at = '2020-01-01 00:00:00.000000'"))
+        with open_cycle_transaction(sessionmaker(bind=group_commit_warehouse)(), 0, leases) as cycle:
+            cycle.step_done()
+            leases.check("fact_rental")
+            assert other.acquire(["fact_rental"]) == []
+            cycle.finish()
+        leases.check("fact_rental")
+        assert leases.session is None and other.acquire(["fact_rental"]) == []
+
+    def test_leases_released_on_exit(self, group_commit_warehouse):
+        '''leaving the lease context should free every lease for the next worker'''
+        session = sessionmaker(bind=group_commit_warehouse)()
+        with hold_sync_leases(session, ["dim_date", sync_lease_name("dim_film", None)], 30) as leases:
+            assert leases.holds("dim_date") and leases.holds("dim_film")
+            assert LeaseHolder(group_commit_warehouse, 30).acquire(["dim_date"]) == []
+        with group_commit_warehouse.connect() as connection:
+            assert connection.execute(text("SELECT COUNT(*) FROM sync_lease")).scalar() == 0
+        session.close()
@@ -0,0 +1,116 @@
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from partition_helper_functions import flush_partition_deletes
+from shadow_helper_functions import reopen_after_swap
+from lease_helper_functions import NoLeases
+import threading
+
+
+# one engine per warehouse file, so daemon cycles and concurrent sources share its pool and statement cache
+group_commit_engines = {}
+group_commit_engines_lock = threading.Lock()
+
+
+def group_commit_engine(sqlite_engine):
+    '''
+    pysqlite begins and commits transactions on its own, which turns a RELEASE of the outermost savepoint into a
+    commit. This engine takes transaction control away from the driver and opens every transaction with BEGIN
+    IMMEDIATE, so a cycle holds the write lock from its first statement and concurrent sources wait on the busy
+    timeout instead of failing when two read locks try to become write locks at once.
+    '''
+    url = sqlite_engine.engine.url
+    with group_commit_engines_lock:
+        engine = group_commit_engines.get(str(url))
+        if engine is None:
+            engine = reopen_after_swap(create_engine(url, echo=False, connect_args={"timeout": 300, "isolation_level": None}))
+
+            @event.listens_for(engine, "begin")
+            def on_begin(connection):
+                connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+            group_commit_engines[str(url)] = engine
+    return engine
+
+
+class LoaderCommits:
+    '''the default: every loader commits its own rows, and each watermark is committed right after them'''
+    def __init__(self, sqlite_session):
+        self.session = sqlite_session
+        self.commits = 0
+
+    def step_done(self):
+        pass
+
+    def finish(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class GroupCommit(LoaderCommits):
+    '''
+    runs an incremental cycle on one connection whose transaction the loaders cannot end. The cycle's session joins
+    it with savepoints, so the commit() every loader calls only releases a savepoint. The transaction is committed
+    after every `group_size` steps (a table with its watermark, a bridge, dim_date, the open rental refresh, the
+    delete reconciliation), or once when the cycle finishes when group_size is 0. A cycle that fails rolls back
+    everything since the last group commit, watermarks included. The cycle's leases are renewed in its transaction
+    after every step, the heartbeat could not get past the write lock the cycle holds.
+    '''
+    def __init__(self, sqlite_engine, group_size=0, leases=None):
+        self.group_size = group_size
+        self.leases = leases or NoLeases()
+        self.connection = group_commit_engine(sqlite_engine).connect()
+        self.transaction = self.connection.begin()
+        super().__init__(Session(bind=self.connection, join_transaction_mode="create_savepoint"))
+        # fact rows leaving a partition are deleted from it only after the transaction that wrote them commits
+        self.session.info["pending_partition_deletes"] = []
+        self.leases.join(self.session)
+        self.steps = 0
+        self.uncommitted_steps = 0
+
+    def step_done(self):
+        self.leases.renew()
+        self.steps += 1
+        self.uncommitted_steps += 1
+        if self.group_size and self.uncommitted_steps == self.group_size:
+            self.commit()
+
+    def commit(self, reopen=True):
+        self.session.commit()
+        self.transaction.commit()
+        flush_partition_deletes(self.session)
+        if self.uncommitted_steps:
+            self.commits += 1
+            self.uncommitted_steps = 0
+        self.transaction = self.connection.begin() if reopen else None
+
+    def finish(self):
+        self.commit(reopen=False)
+        print(f"group commit: {self.steps} steps in {self.commits} transactions")
+
+    def close(self):
+        self.leases.join(None)
+        self.session.close()
+        if self.transaction is not None:
+            self.transaction.rollback()
+            self.transaction = None
+        self.connection.close()
+
+
+def open_cycle_transaction(sqlite_session, group_size=None, leases=None):
+    '''
+    LoaderCommits when group_size is None, otherwise a GroupCommit of group_size steps per transaction (0 for the
+    whole cycle) that renews leases as it goes. The cycle writes through the returned object's session either way.
+    '''
+    if group_size is None:
+        return LoaderCommits(sqlite_session)
+    if group_size < 0:
+        raise ValueError(f"group commit size must be 0 or more: {group_size}")
+    return GroupCommit(sqlite_session.get_bind(), group_size, leases)